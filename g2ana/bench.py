@@ -0,0 +1,348 @@
+#
+# bench.py -- micro-benchmarks for the ANA plugin ingest path
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Micro-benchmarks for parts of the ANA plugin ingest path.  All of them
+run on synthetic data in a temporary directory and need no Gen2
+services.
+
+Typical usage:
+
+# Run all benchmarks
+$ ana_bench --stderr
+
+# Run only the tile decompression benchmark, with 8 threads
+$ ana_bench --stderr --threads=8 tiles
+
+# Run only the frame routing benchmark
+$ ana_bench --stderr routing
+
+# Compare the threaded and asyncio ingest engines
+$ ana_bench --stderr engines
+
+# Compare encodings of array results for XML-RPC
+$ ana_bench --stderr rpc
+"""
+import os
+import time
+import tempfile
+import threading
+import xmlrpc.client
+
+import numpy as np
+from astropy.io import fits
+
+from g2base import ssdlog
+from g2base.astro.frame import Frame
+import g2cam.INS as INSconfig
+
+from ginga.misc import Bunch
+
+from g2ana import fitsutil, routing, ingest, engine, rpcdata
+
+
+def make_synthetic_frame(shape, dtype, seed=0):
+    """Make a frame that compresses roughly like a real one: a sky level
+    with a gentle gradient, read/photon noise and some stars.
+    """
+    rng = np.random.default_rng(seed)
+    ht, wd = shape
+    yy, xx = np.mgrid[0:ht, 0:wd]
+    data = 1000.0 + 50.0 * (xx / wd) + 20.0 * (yy / ht)
+    data += rng.normal(0.0, 15.0, size=shape)
+    for i in range(max(1, (ht * wd) // 200000)):
+        x, y = rng.uniform(0, wd), rng.uniform(0, ht)
+        flux = rng.uniform(1.0e3, 3.0e4)
+        x1, x2 = max(0, int(x) - 8), min(wd, int(x) + 9)
+        y1, y2 = max(0, int(y) - 8), min(ht, int(y) + 9)
+        r2 = (xx[y1:y2, x1:x2] - x) ** 2 + (yy[y1:y2, x1:x2] - y) ** 2
+        data[y1:y2, x1:x2] += flux * np.exp(-r2 / 4.0)
+    return data.astype(dtype)
+
+
+def write_compressed(filepath, data, header=None,
+                     compression_type='RICE_1'):
+    hdulist = fits.HDUList([fits.PrimaryHDU(),
+                            fits.CompImageHDU(data, header=header,
+                                              compression_type=compression_type)])
+    hdulist.writeto(filepath, overwrite=True)
+
+
+def best_of(fn, repeat):
+    """Returns the best wall clock time of `repeat` calls to `fn`."""
+    res = []
+    for i in range(repeat):
+        time_start = time.perf_counter()
+        fn()
+        res.append(time.perf_counter() - time_start)
+    return min(res)
+
+
+def bench_tiles(options, logger):
+    """Compare the tile-parallel decompression in fitsutil with the
+    regular (single threaded) astropy path.
+    """
+    print("tile decompression: {} threads, best of {} ({} cpus)".format(
+        options.threads, options.repeat, os.cpu_count()))
+    print("{:>12s} {:>8s} {:>10s} {:>10s} {:>8s}".format(
+        'shape', 'dtype', 'serial ms', 'tiled ms', 'speedup'))
+
+    def serial(filepath):
+        with fits.open(filepath) as fits_f:
+            return np.asarray(fits_f[1].data)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for shape in [(2048, 2048), (4096, 4096), (4224, 8192)]:
+            # uint16 is stored scaled (BZERO=32768), like most raw frames
+            for dtype in [np.uint16, np.int32, np.float32]:
+                data = make_synthetic_frame(shape, dtype)
+                filepath = os.path.join(tmpdir, 'bench.fits.fz')
+                write_compressed(filepath, data)
+
+                ref = serial(filepath)
+                out, header = fitsutil.read_tiled_data(filepath,
+                                                       options.threads)
+                if not np.array_equal(ref, out):
+                    logger.error("tiled result differs for {} {}".format(
+                        shape, dtype.__name__))
+
+                t_serial = best_of(lambda: serial(filepath), options.repeat)
+                # reuse the output buffer, as with a reserved buffer
+                t_tiled = best_of(lambda: fitsutil.read_tiled_data(
+                    filepath, options.threads, out=out), options.repeat)
+
+                print("{:>12s} {:>8s} {:10.1f} {:10.1f} {:8.2f}".format(
+                    '{}x{}'.format(*shape), dtype.__name__,
+                    t_serial * 1000, t_tiled * 1000, t_serial / t_tiled))
+
+
+def bench_routing(options, logger):
+    """Compare the cost per frame of routing with a RoutingTable to
+    working out the channel from scratch, as ANA used to for each frame.
+    """
+    num_frames = 10000
+    insconfig = INSconfig.INSdata()
+    table = routing.RoutingTable(insconfig, logger=logger)
+
+    # a mix of instruments, including ones routed by frame number (PFS)
+    # and by header (FOCAS, MOIRCS)
+    inscodes = ['IRC', 'HSC', 'FCS', 'MCS', 'PFS']
+    frames, headers = [], []
+    for i in range(num_frames):
+        inscode = inscodes[i % len(inscodes)]
+        number = 100 + i * 10 + (i % 4) + 1
+        frames.append(Frame(path='{}A{:08d}.fits'.format(inscode, number)))
+        headers.append({'DET-ID': i % 2 + 1})
+    channels = set()
+
+    def uncached():
+        for frame, header in zip(frames, headers):
+            chname = insconfig.getNameByFrameId(str(frame))
+            chname = routing.get_chname(frame, header, chname)
+            routing.get_wsname(chname)
+
+    def cached():
+        for frame, header in zip(frames, headers):
+            route = table.lookup(frame, header)
+            route.chname in channels
+
+    t_uncached = best_of(uncached, options.repeat)
+    t_cached = best_of(cached, options.repeat)
+
+    print("frame routing: {} frames, best of {}".format(num_frames,
+                                                        options.repeat))
+    print("{:>12s} {:>12s} {:>8s}".format('uncached us', 'table us',
+                                          'speedup'))
+    print("{:12.2f} {:12.2f} {:8.2f}".format(
+        t_uncached / num_frames * 1.0e6, t_cached / num_frames * 1.0e6,
+        t_uncached / t_cached))
+    print("table: {}".format(table.get_stats()))
+
+
+class EngineBenchClient:
+    """Minimal ingest engine client: reads the header of each file and
+    records the time from the file appearing to its result being
+    delivered.
+    """
+
+    def __init__(self, queue, gate):
+        self.queue = queue
+        self.gate = gate
+        self.time_arrived = {}
+        self.latency = ingest.LatencyStats()
+        self.cond = threading.Condition()
+        self.num_delivered = 0
+
+    def index_dir(self, path):
+        pass
+
+    def file_added(self, filepath):
+        pass
+
+    def file_removed(self, filepath):
+        pass
+
+    def enqueue_file(self, bnch):
+        bnch.order_key = 'bench'
+        bnch.ticket = self.gate.ticket(bnch.order_key)
+        self.queue.put(bnch)
+
+    def process_file(self, bnch, idx):
+        header = fitsutil.read_header(bnch.filepath)
+        return Bunch.Bunch(filepath=bnch.filepath, header=header)
+
+    def deliver(self, results):
+        now = time.time()
+        with self.cond:
+            for res in results:
+                self.latency.record(now - self.time_arrived[res.filepath])
+            self.num_delivered += len(results)
+            self.cond.notify_all()
+
+    def wait_delivered(self, count, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.num_delivered >= count,
+                                      timeout=timeout)
+
+
+def bench_engines(options, logger):
+    """Compare the threaded and asyncio ingest engines: latency from a
+    file being moved into a watched directory until its result is
+    delivered, and CPU used by the engine while nothing happens.
+    """
+    if not engine.have_inotify:
+        logger.error("'inotify' package needs to be installed")
+        return
+
+    num_files, interval, idle_sec = 50, 0.02, 3.0
+    settle_sec = 0.05
+    print("ingest engines: {} files every {:.0f} ms, settle {:.0f} ms, "
+          "{} workers".format(num_files, interval * 1000, settle_sec * 1000,
+                              options.threads))
+    print("{:>8s} {:>8s} {:>8s} {:>8s} {:>8s} {:>12s}".format(
+        'engine', 'p50 ms', 'p95 ms', 'max ms', 'batch', 'idle cpu %'))
+
+    data = make_synthetic_frame((64, 64), np.float32)
+    variants = [('threads', engine.ThreadedIngestEngine, dict()),
+                ('asyncio', engine.AsyncIngestEngine, dict(batch_sec=0.05)),
+                # without batching of results
+                ('asyncio0', engine.AsyncIngestEngine, dict(batch_sec=0.0))]
+    for name, klass, kwargs in variants:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watch_dir = os.path.join(tmpdir, 'data')
+            os.mkdir(watch_dir)
+
+            queue = ingest.IngestQueue()
+            gate = ingest.SequenceGate(logger=logger)
+            coalescer = ingest.EventCoalescer(window=settle_sec)
+            client = EngineBenchClient(queue, gate)
+            eng = klass(client, queue, coalescer, gate, logger,
+                        num_workers=options.threads, **kwargs)
+            eng.add_watch(watch_dir)
+            eng.start()
+            try:
+                time.sleep(0.5)
+                cpu_start = time.process_time()
+                time.sleep(idle_sec)
+                idle_cpu = (time.process_time() - cpu_start) / idle_sec
+
+                for i in range(num_files):
+                    # write elsewhere and move in, as the archiver does
+                    tmppath = os.path.join(tmpdir, 'frame.tmp')
+                    fits.PrimaryHDU(data).writeto(tmppath, overwrite=True)
+                    filepath = os.path.join(watch_dir,
+                                            'BNCA{:08d}.fits'.format(i))
+                    client.time_arrived[filepath] = time.time()
+                    os.rename(tmppath, filepath)
+                    time.sleep(interval)
+
+                if not client.wait_delivered(num_files, 10.0):
+                    logger.error("{}: only {} of {} files delivered".format(
+                        name, client.num_delivered, num_files))
+
+            finally:
+                eng.stop()
+
+            res = client.latency.get_stats()
+            stats = eng.get_stats()
+            print("{:>8s} {:8.1f} {:8.1f} {:8.1f} {:8.2f} {:12.2f}".format(
+                name, res.get('p50_sec', 0) * 1000,
+                res.get('p95_sec', 0) * 1000, res['max_sec'] * 1000,
+                stats['mean_batch'], idle_cpu * 100))
+
+
+def bench_rpc(options, logger):
+    """Compare the XML-RPC payload size and round trip time (encode,
+    marshal, unmarshal, decode) of results with numpy arrays sent as
+    lists, as before, and with the binary encoding in rpcdata.
+    """
+    print("rpc results: best of {}".format(options.repeat))
+    print("{:>12s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+        'array', 'dtype', 'list KB', 'list ms', 'binary KB', 'binary ms'))
+
+    def old_cleanse(d):
+        # scalars only, as ANA._rpc_cleanse did; arrays as lists
+        res = {}
+        for key, val in d.items():
+            if isinstance(val, np.ndarray):
+                val = val.tolist()
+            elif isinstance(val, np.integer):
+                val = int(val)
+            elif isinstance(val, np.floating):
+                val = float(val)
+            res[key] = val
+        return res
+
+    def round_trip(cleanse_fn, decode_fn, result):
+        payload = xmlrpc.client.dumps((cleanse_fn(result),),
+                                      methodresponse=True)
+        (res,), _ = xmlrpc.client.loads(payload)
+        return len(payload), decode_fn(res)
+
+    for shape, dtype in [((256,), np.int64), ((64, 64), np.float32),
+                         ((512, 512), np.float32), ((1024, 1024), np.uint16)]:
+        data = make_synthetic_frame(shape if len(shape) == 2 else (1,) + shape,
+                                    dtype).reshape(shape)
+        result = dict(result='ok', mean=np.float64(data.mean()),
+                      npix=np.int64(data.size), data=data)
+
+        old_size, old_res = round_trip(old_cleanse, lambda d: d, result)
+        new_size, new_res = round_trip(rpcdata.cleanse, rpcdata.decode, result)
+        if not np.array_equal(new_res['data'], data):
+            logger.error("binary result differs for {} {}".format(
+                shape, dtype.__name__))
+
+        t_old = best_of(lambda: round_trip(old_cleanse, lambda d: d, result),
+                        options.repeat)
+        t_new = best_of(lambda: round_trip(rpcdata.cleanse, rpcdata.decode,
+                                           result), options.repeat)
+
+        print("{:>12s} {:>8s} {:10.1f} {:10.1f} {:10.1f} {:10.1f}".format(
+            'x'.join([str(n) for n in shape]), dtype.__name__,
+            old_size / 1024, t_old * 1000, new_size / 1024, t_new * 1000))
+
+
+benchmarks = dict(tiles=bench_tiles, routing=bench_routing,
+                  engines=bench_engines, rpc=bench_rpc)
+
+
+def main(options, args):
+
+    logger = ssdlog.make_logger('ana_bench', options)
+
+    names = args
+    if len(names) == 0:
+        names = list(benchmarks.keys())
+
+    for name in names:
+        if name not in benchmarks:
+            logger.error("No such benchmark: '{}' (choose from {})".format(
+                name, ', '.join(benchmarks.keys())))
+            continue
+        benchmarks[name](options, logger)
+        print("")
+
+# END
@@ -0,0 +1,213 @@
+#
+# cache.py -- disk cache of decoded images for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+A local disk cache of decoded images, so that going back to a frame
+whose file is compressed does not mean decompressing it again.
+
+Each entry is stored as two files in the cache directory: the pixels as
+an uncompressed ``.npy`` file, which is memory mapped when read back,
+and the FITS header plus HDU index as a small ``.json`` file.  Entries
+are keyed by frame id and the modification time of the original file,
+so a rewritten file is never served from a stale entry.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+
+from ginga.misc import Bunch
+
+# temporary files older than this (sec) are left over from a writer that
+# died, and are removed by scan()
+stale_tmp_sec = 3600
+
+
+class DecodeCache:
+    """Disk cache of decoded images with a byte budget and least
+    recently used eviction.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to keep the cache in; created if necessary.  Entries
+        left there by an earlier session are reused.
+    max_bytes : int
+        Total size of the cached pixel files to keep.
+    """
+
+    def __init__(self, cache_dir, max_bytes, logger=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        # key -> Bunch, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_stored = 0
+        self.num_evicted = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.scan()
+
+    def _paths(self, key):
+        path = os.path.join(self.cache_dir, key)
+        return (path + '.npy', path + '.json')
+
+    def _make_tmp(self, key, tmp_paths):
+        fd, path = tempfile.mkstemp(prefix=key + '.', suffix='.tmp',
+                                    dir=self.cache_dir)
+        tmp_paths.append(path)
+        # mkstemp creates the file readable by the owner only
+        os.fchmod(fd, 0o644)
+        os.close(fd)
+        return path
+
+    def scan(self):
+        """Adopt the entries already in the cache directory, oldest
+        (by last access) first.
+        """
+        found = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    # another session may still be writing it
+                    if time.time() - entry.stat().st_mtime > stale_tmp_sec:
+                        os.remove(entry.path)
+                    continue
+                if not entry.name.endswith('.npy'):
+                    continue
+                key = entry.name[:-4]
+                npy_path, json_path = self._paths(key)
+                if not os.path.exists(json_path):
+                    # incomplete entry
+                    os.remove(npy_path)
+                    continue
+                st = entry.stat()
+                found.append((st.st_atime, key, st.st_size))
+
+        with self.lock:
+            for atime, key, nbytes in sorted(found):
+                self.entries[key] = Bunch.Bunch(key=key, nbytes=nbytes)
+                self.total_bytes += nbytes
+            self._evict()
+
+    def get_key(self, frameid, filepath):
+        return '{}-{}'.format(frameid, os.stat(filepath).st_mtime_ns)
+
+    def contains(self, frameid, filepath):
+        """Returns True if the decoded image of `frameid` is cached."""
+        key = self.get_key(frameid, filepath)
+        with self.lock:
+            return key in self.entries
+
+    def get(self, frameid, filepath):
+        """Look up the decoded image of `frameid`, whose original file is
+        `filepath`.  Returns a tuple of (data, header, idx), where data
+        is a read-only memory map and header an `astropy.io.fits.Header`,
+        or None if it is not cached.
+        """
+        key = self.get_key(frameid, filepath)
+        with self.lock:
+            if key not in self.entries:
+                self.num_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+
+        npy_path, json_path = self._paths(key)
+        try:
+            with open(json_path, 'r') as in_f:
+                d = json.load(in_f)
+            data = np.load(npy_path, mmap_mode='r')
+
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.warning("Error reading cache entry '{}': {}".format(
+                    key, e))
+            self.remove(key)
+            return None
+
+        header = fits.Header.fromstring(d['header'])
+        return (data, header, d['idx'])
+
+    def put(self, frameid, filepath, data, header, idx):
+        """Store the decoded image `data` (with `astropy.io.fits.Header`
+        `header` from HDU `idx`) of `frameid`, whose original file is
+        `filepath`.
+        """
+        key = self.get_key(frameid, filepath)
+        npy_path, json_path = self._paths(key)
+
+        # write under unique temporary names, so that a partly written
+        # entry is never picked up and two writers of the same entry
+        # (e.g. a prefetch and a display, or two sessions sharing the
+        # cache) do not write into the same file
+        tmp_paths = []
+        try:
+            tmp_npy = self._make_tmp(key, tmp_paths)
+            with open(tmp_npy, 'wb') as out_f:
+                np.save(out_f, np.ascontiguousarray(data))
+            tmp_json = self._make_tmp(key, tmp_paths)
+            with open(tmp_json, 'w') as out_f:
+                json.dump(dict(frameid=frameid, idx=idx,
+                               header=header.tostring()), out_f)
+            os.replace(tmp_json, json_path)
+            os.replace(tmp_npy, npy_path)
+
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.warning("Error writing cache entry '{}': {}".format(
+                    key, e))
+            for path in tmp_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        nbytes = os.path.getsize(npy_path)
+        with self.lock:
+            bnch = self.entries.pop(key, None)
+            if bnch is not None:
+                self.total_bytes -= bnch.nbytes
+            self.entries[key] = Bunch.Bunch(key=key, nbytes=nbytes)
+            self.total_bytes += nbytes
+            self.num_stored += 1
+            self._evict()
+
+    def remove(self, key):
+        with self.lock:
+            bnch = self.entries.pop(key, None)
+            if bnch is not None:
+                self.total_bytes -= bnch.nbytes
+        for path in self._paths(key):
+            # NOTE: any memory maps of the file remain valid
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            key = next(iter(self.entries))
+            self.remove(key)
+            self.num_evicted += 1
+
+    def get_stats(self):
+        with self.lock:
+            # NOTE: sizes in MB, as floats, since byte counts can be too
+            # large for XML-RPC integers
+            return dict(entries=len(self.entries),
+                        mbytes=self.total_bytes / 1024**2,
+                        max_mbytes=self.max_bytes / 1024**2,
+                        hits=self.num_hits, misses=self.num_misses,
+                        stored=self.num_stored, evicted=self.num_evicted)
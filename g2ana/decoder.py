@@ -0,0 +1,360 @@
+#
+# decoder.py -- decode arriving frames for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Decode the frames that arrive in a data directory and work out where
+they are shown, without any GUI.
+
+A `FrameDecoder` holds what ANA (and the 'ana_loadtest' script) need
+between the ingest queue and the display:
+
+- the order key and ticket of a queued frame (see `ingest.SequenceGate`),
+  and whether it has been superseded by a newer one ("latest wins")
+- the choice of loader: pixels from an ingest daemon event, the decode
+  cache, a memory map, tile-parallel decompression (into a buffer
+  reserved with `reserve_buffer`, if any) or the regular ginga loader
+- header-only decoding of frames that are not displayed
+- binned previews of large uncompressed frames
+- the route (channel and workspace) of each frame
+
+What is done with a route or a preview is up to the caller, via the
+`route_cb` and `preview_cb` callbacks.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ginga.misc import Bunch
+from ginga.util import loader
+
+from g2base.astro.frame import Frame
+
+from g2ana import fitsutil
+
+
+class FrameDecoder:
+    """Decode queued frames and route them to channels.
+
+    Parameters
+    ----------
+    routes : `routing.RoutingTable`
+        Maps frames to channels and workspaces.
+    gate : `ingest.SequenceGate`
+        Issues the tickets that keep frames for a channel in order.
+    logger : logger
+        For logging.
+    latest_wins : bool
+        Only read the header of frames superseded by a newer one for the
+        same channel.
+    header_only_inscodes : sequence of str
+        Instruments whose frames are never displayed, only their headers
+        read.
+    use_mmap : bool
+        Memory map uncompressed files.
+    tile_threads : int
+        Decompress .fits.fz files with this many threads (0 or 1: use the
+        regular loader).
+    decode_cache : `cache.DecodeCache` or None
+        Disk cache of decoded compressed files.
+    progressive : bool
+        Make a binned preview of large uncompressed frames before loading
+        them.
+    preview_factor, preview_method, preview_min_bytes
+        How the preview is made (see `fitsutil.make_preview`), and the
+        smallest file to make one for.
+    max_reserved_buffers : int
+        Most decode buffers to hold for expected frames.
+    route_cb : callable or None
+        Called as ``route_cb(route)`` for the route of each image or
+        preview before it is returned (e.g. to create the channel); not
+        for header-only results.
+    preview_cb : callable or None
+        Called as ``preview_cb(info, bnch)`` with a preview, where `bnch`
+        describes the queued file or is None.
+    """
+
+    def __init__(self, routes, gate, logger, latest_wins=False,
+                 header_only_inscodes=(), use_mmap=False, tile_threads=0,
+                 decode_cache=None, progressive=False, preview_factor=4,
+                 preview_method='stride', preview_min_bytes=0,
+                 max_reserved_buffers=4, route_cb=None, preview_cb=None):
+        self.routes = routes
+        self.gate = gate
+        self.logger = logger
+        self.latest_wins = latest_wins
+        self.header_only_inscodes = set(header_only_inscodes)
+        self.use_mmap = use_mmap
+        self.tile_threads = tile_threads
+        self.decode_cache = decode_cache
+        self.progressive = progressive
+        self.preview_factor = preview_factor
+        self.preview_method = preview_method
+        self.preview_min_bytes = preview_min_bytes
+        self.max_reserved_buffers = max_reserved_buffers
+        self.route_cb = route_cb
+        self.preview_cb = preview_cb
+
+        self.lock = threading.RLock()
+        # order key -> last ticket issued, for "latest wins"
+        self.latest_ticket = {}
+        # (shape, dtype) of the last image decoded for each channel, and
+        # decode buffers reserved for frames we were told are coming
+        self.frame_shapes = {}
+        self.reserved_buffers = OrderedDict()
+
+        self.num_superseded = 0
+        self.num_header_only = 0
+        self.num_reserved_used = 0
+        self.num_mmap_fallback = 0
+
+    def get_order_key(self, frame, filepath, header=None):
+        """Determine the key used to keep images displayed in arrival
+        order.  This is the channel name where it can be determined from
+        the frame id alone, otherwise the instrument name.  In "latest
+        wins" mode the exact channel is needed, so the header is read
+        for instruments whose channel depends on it, unless it is given
+        as `header` (e.g. from an ingest daemon event).
+        """
+        if self.routes.needs_header(frame):
+            # channel depends on the FITS header
+            if not self.latest_wins:
+                return self.routes.get_insname(str(frame))
+            if header is None:
+                header = fitsutil.read_header(filepath)
+        return self.routes.lookup(frame, header).chname
+
+    def take_ticket(self, bnch):
+        """Set the `order_key` and `ticket` of the live frame described by
+        `bnch`, which is about to be queued.
+        """
+        try:
+            frame = Frame(path=bnch.filepath)
+            event = bnch.get('event', None)
+            key = self.get_order_key(frame, bnch.filepath,
+                                     header=None if event is None else event.header)
+
+        except Exception:
+            # not a Subaru frame; decode_file() will ignore it
+            key = None
+
+        with self.lock:
+            bnch.order_key = key
+            bnch.ticket = self.gate.ticket(key)
+            if key is not None:
+                self.latest_ticket[key] = bnch.ticket
+
+    def is_superseded(self, bnch):
+        """Returns True if we are in "latest wins" mode and a newer file
+        for the same channel than the one described by `bnch` has already
+        been queued.
+        """
+        if not self.latest_wins or bnch.get('ticket', None) is None:
+            return False
+        with self.lock:
+            return self.latest_ticket.get(bnch.order_key, -1) > bnch.ticket
+
+    def decode(self, bnch):
+        """Decode the queued file described by `bnch`.  Returns a Bunch as
+        for decode_file(), with the times of the stages of its ingest, or
+        None.
+        """
+        event = bnch.get('event', None)
+        if self.is_superseded(bnch):
+            # a newer frame for this channel is already queued; skip the
+            # pixels but still let the ObsLog know
+            with self.lock:
+                self.num_superseded += 1
+            info = self.decode_header(bnch.filepath, event=event)
+        else:
+            info = self.decode_file(bnch.filepath, event=event, bnch=bnch)
+
+        if info is not None:
+            info.time_request = bnch.get('time_request', None)
+            if info.time_request is None:
+                # live arrival
+                info.time_event = bnch.time_event
+                info.time_dequeued = bnch.time_dequeued
+                info.time_decoded = time.time()
+        return info
+
+    def decode_file(self, filepath, event=None, bnch=None):
+        """Load the file at `filepath` and determine where it should be
+        displayed.  Returns a Bunch with the image and channel/workspace
+        names, or None if the file is not to be displayed.
+
+        If `event` is given it is a frame-arrival event from the ingest
+        daemon, and the pixels it carries are used instead of reading
+        the file.  `bnch`, if given, describes the file in the ingest
+        queue and is passed on with a preview.
+        """
+        try:
+            frame = Frame(path=filepath)
+        except ValueError:
+            return None
+
+        if frame.inscode in self.header_only_inscodes:
+            # Don't display raw HSC, SPCAM, but read the header so that
+            # they can still be logged
+            return self.decode_header(filepath, event=event)
+
+        self.logger.info("loading file {}".format(filepath))
+
+        frameid = str(frame)
+        if (self.progressive and event is None and
+            filepath.endswith('.fits') and
+            os.path.getsize(filepath) >= self.preview_min_bytes):
+            self.make_preview(frame, filepath, bnch=bnch)
+
+        image = None
+        if event is not None and event.data is not None:
+            # already decoded by the ingest daemon
+            image = fitsutil.make_image(event.data, event.header, filepath,
+                                        event.idx, logger=self.logger)
+        elif self.decode_cache is not None and not filepath.endswith('.fits'):
+            image = self.load_cached(frameid, filepath)
+        elif self.use_mmap and filepath.endswith('.fits'):
+            image = fitsutil.load_image_mmap(filepath, logger=self.logger)
+            if image is None:
+                # e.g. scaled floating point data
+                with self.lock:
+                    self.num_mmap_fallback += 1
+                self.logger.info("cannot memory map {}; using the regular "
+                                 "loader".format(filepath))
+        elif self.tile_threads > 1 and filepath.endswith('.fits.fz'):
+            # use the buffer reserved by reserve_buffer(), if any
+            with self.lock:
+                out = self.reserved_buffers.pop(frameid, None)
+                if out is not None:
+                    self.num_reserved_used += 1
+            image = fitsutil.load_image_tiled(filepath, self.tile_threads,
+                                              logger=self.logger, out=out)
+        if image is None:
+            image = loader.load_file(filepath, logger=self.logger)
+        image.set(name=frameid)
+
+        header = image.get_header()
+        route = self.get_route(frame, header)
+        data = image.get_data()
+        self.frame_shapes[route.chname] = (data.shape, data.dtype)
+
+        return Bunch.Bunch(frameid=frameid, image=image, header=header,
+                           insname=route.insname, chname=route.chname,
+                           wsname=route.wsname, filepath=filepath)
+
+    def decode_header(self, filepath, event=None):
+        """Like decode_file(), but only reads the FITS header.  The
+        returned Bunch has `image` set to None.
+        """
+        try:
+            frame = Frame(path=filepath)
+        except ValueError:
+            return None
+
+        self.logger.info("reading header of {}".format(filepath))
+        with self.lock:
+            self.num_header_only += 1
+
+        frameid = str(frame)
+        if event is not None:
+            header = fitsutil.make_astro_header(event.header)
+        else:
+            header = fitsutil.make_astro_header(fitsutil.read_header(filepath))
+
+        # NOTE: nothing is displayed, so no route_cb
+        route = self.routes.lookup(frame, header)
+
+        return Bunch.Bunch(frameid=frameid, image=None, header=header,
+                           insname=route.insname, chname=route.chname,
+                           wsname=route.wsname, filepath=filepath)
+
+    def load_cached(self, frameid, filepath):
+        """Load the compressed file at `filepath` via the decode cache,
+        decoding and adding it to the cache if it is not there yet.
+        Returns an AstroImage, or None if the file has no image data.
+        """
+        res = self.decode_cache.get(frameid, filepath)
+        if res is None:
+            res = fitsutil.read_image(filepath, tile_threads=self.tile_threads)
+            if res is None:
+                return None
+            self.decode_cache.put(frameid, filepath, *res)
+
+        data, header, idx = res
+        return fitsutil.make_image(data, header, filepath, idx,
+                                   logger=self.logger)
+
+    def make_preview(self, frame, filepath, bnch=None):
+        """Make a binned preview of the file at `filepath` and hand it to
+        `preview_cb`.  `bnch`, if given, describes the file in the ingest
+        queue.
+        """
+        if self.preview_cb is None:
+            return
+        time_start = time.time()
+        try:
+            image = fitsutil.make_preview(filepath, self.preview_factor,
+                                          method=self.preview_method,
+                                          logger=self.logger)
+
+        except Exception as e:
+            self.logger.warning("Error making preview of '{}': {}".format(
+                filepath, e))
+            return
+
+        if image is None:
+            return
+        frameid = str(frame)
+        image.set(name=frameid)
+        header = image.get_header()
+        route = self.get_route(frame, header)
+        self.logger.info("preview of {} made in {:.3f} sec".format(
+            frameid, time.time() - time_start))
+
+        info = Bunch.Bunch(frameid=frameid, image=image, header=header,
+                           insname=route.insname, chname=route.chname,
+                           wsname=route.wsname, filepath=filepath)
+        self.preview_cb(info, bnch)
+
+    def get_route(self, frame, header):
+        route = self.routes.lookup(frame, header)
+        if self.route_cb is not None:
+            self.route_cb(route)
+        return route
+
+    def reserve_buffer(self, frameid, chname):
+        """Reserve a decode buffer for the expected frame `frameid`, the
+        size of the last image decoded for channel `chname`, if the frame
+        will be decompressed with tile-parallel decompression.  Returns
+        True if a buffer was reserved.
+        """
+        if self.tile_threads <= 1 or self.max_reserved_buffers <= 0:
+            return False
+        with self.lock:
+            if frameid in self.reserved_buffers:
+                return False
+            shape = self.frame_shapes.get(chname, None)
+        if shape is None:
+            return False
+
+        out = np.empty(*shape)
+        # touch the pages now rather than while decoding
+        out.fill(0)
+        with self.lock:
+            self.reserved_buffers[frameid] = out
+            while len(self.reserved_buffers) > self.max_reserved_buffers:
+                self.reserved_buffers.popitem(last=False)
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return dict(header_only=self.num_header_only,
+                        superseded=self.num_superseded,
+                        reserved=len(self.reserved_buffers),
+                        reserved_used=self.num_reserved_used,
+                        mmap_fallback=self.num_mmap_fallback)
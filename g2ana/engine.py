@@ -0,0 +1,464 @@
+#
+# engine.py -- ingest engines for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Ingest engines watch data directories for arriving files, feed them to
+an `ingest.IngestQueue` and run the decoding of queued files, handing
+the results back in arrival order (per `ingest.SequenceGate` key).
+
+Two engines with the same interface are provided:
+
+- `ThreadedIngestEngine`: a thread blocking on an inotify generator plus
+  a thread per decode worker blocking on the queue
+- `AsyncIngestEngine`: an asyncio event loop in a single thread that
+  reads the inotify file descriptor when it is readable, uses timers to
+  release settled files, runs decoding in an executor and hands results
+  over in batches
+
+What to do with files is up to a "client" object (e.g. the ANA plugin),
+which must provide these methods:
+
+- ``index_dir(path)``: a watch was placed on `path`; files already there
+  can be scanned now without missing any new ones
+- ``file_added(filepath)``, ``file_removed(filepath)``: called on each
+  raw arrival/removal event, before coalescing
+- ``enqueue_file(bnch)``: put a settled file on the queue; may block
+- ``process_file(bnch, idx)``: decode a queued file in worker `idx`;
+  returns a result or None
+- ``deliver(results)``: accept a list of results, in order; must be safe
+  to call from any thread and should not block
+
+While processing a file, the client can hand over an early result for
+it (e.g. a preview) with the engine's `deliver_early`; it is delivered
+in order with the other results, or not at all if the file's own result
+comes first.
+"""
+import os
+import time
+import struct
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+have_inotify = False
+try:
+    import inotify.adapters
+    import inotify.calls
+    import inotify.constants
+    have_inotify = True
+except ImportError:
+    pass
+
+# inotify event header: wd, mask, cookie, len
+_event_hdr = struct.Struct('iIII')
+
+
+class IngestEngineError(Exception):
+    pass
+
+
+class IngestEngine:
+    """Base class for ingest engines.
+
+    Parameters
+    ----------
+    client : object
+        Object that handles files (see the module docstring).
+    queue : `ingest.IngestQueue`
+        Queue of files waiting to be decoded.
+    coalescer : `ingest.EventCoalescer`
+        Merges repeated events for the same file.
+    gate : `ingest.SequenceGate`
+        Keeps results in order; queued Bunches carry `order_key` and
+        `ticket` attributes.
+    logger : logger
+        For logging.
+    num_workers : int
+        Number of files decoded in parallel.
+    """
+
+    def __init__(self, client, queue, coalescer, gate, logger,
+                 num_workers=1):
+        self.client = client
+        self.queue = queue
+        self.coalescer = coalescer
+        self.gate = gate
+        self.logger = logger
+        self.num_workers = max(1, num_workers)
+
+        self.watch_dirs = []
+        self.lock = threading.RLock()
+        self.num_delivered = 0
+        self.num_batches = 0
+
+    def add_watch(self, path):
+        """Watch directory `path` for arriving files.  Must be called
+        before `start`.
+        """
+        if not have_inotify:
+            raise IngestEngineError("'inotify' package needs to be installed "
+                                    "to monitor for files to be loaded")
+        self.watch_dirs.append(path)
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def enqueue_file(self, bnch):
+        try:
+            self.client.enqueue_file(bnch)
+
+        except Exception as e:
+            self.logger.error("Error queueing '{}': {}".format(
+                bnch.filepath, e), exc_info=True)
+
+    def process_file(self, bnch, idx):
+        try:
+            return self.client.process_file(bnch, idx)
+
+        except Exception as e:
+            self.logger.error("Error processing '{}': {}".format(
+                bnch.filepath, e), exc_info=True)
+            return None
+
+    def deliver(self, results):
+        with self.lock:
+            self.num_batches += 1
+            self.num_delivered += len(results)
+        self.client.deliver(results)
+
+    def result_action(self, res):
+        """Returns an action for the gate that delivers `res`."""
+        raise NotImplementedError
+
+    def deliver_early(self, bnch, res):
+        """Deliver `res`, an early result for the queued file `bnch`,
+        after the results of the files queued before it for the same key.
+        It is dropped if the result for `bnch` itself is ready first.
+        This can be called from `process_file`.
+        """
+        self.gate.run_when_next(bnch.order_key, bnch.ticket,
+                                self.result_action(res))
+
+    def get_stats(self):
+        with self.lock:
+            return dict(engine=str(self), delivered=self.num_delivered,
+                        batches=self.num_batches,
+                        mean_batch=(self.num_delivered /
+                                    max(1, self.num_batches)))
+
+
+class ThreadedIngestEngine(IngestEngine):
+    """Ingest engine using blocking threads.  Each result is delivered
+    by itself, as soon as it (and those before it) are ready.
+    """
+
+    def __init__(self, client, queue, coalescer, gate, logger,
+                 num_workers=1):
+        super().__init__(client, queue, coalescer, gate, logger,
+                         num_workers=num_workers)
+        self.ev_quit = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.ev_quit.clear()
+        if len(self.watch_dirs) > 0:
+            self.threads.append(threading.Thread(target=self.watch_loop,
+                                                 name='ana-watch',
+                                                 daemon=True))
+        for idx in range(self.num_workers):
+            self.threads.append(threading.Thread(target=self.worker_loop,
+                                                 args=(idx,),
+                                                 name=f'ana-decode-{idx}',
+                                                 daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.ev_quit.set()
+        # wake up the decode workers so they can terminate
+        self.queue.close()
+        for thread in self.threads:
+            thread.join(timeout=2.0)
+        self.threads = []
+
+    def watch_loop(self):
+        # wake up often enough to release files that have settled
+        # within the coalescing window
+        block_sec = min(1.0, max(0.05, self.coalescer.window / 2.0))
+        i = inotify.adapters.Inotify(block_duration_s=block_sec)
+        for path in self.watch_dirs:
+            i.add_watch(path)
+            # files that arrive from here on are picked up from the events
+            self.client.index_dir(path)
+
+        for event in i.event_gen(yield_nones=True):
+            if self.ev_quit.is_set():
+                break
+
+            if event is not None:
+                (header, type_names, watch_path, filename) = event
+                filepath = os.path.join(watch_path, filename)
+                if ('IN_MOVED_TO' in type_names or
+                    'IN_CLOSE_WRITE' in type_names):
+                    self.client.file_added(filepath)
+                    self.coalescer.add(filepath)
+
+                elif ('IN_MOVED_FROM' in type_names or
+                      'IN_DELETE' in type_names):
+                    self.client.file_removed(filepath)
+                    self.coalescer.discard(filepath)
+
+            # Bunches carry the file path plus event info, and we will
+            # probably want to add more info in the future
+            for bnch in self.coalescer.get_ready():
+                self.enqueue_file(bnch)
+
+        for path in self.watch_dirs:
+            i.remove_watch(path)
+
+    def worker_loop(self, idx):
+        self.logger.info("decode worker {} starting up...".format(idx))
+
+        while not self.ev_quit.is_set():
+            # blocks until there is work, or the queue is closed
+            bnch = self.queue.get()
+            if bnch is None:
+                break
+
+            res = self.process_file(bnch, idx)
+            action = None
+            if res is not None:
+                action = self.result_action(res)
+            self.gate.release(bnch.order_key, bnch.ticket, action)
+
+        self.logger.info("decode worker {} terminating...".format(idx))
+
+    def result_action(self, res):
+        # NOTE: action may be held until earlier results for this key
+        # are done, so bind `res` now
+        return lambda: self.deliver([res])
+
+    def __str__(self):
+        return 'threads'
+
+
+class AsyncIngestEngine(IngestEngine):
+    """Ingest engine built on an asyncio event loop running in its own
+    thread.  Nothing runs while there are no events: the inotify file
+    descriptor is read only when it is readable, settled files are
+    released by timers and decode slots are refilled when the queue
+    signals a new item.
+
+    Results are collected for up to `batch_sec` seconds after the first
+    one becomes ready and then delivered together.
+    """
+
+    def __init__(self, client, queue, coalescer, gate, logger,
+                 num_workers=1, batch_sec=0.05):
+        super().__init__(client, queue, coalescer, gate, logger,
+                         num_workers=num_workers)
+        self.batch_sec = batch_sec
+
+        self.thread = None
+        self.loop = None
+        self.ev_started = threading.Event()
+        self.stopping = False
+        self.wd_paths = {}
+        self.batch = []
+        self.flush_timer = None
+        self.settle_timer = None
+        self.tasks = set()
+
+    def start(self):
+        self.ev_started.clear()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='ana-ingest',
+                                       daemon=True)
+        self.thread.start()
+        self.ev_started.wait()
+
+    def stop(self):
+        # wake up any producers blocked on a full queue
+        self.queue.close()
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._stop)
+        if self.thread is not None:
+            self.thread.join(timeout=5.0)
+            self.thread = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.main())
+
+        except Exception as e:
+            self.logger.error("Error in ingest event loop: {}".format(e),
+                              exc_info=True)
+
+        finally:
+            self.ev_started.set()
+            self.loop.close()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.ev_wake = asyncio.Event()
+        self.queue.on_put = lambda: loop.call_soon_threadsafe(self.ev_wake.set)
+
+        # decode workers; a separate single thread puts files on the
+        # queue, because that may read headers or block on a full queue
+        self.decode_executor = ThreadPoolExecutor(
+            max_workers=self.num_workers, thread_name_prefix='ana-decode')
+        self.enqueue_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='ana-enqueue')
+
+        fd = None
+        if len(self.watch_dirs) > 0:
+            fd = self.open_inotify()
+            loop.add_reader(fd, self.read_events, fd)
+
+        self.logger.info("ingest event loop starting up...")
+        self.ev_started.set()
+        try:
+            await self.dispatch()
+
+        finally:
+            self.queue.on_put = None
+            if fd is not None:
+                loop.remove_reader(fd)
+                os.close(fd)
+            if len(self.tasks) > 0:
+                await asyncio.wait(list(self.tasks), timeout=5.0)
+            self.flush()
+            self.enqueue_executor.shutdown(wait=False)
+            self.decode_executor.shutdown(wait=False)
+            self.logger.info("ingest event loop terminating...")
+
+    def _stop(self):
+        self.stopping = True
+        self.ev_wake.set()
+
+    def open_inotify(self):
+        fd = inotify.calls.inotify_init()
+        os.set_blocking(fd, False)
+        mask = (inotify.constants.IN_CLOSE_WRITE |
+                inotify.constants.IN_MOVED_TO |
+                inotify.constants.IN_MOVED_FROM |
+                inotify.constants.IN_DELETE)
+        for path in self.watch_dirs:
+            wd = inotify.calls.inotify_add_watch(fd, path.encode('utf-8'),
+                                                 mask)
+            self.wd_paths[wd] = path
+            # files that arrive from here on are picked up from the events
+            self.client.index_dir(path)
+        return fd
+
+    def read_events(self, fd):
+        """Called by the event loop when the inotify fd is readable."""
+        try:
+            buf = os.read(fd, 65536)
+
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + _event_hdr.size <= len(buf):
+            wd, mask, cookie, length = _event_hdr.unpack_from(buf, offset)
+            offset += _event_hdr.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            path = self.wd_paths.get(wd, None)
+            if path is None or len(name) == 0:
+                continue
+            filepath = os.path.join(path, name.decode('utf-8', 'replace'))
+
+            if mask & (inotify.constants.IN_MOVED_TO |
+                       inotify.constants.IN_CLOSE_WRITE):
+                self.client.file_added(filepath)
+                self.coalescer.add(filepath)
+                self.schedule_settle()
+
+            elif mask & (inotify.constants.IN_MOVED_FROM |
+                         inotify.constants.IN_DELETE):
+                self.client.file_removed(filepath)
+                self.coalescer.discard(filepath)
+
+    def schedule_settle(self):
+        if self.settle_timer is not None:
+            return
+        time_due = self.coalescer.get_next_due()
+        if time_due is not None:
+            # NOTE: a little extra, so that the events have settled when
+            # the timer goes off
+            delay = max(0.0, time_due - time.time()) + 0.002
+            self.settle_timer = self.loop.call_later(delay,
+                                                     self.release_settled)
+
+    def release_settled(self):
+        self.settle_timer = None
+        for bnch in self.coalescer.get_ready():
+            self.enqueue_executor.submit(self.enqueue_file, bnch)
+        self.schedule_settle()
+
+    async def dispatch(self):
+        """Start decoding queued files whenever a worker is free."""
+        free = list(range(self.num_workers))
+        while not self.stopping:
+            while len(free) > 0:
+                bnch = self.queue.get_nowait()
+                if bnch is None:
+                    break
+                task = asyncio.create_task(self.process(bnch, free.pop()))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                task.add_done_callback(lambda task: self.free_worker(free,
+                                                                     task))
+
+            await self.ev_wake.wait()
+            self.ev_wake.clear()
+
+    async def process(self, bnch, idx):
+        loop = asyncio.get_running_loop()
+        res = await loop.run_in_executor(self.decode_executor,
+                                         self.process_file, bnch, idx)
+        action = None
+        if res is not None:
+            action = self.result_action(res)
+        self.gate.release(bnch.order_key, bnch.ticket, action)
+        return idx
+
+    def result_action(self, res):
+        # NOTE: held actions may be run from another thread (e.g. when a
+        # queued file is dropped), so go through the loop
+        return lambda: self.loop.call_soon_threadsafe(self.add_result, res)
+
+    def free_worker(self, free, task):
+        # the task returns the number of the worker it ran on
+        free.append(task.result())
+        self.ev_wake.set()
+
+    def add_result(self, res):
+        self.batch.append(res)
+        if self.flush_timer is None:
+            self.flush_timer = self.loop.call_later(self.batch_sec,
+                                                    self.flush)
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        batch, self.batch = self.batch, []
+        if len(batch) > 0:
+            self.deliver(batch)
+
+    def __str__(self):
+        return 'asyncio'
+
+
+engines = dict(threads=ThreadedIngestEngine, asyncio=AsyncIngestEngine)
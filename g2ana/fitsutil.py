@@ -0,0 +1,323 @@
+#
+# fitsutil.py -- FITS reading helpers for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+FITS reading helpers used by the ANA plugin that go around the generic
+ginga loader when only part of a file is needed.
+"""
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from ginga.AstroImage import AstroImage, AstroHeader
+
+
+def read_header(filepath):
+    """Read the header describing the image in `filepath`, without
+    reading any pixel data.
+
+    For plain and gzipped files only the blocks of the primary header
+    are read (a few kB), regardless of the size of the data.  For
+    tile-compressed (``.fz``) files the primary HDU is normally empty
+    and the image, together with its full header, lives in the first
+    extension; in that case the header of that extension is returned.
+
+    Returns an `astropy.io.fits.Header`.
+    """
+    if not filepath.endswith('.fz'):
+        opener = gzip.open if filepath.endswith('.gz') else open
+        with opener(filepath, 'rb') as in_f:
+            return fits.Header.fromfile(in_f)
+
+    with fits.open(filepath, memmap=False, lazy_load_hdus=True) as fits_f:
+        header = fits_f[0].header
+        if header.get('NAXIS', 0) == 0:
+            try:
+                header = fits_f[1].header
+            except IndexError:
+                pass
+        return header.copy()
+
+
+def make_astro_header(header, ahdr=None):
+    """Convert an `astropy.io.fits.Header` to a ginga `AstroHeader`.
+    If `ahdr` is given, the cards are copied into it instead.
+    """
+    if ahdr is None:
+        ahdr = AstroHeader()
+    for card in header.cards:
+        if len(card.keyword) == 0:
+            continue
+        ahdr.set_card(card.keyword, card.value, comment=card.comment)
+    return ahdr
+
+
+def get_uint_offset(header, dtype):
+    """Returns the sign bit to flip to turn raw signed integers of
+    `dtype` into the unsigned values they store, if `header` scales them
+    the way FITS stores unsigned integers (BSCALE=1, BZERO=2**(bits-1)),
+    otherwise None.
+    """
+    if dtype.kind != 'i' or 'BLANK' in header:
+        return None
+    bits = 8 * dtype.itemsize
+    if header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 2**(bits - 1):
+        return None
+    return 1 << (bits - 1)
+
+
+def load_image_mmap(filepath, logger=None, band_bytes=16 * 1024 * 1024):
+    """Load the first image HDU in the uncompressed FITS file `filepath`
+    as an AstroImage whose data is a memory map of the file.
+
+    Pixels are only paged in from disk as they are accessed, so nothing
+    but the headers is read up front.
+
+    Unsigned integer images (e.g. raw uint16 frames, stored as int16
+    with BZERO=32768) cannot be used as a map, as every value has to be
+    shifted.  For those the raw array is mapped and shifted into an
+    unsigned array in bands of about `band_bytes`, which is cheaper than
+    the regular loader and never holds more than a band of temporaries.
+
+    Returns None if the image cannot be loaded this way (e.g. it has any
+    other BSCALE/BZERO scaling); the caller should then use the regular
+    loader.
+    """
+    fits_f = fits.open(filepath, memmap=True, lazy_load_hdus=True,
+                       do_not_scale_image_data=True)
+    try:
+        for idx, hdu in enumerate(fits_f):
+            if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and
+                hdu.header.get('NAXIS', 0) >= 2):
+                break
+        else:
+            return None
+
+        header = hdu.header
+        if header.get('BSCALE', 1) == 1 and header.get('BZERO', 0) == 0:
+            image = AstroImage(logger=logger)
+            image.load_hdu(hdu, fobj=fits_f)
+            image.set(path=filepath, idx=idx)
+            return image
+
+        raw = hdu.data
+        sign_bit = get_uint_offset(header, raw.dtype)
+        if sign_bit is None:
+            return None
+
+        # the unsigned values are the raw bits with the sign bit flipped
+        udtype = raw.dtype.newbyteorder('=').str.replace('i', 'u')
+        data = np.empty(raw.shape, dtype=udtype)
+        raw_u = raw.view(raw.dtype.str.replace('i', 'u'))
+        sign_bit = np.array(sign_bit, dtype=udtype)
+        row_bytes = max(1, raw[0].nbytes)
+        band_ht = max(1, band_bytes // row_bytes)
+        for y1 in range(0, raw.shape[0], band_ht):
+            y2 = y1 + band_ht
+            np.bitwise_xor(raw_u[y1:y2], sign_bit, out=data[y1:y2])
+
+        header = header.copy()
+        for kwd in ('BSCALE', 'BZERO'):
+            header.remove(kwd, ignore_missing=True)
+        return make_image(data, header, filepath, idx, logger=logger)
+
+    finally:
+        # NOTE: the data stays mapped after the file is closed
+        fits_f.close()
+
+
+def _decompress_rows(filepath, out, y1, y2):
+    # each thread uses its own file handle.
+    # NOTE: memmap=False, as astropy refuses to open scaled images (e.g.
+    # uint16 stored with BZERO=32768) memory mapped; only the compressed
+    # tiles of the band are read, so there is nothing to gain from it
+    with fits.open(filepath, memmap=False, lazy_load_hdus=True) as fits_f:
+        out[y1:y2] = fits_f[1].section[y1:y2]
+
+
+def read_tiled_data(filepath, num_threads, out=None):
+    """Decompress the tile-compressed 2D image in the first extension of
+    `filepath`, spreading bands of tiles across `num_threads` threads.
+
+    astropy's tile codecs release the GIL, so the bands are decompressed
+    in parallel.  Each band is written directly into a single output
+    array; if `out` is given (and has the right shape and dtype) it is
+    used, otherwise one is allocated.
+
+    Returns a tuple of (data, header), where header is the
+    `astropy.io.fits.Header` of the image, or None if the file does not
+    contain a tile-compressed 2D image.
+    """
+    with fits.open(filepath, disable_image_compression=True,
+                   lazy_load_hdus=True) as fits_f:
+        if len(fits_f) < 2:
+            return None
+        tbl_hdr = fits_f[1].header
+        if not tbl_hdr.get('ZIMAGE', False) or tbl_hdr.get('ZNAXIS') != 2:
+            return None
+        ht = tbl_hdr['ZNAXIS2']
+        # rows per tile; bands are aligned on tile boundaries so that no
+        # tile is decompressed twice
+        tile_ht = max(1, tbl_hdr.get('ZTILE2', 1))
+
+    with fits.open(filepath, memmap=False, lazy_load_hdus=True) as fits_f:
+        hdu = fits_f[1]
+        header = hdu.header.copy()
+        shape = hdu.shape
+        # data type after any scaling/dequantization is applied
+        dtype = hdu.section[0:1].dtype
+
+    if out is None or out.shape != shape or out.dtype != dtype:
+        out = np.empty(shape, dtype=dtype)
+
+    num_tiles = (ht + tile_ht - 1) // tile_ht
+    num_threads = max(1, min(num_threads, num_tiles))
+    band_ht = ((num_tiles + num_threads - 1) // num_threads) * tile_ht
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(_decompress_rows, filepath, out,
+                                   y1, min(y1 + band_ht, ht))
+                   for y1 in range(0, ht, band_ht)]
+        for future in futures:
+            # raises any exception from the thread
+            future.result()
+
+    return (out, header)
+
+
+def load_image_tiled(filepath, num_threads, logger=None, out=None):
+    """Load a tile-compressed FITS file as an AstroImage using
+    `read_tiled_data`.  Returns None if the file cannot be handled this
+    way; the caller should then use the regular loader.
+    """
+    res = read_tiled_data(filepath, num_threads, out=out)
+    if res is None:
+        return None
+    data, header = res
+
+    return make_image(data, header, filepath, 1, logger=logger)
+
+
+def make_image(data, header, filepath, idx, logger=None):
+    """Make an AstroImage from an already decoded array `data` and its
+    `astropy.io.fits.Header`, as if it had been loaded from HDU `idx` of
+    `filepath`.
+    """
+    image = AstroImage(logger=logger)
+    image.load_data(data)
+    make_astro_header(header, ahdr=image.get_header())
+    image.wcs.load_header(header)
+    image.set(path=filepath, idx=idx)
+    return image
+
+
+def read_image(filepath, tile_threads=0):
+    """Read the pixel data and header of the first image HDU with data in
+    `filepath`, like the ginga loader does.  Tile-compressed files are
+    decompressed with `tile_threads` threads if that is more than one.
+
+    Returns a tuple of (data, header, idx), or None if the file has no
+    image data.
+    """
+    if tile_threads > 1 and filepath.endswith('.fz'):
+        res = read_tiled_data(filepath, tile_threads)
+        if res is not None:
+            data, header = res
+            return (data, header, 1)
+
+    with fits.open(filepath, memmap=False) as fits_f:
+        for idx, hdu in enumerate(fits_f):
+            if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU,
+                                 fits.CompImageHDU)) and
+                hdu.header.get('NAXIS', 0) >= 2):
+                return (np.asarray(hdu.data), hdu.header.copy(), idx)
+    return None
+
+
+def scale_wcs(header, factor, centered=False):
+    """Adjust the WCS keywords in `header` (in place) for an image that
+    has been binned by `factor` along both axes.  If `centered` is True
+    each new pixel is the mean of a `factor` x `factor` block, otherwise
+    it is the first pixel of the block (i.e. the image was strided).
+    """
+    # position of the center of new pixel 1 in old pixel coordinates
+    offset = 0.5 if centered else 1.0
+    for i in (1, 2):
+        kwd = f'CRPIX{i}'
+        if kwd in header:
+            header[kwd] = (header[kwd] - offset) / factor + offset
+        kwd = f'CDELT{i}'
+        if kwd in header:
+            header[kwd] = header[kwd] * factor
+        for j in (1, 2):
+            kwd = f'CD{i}_{j}'
+            if kwd in header:
+                header[kwd] = header[kwd] * factor
+
+
+def read_preview(filepath, factor, method='stride'):
+    """Make a reduced resolution version of the first image HDU in the
+    uncompressed FITS file `filepath`, from a memory map of the file.
+
+    With `method` 'stride' every `factor`-th pixel of every `factor`-th
+    row is taken, so only those rows are read from disk.  With 'mean'
+    each pixel is the mean of a `factor` x `factor` block.  The WCS in
+    the returned header is adjusted to match.
+
+    Returns a tuple of (data, header, idx), or None if the file has no
+    2D image.
+    """
+    with fits.open(filepath, memmap=True, do_not_scale_image_data=True,
+                   lazy_load_hdus=True) as fits_f:
+        for idx, hdu in enumerate(fits_f):
+            if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and
+                hdu.header.get('NAXIS', 0) == 2):
+                break
+        else:
+            return None
+
+        header = hdu.header.copy()
+        data = hdu.data
+        if method == 'mean':
+            ht, wd = data.shape[0] // factor, data.shape[1] // factor
+            out = np.empty((ht, wd), dtype=np.float32)
+            # a band of rows at a time, to bound the memory used
+            for y1 in range(0, ht, 64):
+                y2 = min(ht, y1 + 64)
+                band = np.asarray(data[y1 * factor:y2 * factor,
+                                       :wd * factor], dtype=np.float32)
+                out[y1:y2] = band.reshape(y2 - y1, factor,
+                                          wd, factor).mean(axis=(1, 3))
+        else:
+            out = np.array(data[::factor, ::factor])
+        del data
+
+    bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+    if bscale != 1 or bzero != 0:
+        out = out.astype(np.float32) * np.float32(bscale) + np.float32(bzero)
+        for kwd in ('BSCALE', 'BZERO', 'BLANK'):
+            header.remove(kwd, ignore_missing=True)
+
+    header['NAXIS1'], header['NAXIS2'] = out.shape[1], out.shape[0]
+    scale_wcs(header, factor, centered=(method == 'mean'))
+    return (out, header, idx)
+
+
+def make_preview(filepath, factor, method='stride', logger=None):
+    """Make a preview AstroImage using `read_preview`.  The image has its
+    `preview` attribute set to True.  Returns None if the file has no
+    2D image.
+    """
+    res = read_preview(filepath, factor, method=method)
+    if res is None:
+        return None
+    data, header, idx = res
+
+    image = make_image(data, header, filepath, idx, logger=logger)
+    image.set(preview=True, preview_factor=factor, nothumb=True)
+    return image
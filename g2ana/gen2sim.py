@@ -0,0 +1,406 @@
+#
+# gen2sim.py -- local Gen2 stand-in and command driver for the ANA service
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Load test of the ANA command path without a live Gen2.
+
+This provides the two Gen2 services that ANA talks to:
+
+- the remoteObjects name service, run from g2base as a subprocess (or
+  use an already running one with --no-names), and
+- a 'monitor' hub, which receives the g2task results that ANA publishes.
+
+and a driver that sends a command stream to the ANA service of a
+running anaview via `callGlobalPlugin2`, the way Gen2 does, and matches
+the published results to the commands.  It reports commands per
+second and, per method, the latency of:
+
+- 'rpc': the callGlobalPlugin2 call itself
+- 'dispatch': from sending a command until the GUI thread runs it
+- 'run': from the GUI thread running it until it completed
+- 'publish': from completion until the result arrived at the hub
+- 'total': from sending a command until its result arrived
+
+All times are taken on the same host, so the clocks agree.
+
+Start anaview against the stand-in, e.g. headless with Qt:
+
+$ QT_QPA_PLATFORM=offscreen GEN2HOST=localhost anaview --propid=o99999 ...
+
+Then run the stand-in and driver:
+
+# 1000 zero-length sleeps, 50 per second
+$ ana_gen2sim --stderr --propid=o99999 --count=1000 --rate=50
+
+# a mix with dialogs for two instruments, cancelled after 0.5 sec
+$ ana_gen2sim --stderr --propid=o99999 --mix=sleep:8,confirmation:1,userinput:1 \
+    --instruments=IRCS,FOCAS --cancel-after=0.5
+
+# replay a recorded command stream
+$ ana_gen2sim --stderr --propid=o99999 --replay=commands.jsonl
+
+A command stream file has one JSON object per line, with the keys
+'time' (seconds from the start), 'method', and optionally 'args',
+'kwdargs' and 'cancel_after' (seconds after which to cancel it).
+"""
+import json
+import time
+import random
+import threading
+import subprocess
+
+from ginga.misc import Bunch
+
+from g2base import ssdlog
+from g2base.remoteObjects import remoteObjects as ro
+from g2base.remoteObjects import Monitor
+
+from g2ana.ingest import LatencyStats
+
+# latencies reported per method, in order
+stages = ('rpc', 'dispatch', 'run', 'publish', 'total')
+# methods of synthetic commands, and those that show a dialog
+synthetic_methods = ('sleep', 'confirmation', 'userinput')
+dialog_methods = ('confirmation', 'userinput')
+
+
+class MonitorHub:
+    """Stand-in for the Gen2 'monitor' service.  Calls `result_cb` as
+    ``result_cb(tag, vals, time_received)`` for each g2task update.
+    """
+
+    def __init__(self, logger, ev_quit, port, result_cb, name='monitor'):
+        self.logger = logger
+        self.port = port
+        self.result_cb = result_cb
+        self.monitor = Monitor.Monitor(name, logger, ev_quit=ev_quit)
+
+    def start(self):
+        self.monitor.start(wait=True)
+        # serving makes the hub known to the name service, so that ANA
+        # can publish to it
+        self.monitor.start_server(wait=True, port=self.port)
+        self.monitor.subscribe_cb(self.arr_g2task, ['g2task'])
+
+    def stop(self):
+        self.monitor.stop_server(wait=True)
+        self.monitor.stop(wait=True)
+
+    def arr_g2task(self, payload, name, channels):
+        time_received = time.time()
+        try:
+            bnch = Monitor.unpack_payload(payload)
+            self.result_cb(bnch.path, bnch.value, time_received)
+
+        except Exception as e:
+            self.logger.error("Error handling g2task update: {}".format(e),
+                              exc_info=True)
+
+
+def start_name_service(cmd, logger):
+    """Start the remoteObjects name service with command line `cmd`.
+    Returns the subprocess.
+    """
+    logger.info("starting name service: {}".format(cmd))
+    return subprocess.Popen(cmd, shell=True)
+
+
+def make_synthetic_stream(mix, count, rate, sleep_time=0.0,
+                          instruments=(), cancel_after=None, seed=0):
+    """Returns a list of `count` commands (Bunches with time, method,
+    args, kwdargs and cancel_after), `rate` per second, with methods
+    drawn from `mix`, a dict of {method: weight}.  Dialog commands are
+    sent for the instruments in `instruments` in turn.
+    """
+    if len(mix) == 0:
+        raise ValueError("no methods in the command mix")
+    unknown = set(mix.keys()) - set(synthetic_methods)
+    if len(unknown) > 0:
+        raise ValueError("no synthetic commands for {} (choose from {})".format(
+            ', '.join(sorted(unknown)), ', '.join(synthetic_methods)))
+    if any(weight < 0 for weight in mix.values()) or sum(mix.values()) <= 0:
+        raise ValueError("weights in the command mix must not be negative, "
+                         "and at least one must be positive")
+    if len(instruments) == 0 and any(mix.get(method, 0) > 0
+                                     for method in dialog_methods):
+        raise ValueError("dialog commands ({}) need at least one "
+                         "instrument".format(', '.join(dialog_methods)))
+    if rate <= 0:
+        raise ValueError("the command rate must be positive")
+
+    rng = random.Random(seed)
+    methods, weights = list(mix.keys()), list(mix.values())
+    res = []
+    for i in range(count):
+        method = rng.choices(methods, weights=weights)[0]
+        cmd = Bunch.Bunch(time=i / rate, method=method, args=[],
+                          kwdargs={}, cancel_after=None)
+        if method == 'sleep':
+            cmd.kwdargs = dict(sleep_time=sleep_time)
+        else:
+            # a dialog; nobody will answer it
+            insname = instruments[i % len(instruments)]
+            cmd.kwdargs = dict(instrument_name=insname,
+                               title="load test {}".format(i))
+            if method == 'confirmation':
+                cmd.kwdargs['dialog'] = 'OK Cancel'
+            elif method == 'userinput':
+                cmd.kwdargs['itemlist'] = [['VALUE', i]]
+            cmd.cancel_after = cancel_after
+        res.append(cmd)
+    return res
+
+
+def load_stream(filepath):
+    """Returns the list of commands in the command stream file
+    `filepath`.
+    """
+    res = []
+    with open(filepath, 'r') as in_f:
+        for line in in_f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            d = json.loads(line)
+            if 'time' not in d or 'method' not in d:
+                raise ValueError("command without 'time' or 'method' in "
+                                 "'{}': {}".format(filepath, line))
+            res.append(Bunch.Bunch(time=d['time'], method=d['method'],
+                                   args=d.get('args', []),
+                                   kwdargs=d.get('kwdargs', {}),
+                                   cancel_after=d.get('cancel_after', None)))
+    return res
+
+
+class CommandDriver:
+    """Send commands to the ANA service `svcname` and match the results
+    that arrive at the hub to them.
+    """
+
+    def __init__(self, svcname, logger):
+        self.svcname = svcname
+        self.logger = logger
+        self.proxy = ro.remoteObjectProxy(svcname)
+
+        self.cond = threading.Condition()
+        # tag -> Bunch, for commands sent
+        self.commands = {}
+        self.num_done = 0
+        self.num_errors = 0
+        self.time_first = None
+        self.time_last = None
+        # method -> {stage: LatencyStats}
+        self.latency = {}
+
+    def wait_service(self, timeout):
+        """Wait up to `timeout` sec for the ANA service to answer."""
+        time_end = time.time() + timeout
+        while True:
+            try:
+                self.proxy.get_command_stats()
+                return True
+
+            except Exception as e:
+                if time.time() > time_end:
+                    self.logger.error("ANA service '{}' not answering: {}".format(
+                        self.svcname, e))
+                    return False
+                time.sleep(1.0)
+
+    def record(self, method, stage, sec):
+        with self.cond:
+            dct = self.latency.setdefault(method, {})
+            if stage not in dct:
+                dct[stage] = LatencyStats(maxlen=100000)
+            stats = dct[stage]
+        stats.record(sec)
+
+    def send(self, tag, cmd):
+        with self.cond:
+            self.commands[tag] = Bunch.Bunch(cmd=cmd, time_sent=time.time(),
+                                             done=False)
+        time_start = time.time()
+        self.proxy.callGlobalPlugin2(tag, 'ANA', cmd.method, cmd.args,
+                                     cmd.kwdargs)
+        self.record(cmd.method, 'rpc', time.time() - time_start)
+
+        if cmd.cancel_after is not None:
+            timer = threading.Timer(cmd.cancel_after, self.cancel, args=(tag,))
+            timer.daemon = True
+            timer.start()
+
+    def cancel(self, tag):
+        # NOTE: called from a timer thread, so use a proxy of our own
+        try:
+            ro.remoteObjectProxy(self.svcname).cancel_command(tag)
+
+        except Exception as e:
+            self.logger.error("Error cancelling '{}': {}".format(tag, e))
+
+    def result_cb(self, tag, vals, time_received):
+        if 'gui_done' not in vals:
+            return
+        with self.cond:
+            bnch = self.commands.get(tag, None)
+            if bnch is None or bnch.done:
+                # not ours, or already counted
+                return
+            bnch.done = True
+            self.num_done += 1
+            if vals.get('result', None) == 'error':
+                self.num_errors += 1
+            self.time_last = time_received
+            self.cond.notify_all()
+
+        method = bnch.cmd.method
+        gui_done = vals['gui_done']
+        gui_dispatched = vals.get('gui_dispatched', None)
+        if gui_dispatched is not None:
+            self.record(method, 'dispatch', gui_dispatched - bnch.time_sent)
+            self.record(method, 'run', gui_done - gui_dispatched)
+        self.record(method, 'publish', time_received - gui_done)
+        self.record(method, 'total', time_received - bnch.time_sent)
+
+    def run(self, stream, tag_prefix='gen2sim'):
+        """Send the commands in `stream`, at their times."""
+        self.time_first = time.time()
+        for i, cmd in enumerate(stream):
+            delay = self.time_first + cmd.time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            tag = '{}.{}'.format(tag_prefix, i)
+            try:
+                self.send(tag, cmd)
+
+            except Exception as e:
+                self.logger.error("Error sending {} ({}): {}".format(
+                    cmd.method, tag, e))
+
+    def wait_done(self, count, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.num_done >= count,
+                                      timeout=timeout)
+
+
+def parse_mix(mix):
+    """Parse 'METHOD[:WEIGHT],...' into a dict of {method: weight}."""
+    res = {}
+    for item in mix.split(','):
+        item = item.strip()
+        if len(item) == 0:
+            continue
+        if ':' in item:
+            method, weight = item.split(':', 1)
+            try:
+                res[method.strip()] = float(weight)
+
+            except ValueError:
+                raise ValueError("bad weight in command mix: '{}'".format(item))
+        else:
+            res[item] = 1.0
+    return res
+
+
+def make_stream(options):
+    """Returns the command stream described by the command line
+    `options`.  Raises ValueError if they do not describe one.
+    """
+    if options.replay is not None:
+        return load_stream(options.replay)
+
+    if options.count <= 0:
+        raise ValueError("the command count must be positive")
+    instruments = [s.strip() for s in options.instruments.split(',')
+                   if len(s.strip()) > 0]
+    return make_synthetic_stream(parse_mix(options.mix), options.count,
+                                 options.rate,
+                                 sleep_time=options.sleep_time,
+                                 instruments=instruments,
+                                 cancel_after=options.cancel_after,
+                                 seed=options.seed)
+
+
+def main(options, args):
+
+    logger = ssdlog.make_logger('ana_gen2sim', options)
+
+    # check the options before starting any service
+    try:
+        stream = make_stream(options)
+
+    except (OSError, ValueError) as e:
+        logger.error("Cannot make the command stream: {}".format(e))
+        return 1
+
+    ev_quit = threading.Event()
+    names = None
+    if not options.no_names:
+        names = start_name_service(options.names_cmd, logger)
+        time.sleep(2.0)
+    ro.init([options.rohost])
+
+    svcname = options.svcname
+    if svcname is None:
+        # as in the ANA plugin
+        svcname = "ANA-{}-{}".format(options.propid,
+                                     options.host or ro.get_myhost(short=True))
+
+    driver = CommandDriver(svcname, logger)
+    hub = MonitorHub(logger, ev_quit, options.monport, driver.result_cb)
+    hub.start()
+    try:
+        logger.info("waiting for ANA service '{}'".format(svcname))
+        if not driver.wait_service(options.timeout):
+            return 1
+
+        driver.run(stream)
+        if not driver.wait_done(len(stream), options.timeout):
+            logger.error("only {} of {} results arrived".format(
+                driver.num_done, len(stream)))
+
+        elapsed = (driver.time_last or time.time()) - driver.time_first
+        print("{} commands sent, {} results ({} errors) in {:.1f} sec: "
+              "{:.1f} commands/sec".format(len(stream), driver.num_done,
+                                           driver.num_errors, elapsed,
+                                           driver.num_done / max(elapsed, 1e-6)))
+        print("")
+        print("latency (ms)")
+        print("{:>14s} {:>10s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s}".format(
+            'method', 'stage', 'n', 'p50', 'p95', 'p99', 'max'))
+        for method in sorted(driver.latency.keys()):
+            stage_dct = driver.latency[method]
+            for stage in stages:
+                if stage not in stage_dct:
+                    continue
+                dct = stage_dct[stage].get_stats()
+                print("{:>14s} {:>10s} {:6d} {:8.1f} {:8.1f} {:8.1f} "
+                      "{:8.1f}".format(method, stage, dct['count'],
+                                       dct.get('p50_sec', 0) * 1000,
+                                       dct.get('p95_sec', 0) * 1000,
+                                       dct.get('p99_sec', 0) * 1000,
+                                       dct['max_sec'] * 1000))
+
+        print("")
+        stats = driver.proxy.get_ingest_stats()
+        print("ANA publishing: {}".format(stats.get('publish', None)))
+        print("ANA commands: {}".format(driver.proxy.get_command_stats()))
+
+        if options.serve:
+            logger.info("serving until interrupted")
+            while not ev_quit.is_set():
+                ev_quit.wait(1.0)
+
+    except KeyboardInterrupt:
+        logger.error("Caught keyboard interrupt!")
+
+    finally:
+        ev_quit.set()
+        hub.stop()
+        if names is not None:
+            names.terminate()
+            names.wait()
+
+# END
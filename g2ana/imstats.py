@@ -0,0 +1,218 @@
+#
+# imstats.py -- statistics of loaded images for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Statistics of images already loaded into ANA, for Gen2 scripts that
+need e.g. the sky level, the number of saturated pixels or the median
+of some regions without fetching the pixels.
+
+A box is given as ``(x1, y1, x2, y2)`` in pixel indices of the data
+array, with the upper bounds exclusive (i.e. ``data[y1:y2, x1:x2]``);
+it is clipped to the image.  Small boxes of the same size are stacked
+and computed together.  Statistics are computed in the dtype of the
+image where possible, so that e.g. a whole raw frame is not copied to
+floating point.
+"""
+import weakref
+import warnings
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def clip_box(box, shape):
+    """Returns `box` clipped to an image of `shape`, as a tuple of ints."""
+    ht, wd = shape[:2]
+    x1, y1, x2, y2 = [int(round(n)) for n in box]
+    x1, x2 = sorted([min(max(0, x), wd) for x in (x1, x2)])
+    y1, y2 = sorted([min(max(0, y), ht) for y in (y1, y2)])
+    return (x1, y1, x2, y2)
+
+
+def sky_level(pixels, nsigma=3.0, iterations=3):
+    """Returns the sigma-clipped median and standard deviation along the
+    last axis of 2D array `pixels` (one row per region), ignoring NaNs.
+    """
+    pixels = np.array(pixels, dtype=np.float64)
+    for i in range(iterations):
+        median = np.nanmedian(pixels, axis=-1, keepdims=True)
+        stddev = np.nanstd(pixels, axis=-1, keepdims=True)
+        with np.errstate(invalid='ignore'):
+            outside = np.abs(pixels - median) > nsigma * stddev
+        if not outside.any():
+            break
+        pixels[outside] = np.nan
+    return (np.nanmedian(pixels, axis=-1), np.nanstd(pixels, axis=-1))
+
+
+def region_stats(pixels, saturation=None, band_pixels=1000000,
+                 max_sky_pixels=1000000):
+    """Returns a dict of statistics of the regions in 3D array `pixels`
+    (region, y, x), each an array with one value per region.
+
+    The pixels are neither copied nor converted to floating point as a
+    whole: sums are accumulated in float64 over bands of at most about
+    `band_pixels` pixels per region, and the median is taken in the
+    dtype of `pixels`.  The sky level of regions with more than
+    `max_sky_pixels` pixels is estimated from an evenly spaced subset of
+    them.
+    """
+    num, ht, wd = pixels.shape
+    is_float = np.issubdtype(pixels.dtype, np.floating)
+    rows = max(1, band_pixels // max(1, wd))
+    bands = [pixels[:, y:y + rows] for y in range(0, ht, rows)]
+    axes = (1, 2)
+
+    ngood = np.zeros(num, dtype=np.int64)
+    total = np.zeros(num, dtype=np.float64)
+    nsat = np.zeros(num, dtype=np.int64)
+    mins, maxs = [], []
+    for band in bands:
+        if is_float:
+            finite = np.isfinite(band)
+            ngood += finite.sum(axis=axes)
+            total += np.where(finite, band, 0).sum(axis=axes,
+                                                   dtype=np.float64)
+            mins.append(np.nanmin(band, axis=axes))
+            maxs.append(np.nanmax(band, axis=axes))
+        else:
+            ngood += band.shape[1] * band.shape[2]
+            total += band.sum(axis=axes, dtype=np.float64)
+            mins.append(band.min(axis=axes))
+            maxs.append(band.max(axis=axes))
+        if saturation is not None:
+            with np.errstate(invalid='ignore'):
+                nsat += (band >= saturation).sum(axis=axes)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / ngood
+    # second pass for the standard deviation, which is more accurate
+    # than one from the sum of squares
+    sqdev = np.zeros(num, dtype=np.float64)
+    for band in bands:
+        dev = band - mean[:, np.newaxis, np.newaxis]
+        sqdev += np.nansum(dev * dev, axis=axes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stddev = np.sqrt(sqdev / ngood)
+    stddev[ngood == 0] = np.nan
+
+    stats = dict(min=np.nanmin(np.stack(mins), axis=0),
+                 max=np.nanmax(np.stack(maxs), axis=0),
+                 mean=mean, stddev=stddev)
+    if is_float:
+        stats['median'] = np.nanmedian(pixels, axis=axes)
+    else:
+        stats['median'] = np.median(pixels, axis=axes)
+    step = max(1, int(np.ceil(np.sqrt(ht * wd / max_sky_pixels))))
+    stats['sky'], stats['sky_stddev'] = sky_level(
+        pixels[:, ::step, ::step].reshape(num, -1))
+    if saturation is not None:
+        stats['saturated'] = nsat
+    stats['ngood'] = ngood
+    return stats
+
+
+def compute_stats(data, boxes, saturation=None, max_stack_pixels=65536):
+    """Returns a list with a dict of statistics for each box in `boxes`
+    on the 2D array `data`.  If `saturation` is given, the number of
+    pixels at or above it is included.  Boxes of the same size up to
+    `max_stack_pixels` pixels are stacked and computed together; larger
+    ones are computed on a view of `data`, without copying them.
+    """
+    boxes = [clip_box(box, data.shape) for box in boxes]
+    res = [None] * len(boxes)
+
+    # boxes of the same size are computed together
+    groups = {}
+    for i, box in enumerate(boxes):
+        x1, y1, x2, y2 = box
+        groups.setdefault((y2 - y1, x2 - x1), []).append(i)
+
+    for (ht, wd), indices in groups.items():
+        if ht * wd == 0:
+            for i in indices:
+                res[i] = dict(box=list(boxes[i]), npix=0)
+            continue
+
+        if ht * wd <= max_stack_pixels:
+            batches = [indices]
+        else:
+            batches = [[i] for i in indices]
+
+        for batch in batches:
+            regions = [data[y1:y2, x1:x2]
+                       for x1, y1, x2, y2 in [boxes[i] for i in batch]]
+            if len(regions) == 1:
+                pixels = regions[0][np.newaxis]
+            else:
+                pixels = np.stack(regions)
+
+            with warnings.catch_warnings():
+                # all-NaN regions give NaN results
+                warnings.simplefilter('ignore', RuntimeWarning)
+                stats = region_stats(pixels, saturation=saturation)
+            ngood = stats.pop('ngood')
+
+            for j, i in enumerate(batch):
+                dct = dict(box=list(boxes[i]), npix=ht * wd,
+                           nbad=int(ht * wd - ngood[j]))
+                for key, arr in stats.items():
+                    val = arr[j].item()
+                    # left out for regions without valid pixels, as NaN
+                    # cannot be sent over XML-RPC
+                    if val == val:
+                        dct[key] = val
+                res[i] = dct
+
+    return res
+
+
+class StatsCache:
+    """Cache of the statistics computed for the images that are loaded.
+
+    Entries are keyed by the image (object) and box, so a replaced
+    image, even under the same name, is never served stale results.
+    Images are only weakly referenced: an entry goes away with its
+    image when the channel drops it, and the cache never keeps the
+    pixels of an image alive.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # image -> {(box, saturation): stats}
+        self.images = weakref.WeakKeyDictionary()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get_stats(self, image, data, boxes, saturation=None):
+        """Returns a list of statistics dicts for `boxes` on `data`, the
+        pixels of `image`, computing only those that are not cached.
+        """
+        with self.lock:
+            cached = self.images.get(image, None)
+            if cached is None:
+                cached = {}
+                self.images[image] = cached
+
+            keys = [(clip_box(box, data.shape), saturation) for box in boxes]
+            missing = [k for k in OrderedDict.fromkeys(keys)
+                       if k not in cached]
+            self.num_hits += len(keys) - len(missing)
+            self.num_misses += len(missing)
+
+        if len(missing) > 0:
+            results = compute_stats(data, [k[0] for k in missing],
+                                    saturation=saturation)
+            with self.lock:
+                cached.update(zip(missing, results))
+
+        return [dict(cached[k]) for k in keys]
+
+    def get_cache_stats(self):
+        with self.lock:
+            return dict(images=len(self.images), hits=self.num_hits,
+                        misses=self.num_misses)
@@ -0,0 +1,590 @@
+#
+# ingest.py -- support classes for the ANA plugin file ingest
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Helpers used by the ANA plugin to move newly arrived FITS files from
+the filesystem watcher to the image loader.
+
+These classes do not depend on the GUI and are safe to use from any
+thread.
+"""
+import os
+import time
+import heapq
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from ginga.misc import Bunch
+
+# Request classes, in order of urgency.  These are used as priorities in
+# the IngestQueue (lower values are taken first).
+#   interactive: a frame requested by the user (e.g. from the ObsLog)
+#   live: a newly arrived frame
+#   backfill: speculative work (e.g. prefetching)
+PRIO_INTERACTIVE = 0
+PRIO_LIVE = 1
+PRIO_BACKFILL = 2
+
+request_classes = {PRIO_INTERACTIVE: 'interactive',
+                   PRIO_LIVE: 'live',
+                   PRIO_BACKFILL: 'backfill'}
+
+
+class EventCoalescer:
+    """Merge repeated filesystem events for the same path.
+
+    A file is often reported more than once as it arrives (e.g. an
+    ``IN_CLOSE_WRITE`` followed by an ``IN_MOVED_TO``, or several write
+    passes).  Events are held here until no new event for that path has
+    been seen for `window` seconds, and then released exactly once.
+
+    Parameters
+    ----------
+    window : float
+        Settle window in seconds.  A value of 0 releases each path on the
+        next call to `get_ready` without waiting.
+    """
+
+    def __init__(self, window=0.25):
+        self.window = window
+
+        self.lock = threading.RLock()
+        # filepath -> Bunch, in order of first event
+        self.pending = OrderedDict()
+
+        self.num_events = 0
+        self.num_merged = 0
+        self.num_released = 0
+        self.num_discarded = 0
+
+    def add(self, filepath, **kwargs):
+        """Record an event for `filepath`.
+
+        Any keyword arguments are stored on the Bunch that is eventually
+        released for this path (later events overwrite earlier values).
+        """
+        now = time.time()
+        with self.lock:
+            self.num_events += 1
+            bnch = self.pending.get(filepath, None)
+            if bnch is None:
+                bnch = Bunch.Bunch(filepath=filepath, time_event=now,
+                                   num_events=0)
+                self.pending[filepath] = bnch
+            else:
+                self.num_merged += 1
+            bnch.num_events += 1
+            bnch.time_last = now
+            bnch.update(kwargs)
+
+    def discard(self, filepath):
+        """Forget any pending events for `filepath` (e.g. it was deleted
+        or moved away before it settled).
+        """
+        with self.lock:
+            if self.pending.pop(filepath, None) is not None:
+                self.num_discarded += 1
+
+    def get_ready(self, now=None):
+        """Return a list of Bunches for paths whose events have settled.
+        """
+        if now is None:
+            now = time.time()
+        res = []
+        with self.lock:
+            for filepath, bnch in list(self.pending.items()):
+                if now - bnch.time_last >= self.window:
+                    del self.pending[filepath]
+                    res.append(bnch)
+            self.num_released += len(res)
+        return res
+
+    def get_next_due(self):
+        """Returns the time at which the next pending path will have
+        settled, or None if there are no pending paths.
+        """
+        with self.lock:
+            if len(self.pending) == 0:
+                return None
+            return min([bnch.time_last for bnch in self.pending.values()]) + self.window
+
+    def get_stats(self):
+        with self.lock:
+            return dict(events=self.num_events, merged=self.num_merged,
+                        released=self.num_released,
+                        discarded=self.num_discarded,
+                        pending=len(self.pending))
+
+
+class FrameIndex:
+    """Map frame ids to the absolute paths of their files in a data
+    directory, so that finding a frame needs no filesystem access.
+
+    The index is seeded with `scan` and then kept up to date by calling
+    `add` and `remove` as files arrive and go away.  If a frame exists
+    under more than one of `suffixes`, the first one listed is preferred.
+    """
+
+    suffixes = ('.fits', '.fits.fz', '.fits.gz')
+
+    def __init__(self, logger=None):
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        # frameid -> {suffix: filepath}
+        self.index = {}
+
+    def _split(self, filepath):
+        name = os.path.basename(filepath)
+        for suffix in self.suffixes:
+            if name.endswith(suffix):
+                return (name[:-len(suffix)], suffix)
+        return (None, None)
+
+    def scan(self, data_dir):
+        """Add all the frames in `data_dir`.  Returns the number of files
+        found.
+        """
+        count = 0
+        try:
+            with os.scandir(data_dir) as it:
+                for entry in it:
+                    if entry.is_file() and self.add(entry.path):
+                        count += 1
+
+        except OSError as e:
+            if self.logger is not None:
+                self.logger.warning("Error scanning '{}': {}".format(
+                    data_dir, e))
+        return count
+
+    def add(self, filepath):
+        """Add the file at `filepath`.  Returns False if its name does not
+        look like a frame.
+        """
+        frameid, suffix = self._split(filepath)
+        if frameid is None:
+            return False
+        with self.lock:
+            self.index.setdefault(frameid, dict())[suffix] = os.path.abspath(filepath)
+        return True
+
+    def remove(self, filepath):
+        frameid, suffix = self._split(filepath)
+        if frameid is None:
+            return
+        with self.lock:
+            paths = self.index.get(frameid, None)
+            if paths is not None:
+                paths.pop(suffix, None)
+                if len(paths) == 0:
+                    del self.index[frameid]
+
+    def get_path(self, frameid):
+        """Returns the path of the file for `frameid`, or None."""
+        with self.lock:
+            paths = self.index.get(frameid, None)
+            if paths is None:
+                return None
+            for suffix in self.suffixes:
+                if suffix in paths:
+                    return paths[suffix]
+        return None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.index)
+
+
+class IngestQueue:
+    """A bounded priority queue of Bunches describing files to load.
+
+    Items with a lower `priority` value are taken first, and items of
+    equal priority in the order they were put.  Consumers block on a
+    condition variable rather than polling, and are woken with None
+    when the queue is closed.
+
+    When the queue holds `maxsize` items (0 means unbounded), `policy`
+    decides what happens to a new item:
+
+    - 'oldest': drop the oldest of the least urgent items that are no
+      more urgent than the new one (or the new item itself if the queue
+      is full of more urgent items)
+    - 'channel-oldest': like 'oldest', but prefer to drop the oldest item
+      with the same `order_key` (i.e. channel) as the new one
+    - 'block': wait for a consumer to make room (backpressure)
+
+    Items put with `droppable` set to False (e.g. interactive requests)
+    are never dropped and never wait for room; they may temporarily take
+    the queue over its capacity.
+
+    Every dropped Bunch is passed to `on_drop`, outside of the queue lock.
+    If `on_put` is set, it is called with no arguments after each item is
+    added (e.g. to wake up an event loop that uses `get_nowait`).
+    """
+
+    policies = ('oldest', 'channel-oldest', 'block')
+
+    def __init__(self, maxsize=0, policy='oldest', on_drop=None):
+        if policy not in self.policies:
+            raise ValueError("drop policy must be one of {}".format(
+                self.policies))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.on_put = None
+
+        self.cond = threading.Condition()
+        # heap of (priority, count, bnch)
+        self.heap = []
+        self.count = 0
+        self.closed = False
+
+        self.num_put = 0
+        self.num_get = 0
+        self.num_dropped = 0
+        self.max_depth = 0
+        self.total_wait_sec = 0.0
+        self.max_wait_sec = 0.0
+
+    def put(self, bnch, priority=PRIO_LIVE, droppable=True):
+        """Add `bnch` to the queue.  Returns False if it was dropped."""
+        dropped = []
+        accepted = True
+        with self.cond:
+            bnch.droppable = droppable
+            if self.maxsize <= 0 or not droppable:
+                pass
+
+            elif self.policy == 'block':
+                while len(self.heap) >= self.maxsize and not self.closed:
+                    self.cond.wait()
+
+            elif len(self.heap) >= self.maxsize:
+                victim = self._choose_victim(bnch, priority)
+                if victim is None:
+                    # queue is full of more urgent items
+                    accepted = False
+                    dropped.append(bnch)
+                else:
+                    self.heap.remove(victim)
+                    heapq.heapify(self.heap)
+                    dropped.append(victim[2])
+
+            if accepted:
+                bnch.time_queued = time.time()
+                heapq.heappush(self.heap, (priority, self.count, bnch))
+                self.count += 1
+                self.num_put += 1
+                self.max_depth = max(self.max_depth, len(self.heap))
+                self.cond.notify()
+
+            self.num_dropped += len(dropped)
+
+        if self.on_drop is not None:
+            for _bnch in dropped:
+                self.on_drop(_bnch)
+        if accepted and self.on_put is not None:
+            self.on_put()
+        return accepted
+
+    def _choose_victim(self, bnch, priority):
+        candidates = [tup for tup in self.heap
+                      if tup[0] >= priority and tup[2].droppable]
+        if len(candidates) == 0:
+            return None
+        if self.policy == 'channel-oldest':
+            key = bnch.get('order_key', None)
+            same = [tup for tup in candidates
+                    if tup[2].get('order_key', None) == key]
+            if len(same) > 0:
+                candidates = same
+        # least urgent first, then oldest
+        return min(candidates, key=lambda tup: (-tup[0], tup[1]))
+
+    def get(self):
+        """Take the next item, blocking until there is one.  Returns None
+        if the queue has been closed.
+        """
+        with self.cond:
+            while len(self.heap) == 0 and not self.closed:
+                self.cond.wait()
+            return self._pop()
+
+    def get_nowait(self):
+        """Take the next item, or return None if the queue is empty."""
+        with self.cond:
+            return self._pop()
+
+    def _pop(self):
+        if len(self.heap) == 0:
+            return None
+
+        priority, count, bnch = heapq.heappop(self.heap)
+        bnch.time_dequeued = time.time()
+        wait_sec = bnch.time_dequeued - bnch.time_queued
+        self.num_get += 1
+        self.total_wait_sec += wait_sec
+        self.max_wait_sec = max(self.max_wait_sec, wait_sec)
+        # make room for any blocked producers
+        self.cond.notify_all()
+        return bnch
+
+    def close(self):
+        """Wake up all consumers (and blocked producers)."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.heap)
+
+    def get_stats(self):
+        with self.cond:
+            return dict(depth=len(self.heap), max_depth=self.max_depth,
+                        capacity=self.maxsize, policy=self.policy,
+                        put=self.num_put, get=self.num_get,
+                        dropped=self.num_dropped,
+                        mean_wait_sec=(self.total_wait_sec /
+                                       max(1, self.num_get)),
+                        max_wait_sec=self.max_wait_sec)
+
+
+class LatencyStats:
+    """Keep count, mean, maximum and percentiles of recent latencies.
+
+    Percentiles are computed over the last `maxlen` samples.
+    """
+
+    def __init__(self, maxlen=1000):
+        self.lock = threading.RLock()
+        self.samples = deque(maxlen=maxlen)
+        self.count = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+
+    def record(self, sec):
+        with self.lock:
+            self.samples.append(sec)
+            self.count += 1
+            self.total_sec += sec
+            self.max_sec = max(self.max_sec, sec)
+
+    def get_stats(self):
+        with self.lock:
+            res = dict(count=self.count,
+                       mean_sec=self.total_sec / max(1, self.count),
+                       max_sec=self.max_sec)
+            if len(self.samples) > 0:
+                p50, p95, p99 = np.percentile(list(self.samples),
+                                              [50, 95, 99])
+                res.update(p50_sec=float(p50), p95_sec=float(p95),
+                           p99_sec=float(p99))
+            return res
+
+
+class IngestTimings:
+    """Rolling statistics of the time from a file's arrival event until
+    each stage of its ingest is reached, per instrument and channel.
+
+    The stages are, in order:
+
+    - 'dequeued': a decode worker took the file off the queue
+    - 'decoded': the image (or header) was read
+    - 'displayed': the image was added to its channel
+    - 'logged': the frame was added to the ObsLog
+    """
+
+    stages = ('dequeued', 'decoded', 'displayed', 'logged')
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+
+        self.lock = threading.RLock()
+        # (insname, chname, stage) -> LatencyStats
+        self.stats = {}
+        # frameid -> Bunch, for frames with stages still to come
+        self.pending = OrderedDict()
+
+    def record(self, insname, chname, stage, sec):
+        key = (insname, chname, stage)
+        with self.lock:
+            stats = self.stats.get(key, None)
+            if stats is None:
+                stats = LatencyStats(maxlen=self.maxlen)
+                self.stats[key] = stats
+        stats.record(sec)
+
+    def record_frame(self, frameid, insname, chname, time_event, **times):
+        """Record the stages reached so far by frame `frameid`.  `times`
+        maps stage names to the times (as returned by time.time()) they
+        were reached.  The frame is remembered so that later stages can
+        be recorded with `record_stage`.
+        """
+        for stage, time_stage in times.items():
+            self.record(insname, chname, stage, time_stage - time_event)
+        with self.lock:
+            self.pending[frameid] = Bunch.Bunch(insname=insname,
+                                                chname=chname,
+                                                time_event=time_event)
+            self.pending.move_to_end(frameid)
+            while len(self.pending) > self.maxlen:
+                self.pending.popitem(last=False)
+
+    def record_stage(self, frameid, stage, time_stage=None):
+        """Record that frame `frameid` reached `stage`.  Nothing is done
+        if the frame is unknown (e.g. it was not a live arrival).
+        """
+        if time_stage is None:
+            time_stage = time.time()
+        with self.lock:
+            bnch = self.pending.get(frameid, None)
+        if bnch is not None:
+            self.record(bnch.insname, bnch.chname, stage,
+                        time_stage - bnch.time_event)
+
+    def get_stats(self):
+        """Returns a dict of {insname: {chname: {stage: stats}}}, where
+        stats is a dict as returned by `LatencyStats.get_stats`.
+        """
+        with self.lock:
+            items = list(self.stats.items())
+        res = dict()
+        for (insname, chname, stage), stats in sorted(items):
+            dct = res.setdefault(insname, dict()).setdefault(chname, dict())
+            dct[stage] = stats.get_stats()
+        return res
+
+
+class SequenceGate:
+    """Release actions in the order tickets were issued, independently
+    for each key.
+
+    A producer takes a ticket for a key when it queues an item; whoever
+    finishes processing the item hands the ticket back together with an
+    action (or None) via `release`.  Actions for a key run strictly in
+    ticket order, while different keys never wait for each other.  A key
+    of None means "no ordering" and the action is run immediately.
+
+    Every ticket issued *must* eventually be released, otherwise later
+    actions for that key are held back forever.
+
+    An "early" action for a ticket (e.g. showing a preview of the item)
+    can be given via `run_when_next`; it runs once all the tickets
+    before it have been released, without releasing the ticket itself.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        # key -> next ticket to hand out
+        self.issued = {}
+        # key -> next ticket allowed to run
+        self.next_release = {}
+        # key -> {ticket: action} for tickets released out of order
+        self.held = {}
+        # key -> {ticket: action} for early actions not yet run
+        self.early = {}
+
+    def ticket(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            num = self.issued.get(key, 0)
+            self.issued[key] = num + 1
+            return num
+
+    def release(self, key, ticket, action=None):
+        if key is None or ticket is None:
+            self._run(action)
+            return
+
+        with self.lock:
+            held = self.held.setdefault(key, dict())
+            held[ticket] = action
+            num = self.next_release.get(key, 0)
+            # actions are run while holding the lock, so that two
+            # releasing threads cannot reorder them; they are expected
+            # to be short (e.g. scheduling work on the GUI thread)
+            early = self.early.get(key, {})
+            while num in held:
+                # the early action is moot once the item is done
+                early.pop(num, None)
+                self._run(held.pop(num))
+                num += 1
+            self.next_release[key] = num
+            if len(held) == 0:
+                del self.held[key]
+            if num in early:
+                self._run(early.pop(num))
+            if len(early) == 0:
+                self.early.pop(key, None)
+
+    def run_when_next(self, key, ticket, action):
+        """Run `action` as soon as all the tickets for `key` before
+        `ticket` have been released, i.e. in order with the actions for
+        earlier tickets, but without releasing `ticket`.  The action is
+        dropped if `ticket` is released before that.
+        """
+        if key is None or ticket is None:
+            self._run(action)
+            return
+
+        with self.lock:
+            num = self.next_release.get(key, 0)
+            if ticket == num:
+                self._run(action)
+            elif ticket > num:
+                self.early.setdefault(key, dict())[ticket] = action
+
+    def _run(self, action):
+        if action is None:
+            return
+        try:
+            action()
+
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("Error in released action: {}".format(e),
+                                  exc_info=True)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(keys=len(self.issued),
+                        held=sum([len(d) for d in self.held.values()]),
+                        early=sum([len(d) for d in self.early.values()]))
+
+
+class WorkerStats:
+    """Keep track of how busy each worker in a pool is."""
+
+    def __init__(self, num_workers):
+        self.lock = threading.RLock()
+        self.time_start = time.time()
+        self.workers = [Bunch.Bunch(busy_sec=0.0, count=0)
+                        for i in range(num_workers)]
+
+    def record(self, idx, busy_sec):
+        with self.lock:
+            bnch = self.workers[idx]
+            bnch.busy_sec += busy_sec
+            bnch.count += 1
+
+    def get_stats(self):
+        """Returns a list of dicts, one per worker, with the number of
+        items processed, total busy time and utilisation (busy fraction
+        of the time since the pool was started).
+        """
+        elapsed = max(time.time() - self.time_start, 1.0e-6)
+        with self.lock:
+            return [dict(worker=i, count=bnch.count,
+                         busy_sec=bnch.busy_sec,
+                         utilization=bnch.busy_sec / elapsed)
+                    for i, bnch in enumerate(self.workers)]
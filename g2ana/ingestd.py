@@ -0,0 +1,642 @@
+#
+# ingestd.py -- shared per-host FITS ingest daemon for ANA viewers
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Watches data directories for newly arrived FITS files on behalf of all
+the anaview sessions on a host, so that each file is only parsed and
+decoded once no matter how many sessions are looking at it.
+
+Sessions (the ANA plugin, when its 'ingest_daemon_socket' setting is
+set) connect over a Unix socket and subscribe to a data directory.  The
+daemon watches each subscribed directory once, and for every file that
+arrives sends the subscribers a frame-arrival event with the frame id
+and FITS header, plus a read-only shared memory buffer (a sealed memfd
+passed over the socket) holding the decoded pixels.  Files that are
+deleted or moved away are announced with a removal event.
+
+Events are queued for each session and sent by a thread of its own; a
+session that falls too far behind (option --send-queue) is dropped,
+rather than holding up the others.
+
+A session may only subscribe to a directory that its user can read.
+The daemon itself must run as a user that can read all data
+directories.
+
+Typical usage:
+
+$ ana_ingestd --loglevel=20 --socket=/var/run/g2ana/ingestd.sock \\
+    --workers=4 --log=ingestd.log
+"""
+import os
+import pwd
+import stat
+import mmap
+import array
+import fcntl
+import json
+import time
+import socket
+import struct
+import threading
+import queue as Queue
+
+import numpy as np
+from astropy.io import fits
+
+from g2base import ssdlog
+from g2base.astro.frame import Frame
+
+from ginga.misc import Bunch
+
+from g2ana import ingest, fitsutil
+
+have_inotify = False
+try:
+    import inotify.adapters
+    have_inotify = True
+except ImportError:
+    pass
+
+default_socket = '/var/run/g2ana/ingestd.sock'
+
+# largest message sent as one datagram.  A datagram must fit into the
+# socket send buffer (about 208 kB by default on Linux, and SO_SNDBUF is
+# capped by net.core.wmem_max), so larger messages (e.g. with very long
+# FITS headers) are passed in a memfd instead; see send_msg()
+max_msg_size = 64 * 1024
+
+
+class IngestDaemonError(Exception):
+    pass
+
+
+def send_msg(sock, dct, fds=[]):
+    """Send `dct` as one JSON message on a SOCK_SEQPACKET socket, along
+    with any file descriptors in `fds`.  A message larger than
+    `max_msg_size` is copied into a memfd, which is passed after `fds`,
+    and only its size is sent in the datagram.
+    """
+    buf = json.dumps(dct).encode('utf-8')
+    fds = list(fds)
+    msg_fd = None
+    if len(buf) > max_msg_size:
+        msg_fd = make_shared_buffer('msg', np.frombuffer(buf, dtype=np.uint8))
+        fds.append(msg_fd)
+        buf = json.dumps(dict(msg_nbytes=len(buf))).encode('utf-8')
+    try:
+        ancdata = []
+        if len(fds) > 0:
+            ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                            array.array('i', fds)))
+        sock.sendmsg([buf], ancdata)
+
+    finally:
+        if msg_fd is not None:
+            os.close(msg_fd)
+
+
+def recv_msg(sock, max_fds=1):
+    """Receive one JSON message from a SOCK_SEQPACKET socket.  Returns a
+    tuple of (dict, fds), or (None, []) if the peer has closed the
+    connection.
+    """
+    fds = array.array('i')
+    # NOTE: room for the memfd of a large message, too
+    buf, ancdata, flags, addr = sock.recvmsg(
+        max_msg_size, socket.CMSG_SPACE((max_fds + 1) * fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            usable = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
+            fds.frombytes(cmsg_data[:usable])
+    fds = list(fds)
+    if len(buf) == 0:
+        for fd in fds:
+            os.close(fd)
+        return (None, [])
+    if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+        for fd in fds:
+            os.close(fd)
+        raise IngestDaemonError("truncated message")
+    dct = json.loads(buf.decode('utf-8'))
+    if 'msg_nbytes' in dct:
+        # the message itself is in the last descriptor
+        if len(fds) == 0:
+            raise IngestDaemonError("large message without its buffer")
+        buf = map_shared_buffer(fds.pop(), (dct['msg_nbytes'],), np.uint8)
+        dct = json.loads(buf.tobytes().decode('utf-8'))
+    return (dct, fds)
+
+
+def get_peer_creds(sock):
+    """Returns the (pid, uid, gid) of the process at the other end of a
+    Unix socket.
+    """
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)
+
+
+def can_read_dir(uid, gid, path):
+    """Returns True if user `uid` (primary group `gid`) can list and read
+    files in directory `path`.
+    """
+    if uid == 0:
+        return True
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if st.st_uid == uid:
+        mask = stat.S_IRUSR | stat.S_IXUSR
+    else:
+        try:
+            groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+        except KeyError:
+            groups = [gid]
+        if st.st_gid in groups:
+            mask = stat.S_IRGRP | stat.S_IXGRP
+        else:
+            mask = stat.S_IROTH | stat.S_IXOTH
+    return (st.st_mode & mask) == mask
+
+
+def make_shared_buffer(name, data):
+    """Copy `data` into a new memfd, sealed against further changes, and
+    return the file descriptor.  The buffer holds the array in native
+    byte order.
+    """
+    flags = os.MFD_CLOEXEC | getattr(os, 'MFD_ALLOW_SEALING', 0)
+    fd = os.memfd_create(name, flags)
+    try:
+        nbytes = max(1, data.nbytes)
+        os.ftruncate(fd, nbytes)
+        with mmap.mmap(fd, nbytes) as mm:
+            arr = np.ndarray(data.shape, dtype=data.dtype.newbyteorder('='),
+                             buffer=mm)
+            arr[...] = data
+            del arr
+        if hasattr(fcntl, 'F_ADD_SEALS'):
+            # subscribers get a read-only view, whatever they try
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS,
+                        fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SHRINK |
+                        fcntl.F_SEAL_GROW | fcntl.F_SEAL_SEAL)
+        return fd
+
+    except Exception:
+        os.close(fd)
+        raise
+
+
+def map_shared_buffer(fd, shape, dtype):
+    """Map a buffer made by `make_shared_buffer` read-only as a numpy
+    array.  The file descriptor is closed; the mapping lives as long as
+    the array.
+    """
+    try:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        mm = mmap.mmap(fd, max(1, nbytes), prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    return np.frombuffer(mm, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class Subscriber:
+    """A connected session, as seen by the daemon.
+
+    Messages are sent by a thread of its own, from a queue of at most
+    `queue_len` messages, so that a slow session does not hold up the
+    decode workers or the other sessions.  A session that falls further
+    behind than that is dropped.
+    """
+
+    def __init__(self, sock, logger, queue_len=16):
+        self.sock = sock
+        self.logger = logger
+        self.pid, self.uid, self.gid = get_peer_creds(sock)
+        self.data_dirs = set()
+        self.lock = threading.RLock()
+        self.closed = False
+        # of (dict, fds)
+        self.send_queue = Queue.Queue(maxsize=queue_len)
+        self.num_sent = 0
+
+    def start(self):
+        thr = threading.Thread(target=self.send_loop, daemon=True)
+        thr.start()
+
+    def send(self, dct, fds=[]):
+        """Queue `dct` to be sent, along with duplicates of the file
+        descriptors in `fds`.  Returns False if the session is closed or
+        has fallen too far behind, in which case it is closed.
+        """
+        if self.closed:
+            return False
+        fds = [os.dup(fd) for fd in fds]
+        try:
+            self.send_queue.put_nowait((dct, fds))
+            return True
+
+        except Queue.Full:
+            for fd in fds:
+                os.close(fd)
+            self.logger.warning("{} is {} messages behind; dropping "
+                                "connection".format(self, self.send_queue.qsize()))
+            self.close()
+            return False
+
+    def send_loop(self):
+        while True:
+            try:
+                dct, fds = self.send_queue.get(block=True, timeout=1.0)
+            except Queue.Empty:
+                if self.closed:
+                    break
+                continue
+
+            try:
+                if not self.closed:
+                    send_msg(self.sock, dct, fds=fds)
+                    self.num_sent += 1
+
+            except Exception as e:
+                if not self.closed:
+                    self.logger.warning("dropping connection {}: {}".format(
+                        self, e))
+                    self.close()
+
+            finally:
+                # the session holds its own descriptors now
+                for fd in fds:
+                    os.close(fd)
+
+    def close(self):
+        """Close the connection.  Messages still queued are discarded by
+        the send thread.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                # wakes up the client_loop waiting on the socket
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def __str__(self):
+        return 'pid={} uid={}'.format(self.pid, self.uid)
+
+
+class IngestDaemon:
+
+    def __init__(self, logger, ev_quit, sockpath=default_socket,
+                 num_workers=2, settle_sec=0.25, tile_threads=0,
+                 header_only_inscodes=['HSC', 'SUP'], send_timeout=5.0,
+                 send_queue_len=16):
+        self.logger = logger
+        self.ev_quit = ev_quit
+        self.sockpath = sockpath
+        self.num_workers = num_workers
+        self.tile_threads = tile_threads
+        self.header_only_inscodes = set(header_only_inscodes)
+        self.send_timeout = send_timeout
+        self.send_queue_len = send_queue_len
+
+        self.lock = threading.RLock()
+        # data_dir -> set of Subscribers
+        self.subscribers = {}
+        # watches to add/remove, processed by the watch thread
+        self.watch_ops = Queue.Queue()
+        self.coalescer = ingest.EventCoalescer(window=settle_sec)
+        self.queue = Queue.Queue()
+        self.worker_stats = ingest.WorkerStats(num_workers)
+        self.num_published = 0
+
+        self.sock = None
+        self.threads = []
+
+    def start(self):
+        if not have_inotify:
+            raise IngestDaemonError("'inotify' package needs to be installed")
+
+        dirpath = os.path.dirname(self.sockpath)
+        if len(dirpath) > 0 and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        if os.path.exists(self.sockpath):
+            os.remove(self.sockpath)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.sockpath)
+        # anyone may connect; subscriptions are checked against the
+        # permissions of the data directory
+        os.chmod(self.sockpath, 0o666)
+        self.sock.listen(16)
+        self.sock.settimeout(1.0)
+
+        self._start_thread(self.accept_loop)
+        self._start_thread(self.watch_loop)
+        for idx in range(self.num_workers):
+            self._start_thread(self.decode_loop, idx)
+        self.logger.info("ingest daemon listening on {}".format(self.sockpath))
+
+    def _start_thread(self, fn, *args):
+        thr = threading.Thread(target=fn, args=args, daemon=True)
+        thr.start()
+        self.threads.append(thr)
+
+    def stop(self):
+        self.ev_quit.set()
+        for thr in self.threads:
+            thr.join()
+        self.sock.close()
+        try:
+            os.remove(self.sockpath)
+        except OSError:
+            pass
+        with self.lock:
+            for sub_set in self.subscribers.values():
+                for sub in sub_set:
+                    sub.close()
+        self.logger.info("inotify events: {}".format(
+            self.coalescer.get_stats()))
+        for dct in self.worker_stats.get_stats():
+            self.logger.info("decode worker {worker}: {count} files, "
+                             "busy {busy_sec:.3f} sec, "
+                             "utilization {utilization:.1%}".format(**dct))
+        self.logger.info("ingest daemon stopped.")
+
+    def accept_loop(self):
+        while not self.ev_quit.is_set():
+            try:
+                sock, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(self.send_timeout)
+            sub = Subscriber(sock, self.logger, queue_len=self.send_queue_len)
+            sub.start()
+            self.logger.info("connection from {}".format(sub))
+            self._start_thread(self.client_loop, sub)
+
+    def client_loop(self, sub):
+        """Handle requests from one session."""
+        try:
+            while not self.ev_quit.is_set():
+                try:
+                    dct, fds = recv_msg(sub.sock, max_fds=0)
+                except socket.timeout:
+                    continue
+                if dct is None:
+                    break
+                try:
+                    self.handle_request(sub, dct)
+                    sub.send(dict(event='ok', cmd=dct.get('cmd', None)))
+
+                except Exception as e:
+                    self.logger.warning("request from {} failed: {}".format(
+                        sub, e))
+                    sub.send(dict(event='error', cmd=dct.get('cmd', None),
+                                  errmsg=str(e)))
+
+        except Exception as e:
+            if not sub.closed:
+                self.logger.warning("dropping connection {}: {}".format(
+                    sub, e))
+
+        finally:
+            self.remove_subscriber(sub)
+
+    def handle_request(self, sub, dct):
+        cmd = dct.get('cmd', None)
+        if cmd == 'subscribe':
+            data_dir = os.path.realpath(dct['data_dir'])
+            if not can_read_dir(sub.uid, sub.gid, data_dir):
+                raise IngestDaemonError("permission denied for {}".format(
+                    data_dir))
+            with self.lock:
+                sub_set = self.subscribers.setdefault(data_dir, set())
+                if len(sub_set) == 0:
+                    self.watch_ops.put(('add', data_dir))
+                sub_set.add(sub)
+                sub.data_dirs.add(data_dir)
+            self.logger.info("{} subscribed to {}".format(sub, data_dir))
+
+        elif cmd == 'unsubscribe':
+            data_dir = os.path.realpath(dct['data_dir'])
+            self.unsubscribe(sub, data_dir)
+
+        else:
+            raise IngestDaemonError("unknown command '{}'".format(cmd))
+
+    def unsubscribe(self, sub, data_dir):
+        with self.lock:
+            sub_set = self.subscribers.get(data_dir, set())
+            sub_set.discard(sub)
+            sub.data_dirs.discard(data_dir)
+            if len(sub_set) == 0 and data_dir in self.subscribers:
+                del self.subscribers[data_dir]
+                self.watch_ops.put(('remove', data_dir))
+
+    def remove_subscriber(self, sub):
+        for data_dir in list(sub.data_dirs):
+            self.unsubscribe(sub, data_dir)
+        sub.close()
+        self.logger.info("connection {} closed".format(sub))
+
+    def watch_loop(self):
+        block_sec = min(1.0, max(0.05, self.coalescer.window / 2.0))
+        i = inotify.adapters.Inotify(block_duration_s=block_sec)
+
+        for event in i.event_gen(yield_nones=True):
+            if self.ev_quit.is_set():
+                break
+
+            # add or remove watches as sessions come and go
+            while not self.watch_ops.empty():
+                op, data_dir = self.watch_ops.get()
+                try:
+                    if op == 'add':
+                        i.add_watch(data_dir)
+                    else:
+                        i.remove_watch(data_dir)
+                    self.logger.info("{} watch on {}".format(op, data_dir))
+                except Exception as e:
+                    self.logger.error("failed to {} watch on {}: {}".format(
+                        op, data_dir, e))
+
+            if event is not None:
+                (header, type_names, watch_path, filename) = event
+                filepath = os.path.join(watch_path, filename)
+                if ('IN_MOVED_TO' in type_names or
+                    'IN_CLOSE_WRITE' in type_names):
+                    self.coalescer.add(filepath, data_dir=watch_path)
+
+                elif ('IN_MOVED_FROM' in type_names or
+                      'IN_DELETE' in type_names):
+                    self.coalescer.discard(filepath)
+                    self.publish_removed(watch_path, filepath)
+
+            for bnch in self.coalescer.get_ready():
+                self.queue.put(bnch)
+
+    def decode_loop(self, idx):
+        while not self.ev_quit.is_set():
+            try:
+                bnch = self.queue.get(block=True, timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            time_start = time.time()
+            try:
+                self.publish_file(bnch)
+
+            except Exception as e:
+                self.logger.error("Error ingesting '{}': {}".format(
+                    bnch.filepath, e), exc_info=True)
+
+            finally:
+                self.worker_stats.record(idx, time.time() - time_start)
+
+    def publish_file(self, bnch):
+        with self.lock:
+            subs = list(self.subscribers.get(bnch.data_dir, set()))
+        if len(subs) == 0:
+            return
+
+        try:
+            frame = Frame(path=bnch.filepath)
+        except ValueError:
+            # not a Subaru frame
+            return
+
+        frameid = str(frame)
+        msg = dict(event='frame', filepath=bnch.filepath, frameid=frameid,
+                   time_event=bnch.time_event, shape=None, dtype=None,
+                   idx=0)
+
+        fd = None
+        if frame.inscode in self.header_only_inscodes:
+            header = fitsutil.read_header(bnch.filepath)
+        else:
+            res = fitsutil.read_image(bnch.filepath,
+                                      tile_threads=self.tile_threads)
+            if res is None:
+                header = fitsutil.read_header(bnch.filepath)
+            else:
+                data, header, idx = res
+                fd = make_shared_buffer(frameid, data)
+                msg.update(shape=list(data.shape),
+                           dtype=data.dtype.newbyteorder('=').str, idx=idx)
+        msg['header'] = header.tostring()
+
+        try:
+            for sub in subs:
+                # NOTE: only queued here; see Subscriber
+                sub.send(msg, fds=[] if fd is None else [fd])
+        finally:
+            # subscribers hold duplicates of the descriptor
+            if fd is not None:
+                os.close(fd)
+
+        self.num_published += 1
+        self.logger.debug("published {} to {} sessions".format(
+            frameid, len(subs)))
+
+
+    def publish_removed(self, data_dir, filepath):
+        with self.lock:
+            subs = list(self.subscribers.get(data_dir, set()))
+        msg = dict(event='removed', filepath=filepath)
+        for sub in subs:
+            sub.send(msg)
+
+
+class IngestClient:
+    """Session side of the connection to an `IngestDaemon`."""
+
+    def __init__(self, sockpath, logger, timeout=1.0):
+        self.logger = logger
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.connect(sockpath)
+        self.sock.settimeout(timeout)
+
+    def subscribe(self, data_dir):
+        send_msg(self.sock, dict(cmd='subscribe', data_dir=data_dir))
+
+    def get_event(self):
+        """Wait for the next frame-arrival or removal event.  Returns a
+        Bunch, or None on a timeout.  Its `event` is 'frame' or
+        'removed', and `filepath` the file.  A frame-arrival event also
+        has the frame info, the header (an `astropy.io.fits.Header`) and
+        the pixel data (a read-only numpy array, or None if the daemon
+        only read the header).
+        """
+        while True:
+            try:
+                dct, fds = recv_msg(self.sock)
+            except socket.timeout:
+                return None
+            if dct is None:
+                raise IngestDaemonError("ingest daemon closed connection")
+
+            event = dct.get('event', None)
+            if event == 'error':
+                for fd in fds:
+                    os.close(fd)
+                raise IngestDaemonError(dct.get('errmsg', 'unknown error'))
+
+            elif event != 'frame':
+                for fd in fds:
+                    os.close(fd)
+                if event == 'removed':
+                    return Bunch.Bunch(event=event, filepath=dct['filepath'])
+                continue
+
+            data = None
+            if len(fds) > 0:
+                data = map_shared_buffer(fds[0], tuple(dct['shape']),
+                                         dct['dtype'])
+                for fd in fds[1:]:
+                    os.close(fd)
+            header = fits.Header.fromstring(dct['header'])
+            return Bunch.Bunch(event=event, filepath=dct['filepath'],
+                               frameid=dct['frameid'],
+                               time_event=dct['time_event'],
+                               header=header, data=data, idx=dct['idx'])
+
+    def close(self):
+        self.sock.close()
+
+
+def main(options, args):
+
+    logger = ssdlog.make_logger('ana_ingestd', options)
+
+    ev_quit = threading.Event()
+    header_only = [s.strip().upper() for s in options.header_only.split(',')
+                   if len(s.strip()) > 0]
+    daemon = IngestDaemon(logger, ev_quit, sockpath=options.sockpath,
+                          num_workers=options.workers,
+                          settle_sec=options.settle,
+                          tile_threads=options.tile_threads,
+                          header_only_inscodes=header_only,
+                          send_queue_len=options.send_queue_len)
+    daemon.start()
+
+    try:
+        while not ev_quit.is_set():
+            ev_quit.wait(1.0)
+
+    except KeyboardInterrupt:
+        logger.error("Caught keyboard interrupt!")
+
+    finally:
+        daemon.stop()
+
+# END
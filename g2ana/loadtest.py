@@ -0,0 +1,400 @@
+#
+# loadtest.py -- load test of the ANA ingest path with synthetic frames
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Load test of the ANA ingest path.  Synthetic FITS files with Subaru
+frame ids are written into a data directory at a given rate, while an
+ingest engine watches that directory and decodes the files the way the
+ANA plugin does, without a GUI or any Gen2 services.  At the end,
+throughput, latency per instrument/channel and memory use are reported.
+
+The frame mix is given as a comma separated list of KIND[:WEIGHT],
+where KIND is one of:
+
+- FCS: a FOCAS exposure (a pair of frames, DET-ID 1 and 2)
+- MCS: a MOIRCS exposure (a pair of frames, DET-ID 1 and 2)
+- IRC: an IRCS frame
+- PFSA, PFSB: a PFS exposure (one frame per spectrograph and arm)
+
+Typical usage:
+
+# 10 minutes of a FOCAS/IRCS mix, one exposure every 2 sec, half of the
+# files tile-compressed and a quarter written in place
+$ ana_loadtest --stderr --mix=FCS:2,IRC:1 --interval=2 --duration=600 \
+    --fz=0.5 --inplace=0.25
+
+# PFS at quarter size, with 4 decode workers and the asyncio engine
+$ ana_loadtest --stderr --mix=PFSA --scale=0.25 --workers=4 --engine=asyncio
+"""
+import os
+import time
+import shutil
+import random
+import tempfile
+import resource
+import threading
+
+import numpy as np
+from astropy.io import fits
+
+from g2base import ssdlog
+import g2cam.INS as INSconfig
+
+from g2ana import ingest, engine, routing, cache, decoder
+
+# frame kind -> list of (shape, dtype, DET-ID or None, number suffix)
+# for the files of one exposure
+exposures = dict(
+    FCS=[((4224, 2272), np.uint16, 1, None),
+         ((4224, 2272), np.uint16, 2, None)],
+    MCS=[((2048, 2048), np.float32, 1, None),
+         ((2048, 2048), np.float32, 2, None)],
+    IRC=[((1024, 1024), np.float32, None, None)],
+    # PFS: frame number ends in spectrograph and arm digits
+    PFSA=[((4300, 4416) if arm != 3 else (4096, 4096),
+           np.uint16 if arm != 3 else np.float32, None,
+           '{}{}'.format(spg, arm))
+          for spg in range(1, 5) for arm in (1, 2, 3)],
+)
+exposures['PFSB'] = exposures['PFSA']
+
+
+class FrameWriter:
+    """Write the files of synthetic exposures into `data_dir`."""
+
+    def __init__(self, data_dir, logger, scale=1.0, fz_fraction=0.0,
+                 inplace_fraction=0.0, seed=0):
+        self.data_dir = data_dir
+        self.logger = logger
+        self.scale = scale
+        self.fz_fraction = fz_fraction
+        self.inplace_fraction = inplace_fraction
+
+        self.rng = np.random.default_rng(seed)
+        self.random = random.Random(seed)
+        # (shape, dtype) -> pixel data
+        self.templates = {}
+        self.numbers = {}
+        # files are written here first and then renamed into data_dir
+        self.tmp_dir = tempfile.mkdtemp(prefix='ana_loadtest_')
+
+        # filepath -> time it appeared complete in data_dir
+        self.time_written = {}
+        self.num_files = 0
+        self.num_bytes = 0
+
+    def get_template(self, shape, dtype):
+        shape = tuple([max(16, int(n * self.scale)) for n in shape])
+        key = (shape, dtype)
+        data = self.templates.get(key, None)
+        if data is None:
+            ht, wd = shape
+            # sky with a gradient, noise and some stars
+            data = self.rng.normal(1000.0, 15.0, size=shape).astype(np.float32)
+            data += np.linspace(0.0, 50.0, wd, dtype=np.float32)[np.newaxis, :]
+            data += np.linspace(0.0, 20.0, ht, dtype=np.float32)[:, np.newaxis]
+            for i in range(max(1, (ht * wd) // 200000)):
+                y, x = self.rng.integers(0, ht - 8), self.rng.integers(0, wd - 8)
+                data[y:y + 8, x:x + 8] += self.rng.uniform(1.0e3, 2.0e4)
+            data = data.astype(dtype)
+            self.templates[key] = data
+        return data
+
+    def make_header(self, frameid, inscode, det_id):
+        hdr = fits.Header()
+        hdr['FRAMEID'] = frameid
+        hdr['EXP-ID'] = frameid
+        hdr['PROP-ID'] = 'o99999'
+        hdr['OBS-MOD'] = 'IMAG'
+        hdr['DATA-TYP'] = 'OBJECT'
+        hdr['OBJECT'] = 'LOADTEST'
+        hdr['EXPTIME'] = 30.0
+        hdr['UT'] = time.strftime('%H:%M:%S', time.gmtime())
+        hdr['AIRMASS'] = 1.2
+        hdr['RA'] = '12:34:56.789'
+        hdr['DEC'] = '+12:34:56.78'
+        hdr['EQUINOX'] = 2000.0
+        if det_id is not None:
+            hdr['DET-ID'] = det_id
+        hdr['CTYPE1'], hdr['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+        hdr['CRVAL1'], hdr['CRVAL2'] = 188.737, 12.582
+        hdr['CRPIX1'], hdr['CRPIX2'] = 1000.0, 1000.0
+        hdr['CD1_1'], hdr['CD1_2'] = -2.8e-5, 0.0
+        hdr['CD2_1'], hdr['CD2_2'] = 0.0, 2.8e-5
+        return hdr
+
+    def write_exposure(self, kind):
+        """Write the files of one exposure of `kind`.  Returns the list
+        of paths written.
+        """
+        inscode, frametype = kind[:3], kind[3:] or 'A'
+        res = []
+        for shape, dtype, det_id, suffix in exposures[kind]:
+            number = self.numbers.get(kind, 0) + 1
+            self.numbers[kind] = number
+            if suffix is None:
+                frameid = '{}{}{:08d}'.format(inscode, frametype, number)
+            else:
+                # a visit is shared by all spectrographs and arms
+                visit = (number - 1) // len(exposures[kind]) + 1
+                frameid = '{}{}{:06d}{}'.format(inscode, frametype, visit,
+                                                suffix)
+            res.append(self.write_frame(frameid, inscode, det_id,
+                                        self.get_template(shape, dtype)))
+        return res
+
+    def write_frame(self, frameid, inscode, det_id, data):
+        header = self.make_header(frameid, inscode, det_id)
+        compress = self.random.random() < self.fz_fraction
+        filename = frameid + ('.fits.fz' if compress else '.fits')
+        filepath = os.path.join(self.data_dir, filename)
+
+        if compress:
+            hdulist = fits.HDUList([fits.PrimaryHDU(),
+                                    fits.CompImageHDU(data, header=header,
+                                                      compression_type='RICE_1')])
+        else:
+            hdulist = fits.HDUList([fits.PrimaryHDU(data, header=header)])
+
+        if self.random.random() < self.inplace_fraction:
+            # written directly, so the file is visible while incomplete
+            hdulist.writeto(filepath, overwrite=True)
+        else:
+            # written elsewhere and moved in, as the archiver does
+            tmppath = os.path.join(self.tmp_dir, filename)
+            hdulist.writeto(tmppath, overwrite=True)
+            os.rename(tmppath, filepath)
+
+        self.time_written[filepath] = time.time()
+        self.num_files += 1
+        self.num_bytes += os.path.getsize(filepath)
+        return filepath
+
+    def cleanup(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class LoadTestClient:
+    """Ingest engine client that decodes files the way the ANA plugin
+    does, with the same `decoder.FrameDecoder`, but keeps the results
+    instead of displaying them.
+    """
+
+    def __init__(self, queue, gate, logger, tile_threads=0, use_mmap=False,
+                 decode_cache=None, header_only_inscodes=()):
+        self.queue = queue
+        self.gate = gate
+        self.logger = logger
+
+        self.routes = routing.RoutingTable(INSconfig.INSdata(), logger=logger)
+        self.decoder = decoder.FrameDecoder(
+            self.routes, gate, logger,
+            header_only_inscodes=header_only_inscodes, use_mmap=use_mmap,
+            tile_threads=tile_threads, decode_cache=decode_cache)
+        self.timings = ingest.IngestTimings(maxlen=100000)
+        # chname -> last image, as in a channel with numImages=1
+        self.channels = {}
+
+        self.cond = threading.Condition()
+        self.num_delivered = 0
+        self.num_errors = 0
+        self.num_dropped = 0
+        self.max_rss = 0
+
+    def index_dir(self, path):
+        pass
+
+    def file_added(self, filepath):
+        pass
+
+    def file_removed(self, filepath):
+        pass
+
+    def enqueue_file(self, bnch):
+        self.decoder.take_ticket(bnch)
+        self.queue.put(bnch)
+
+    def drop_file(self, bnch):
+        """Called when the full ingest queue drops `bnch`."""
+        self.logger.warning("ingest queue full: dropped '{}'".format(
+            bnch.filepath))
+        # let later images for this channel through
+        self.gate.release(bnch.order_key, bnch.ticket, None)
+        with self.cond:
+            self.num_dropped += 1
+            self.cond.notify_all()
+
+    def process_file(self, bnch, idx):
+        try:
+            info = self.decoder.decode(bnch)
+            if info is None:
+                raise ValueError("not a frame that can be displayed")
+            return info
+
+        except Exception as e:
+            self.logger.error("Error decoding '{}': {}".format(
+                bnch.filepath, e), exc_info=True)
+            with self.cond:
+                self.num_errors += 1
+                self.cond.notify_all()
+            return None
+
+    def deliver(self, results):
+        now = time.time()
+        for info in results:
+            if info.image is not None:
+                self.channels[info.chname] = info.image
+            self.timings.record_frame(info.frameid, info.insname,
+                                      info.chname, info.time_event,
+                                      dequeued=info.time_dequeued,
+                                      decoded=info.time_decoded,
+                                      displayed=now)
+        rss = get_rss()
+        with self.cond:
+            self.num_delivered += len(results)
+            self.max_rss = max(self.max_rss, rss)
+            self.cond.notify_all()
+
+    def get_num_done(self):
+        """Returns the number of files delivered, failed or dropped."""
+        with self.cond:
+            return self.num_delivered + self.num_errors + self.num_dropped
+
+    def wait_done(self, count, timeout):
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.get_num_done() >= count,
+                timeout=timeout)
+
+
+def get_rss():
+    """Returns the current resident set size of this process in bytes."""
+    with open('/proc/self/statm', 'r') as in_f:
+        return int(in_f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_mix(mix):
+    kinds, weights = [], []
+    for item in mix.split(','):
+        kind, _, weight = item.strip().partition(':')
+        kind = kind.upper()
+        if kind not in exposures:
+            raise ValueError("Unknown frame kind '{}' (choose from {})".format(
+                kind, ', '.join(exposures.keys())))
+        kinds.append(kind)
+        weights.append(float(weight) if len(weight) > 0 else 1.0)
+    return kinds, weights
+
+
+def main(options, args):
+
+    logger = ssdlog.make_logger('ana_loadtest', options)
+
+    kinds, weights = parse_mix(options.mix)
+
+    data_dir = options.data_dir
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='ana_loadtest_data_')
+    os.makedirs(data_dir, exist_ok=True)
+
+    decode_cache = None
+    if options.cache_dir is not None:
+        decode_cache = cache.DecodeCache(options.cache_dir,
+                                         int(options.cache_gb * 1024**3),
+                                         logger=logger)
+
+    queue = ingest.IngestQueue(maxsize=options.capacity)
+    gate = ingest.SequenceGate(logger=logger)
+    coalescer = ingest.EventCoalescer(window=options.settle)
+    client = LoadTestClient(queue, gate, logger,
+                            tile_threads=options.tile_threads,
+                            use_mmap=options.mmap, decode_cache=decode_cache)
+    queue.on_drop = client.drop_file
+    if options.engine == 'asyncio':
+        eng = engine.AsyncIngestEngine(client, queue, coalescer, gate, logger,
+                                       num_workers=options.workers,
+                                       batch_sec=options.batch)
+    else:
+        eng = engine.ThreadedIngestEngine(client, queue, coalescer, gate,
+                                          logger, num_workers=options.workers)
+    eng.add_watch(data_dir)
+
+    writer = FrameWriter(data_dir, logger, scale=options.scale,
+                         fz_fraction=options.fz,
+                         inplace_fraction=options.inplace,
+                         seed=options.seed)
+    # make the pixel data up front, so that it does not count against
+    # the writing rate
+    for kind in kinds:
+        for shape, dtype, det_id, suffix in exposures[kind]:
+            writer.get_template(shape, dtype)
+    rss_start = get_rss()
+
+    eng.start()
+    time_start = time.time()
+    num_exposures = 0
+    try:
+        while True:
+            now = time.time()
+            if now - time_start >= options.duration:
+                break
+            if options.count > 0 and num_exposures >= options.count:
+                break
+            kind = writer.random.choices(kinds, weights=weights)[0]
+            writer.write_exposure(kind)
+            num_exposures += 1
+            # keep the requested rate, unless writing is slower than that
+            time_next = time_start + num_exposures * options.interval
+            time.sleep(max(0.0, time_next - time.time()))
+        time_written = time.time()
+
+        if not client.wait_done(writer.num_files, options.timeout):
+            logger.error("timed out: {} of {} files processed".format(
+                client.get_num_done(), writer.num_files))
+        time_end = time.time()
+
+    finally:
+        eng.stop()
+        writer.cleanup()
+        if options.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    elapsed = time_end - time_start
+    print("wrote {} exposures, {} files, {:.1f} MB in {:.1f} sec".format(
+        num_exposures, writer.num_files, writer.num_bytes / 1024**2,
+        time_written - time_start))
+    print("processed {} files ({} errors, {} dropped) in {:.1f} sec: "
+          "{:.2f} files/sec, {:.1f} MB/sec".format(
+              client.num_delivered, client.num_errors, client.num_dropped,
+              elapsed, client.num_delivered / elapsed,
+              writer.num_bytes / 1024**2 / elapsed))
+    print("memory: RSS {:.1f} MB before start, {:.1f} MB peak while "
+          "ingesting, {:.1f} MB max for the process".format(
+              rss_start / 1024**2, client.max_rss / 1024**2,
+              # NOTE: ru_maxrss is in kB on Linux
+              resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    print("queue: {}".format(queue.get_stats()))
+    print("engine: {}".format(eng.get_stats()))
+    if decode_cache is not None:
+        print("cache: {}".format(decode_cache.get_stats()))
+
+    print("")
+    print("latency from arrival (sec)")
+    print("{:>10s} {:>12s} {:>10s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s}".format(
+        'instrument', 'channel', 'stage', 'n', 'p50', 'p95', 'p99', 'max'))
+    for insname, ch_dct in client.timings.get_stats().items():
+        for chname, stage_dct in ch_dct.items():
+            for stage in client.timings.stages:
+                dct = stage_dct.get(stage, None)
+                if dct is None or dct['count'] == 0:
+                    continue
+                print("{:>10s} {:>12s} {:>10s} {:6d} {:8.3f} {:8.3f} "
+                      "{:8.3f} {:8.3f}".format(
+                          insname, chname, stage, dct['count'],
+                          dct['p50_sec'], dct['p95_sec'], dct['p99_sec'],
+                          dct['max_sec']))
+
+# END
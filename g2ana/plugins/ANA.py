@@ -6,18 +6,16 @@
 # E. Jeschke
 #
 import os, pwd
+import inspect
 import fcntl
 import select
 import re, time
 import errno
-import queue as Queue
-
-import numpy as np
 
 from ginga import GingaPlugin
 from ginga import AstroImage
 from ginga.misc import Bunch, Future
-from ginga.util import loader, paths
+from ginga.util import paths
 
 # g2cam imports
 from g2base.remoteObjects import remoteObjects as ro
@@ -26,16 +24,16 @@ from g2base.remoteObjects import Monitor
 from g2base.astro.frame import Frame
 import g2cam.INS as INSconfig
 
-have_inotify = False
-try:
-    import inotify.adapters
-    have_inotify = True
-except ImportError:
-    pass
+from g2ana import (ingest, ingestd, routing, engine, cache, publish,
+                   scheduler, rpcdata, imstats, decoder)
 
 homedir = paths.home
 propid_file = os.path.join(homedir, '.ana_propid')
 
+# commands that are carried out by a local plugin
+command_plugins = dict(confirmation='Ana_Confirmation',
+                       userinput='Ana_UserInput')
+
 class AnaError(Exception):
     pass
 
@@ -77,10 +75,93 @@ class ANA(GingaPlugin.GlobalPlugin):
         # construct our service name
         self.svcname = "ANA-{}-{}".format(self.propid, self.host)
 
+        prefs = self.fv.get_preferences()
+        self.settings = prefs.create_category('plugin_ANA')
+        self.settings.add_defaults(coalesce_window_sec=0.25,
+                                   num_decode_workers=1,
+                                   latest_wins=False,
+                                   header_only_inscodes=['HSC', 'SUP'],
+                                   use_mmap=False,
+                                   tile_decompress_threads=0,
+                                   ingest_daemon_socket=None,
+                                   queue_capacity=500,
+                                   queue_drop_policy='oldest',
+                                   precreate_instruments=[],
+                                   ingest_engine='threads',
+                                   gui_batch_sec=0.05,
+                                   progressive_preview=False,
+                                   preview_factor=4,
+                                   preview_method='stride',
+                                   preview_min_bytes=64 * 1024 * 1024,
+                                   decode_cache_dir=None,
+                                   decode_cache_max_gb=20.0,
+                                   publish_batch_sec=0.05,
+                                   publish_batch_max_tags=100,
+                                   command_timeout_sec=None,
+                                   max_reserved_buffers=4)
+        self.settings.load(onError='silent')
+
         # for looking up instrument names
         self.insconfig = INSconfig.INSdata()
-        self.queue = Queue.Queue()
-        self.pfs_arm_dct = {'1': 'B', '2': 'R', '3': 'N', '4': 'R'}
+        # maps frames to the channel and workspace they are shown in
+        self.routes = routing.RoutingTable(self.insconfig, logger=self.logger)
+        # channels we know to exist; used to avoid round trips to the
+        # GUI thread when routing a frame
+        self.known_channels = set()
+        # frame id -> path of files in our data directory
+        self.frame_index = ingest.FrameIndex(logger=self.logger)
+        fv.add_callback('delete-channel', self.delete_channel_cb)
+        # files waiting to be decoded
+        self.queue = ingest.IngestQueue(
+            maxsize=self.settings.get('queue_capacity', 0),
+            policy=self.settings.get('queue_drop_policy', 'oldest'),
+            on_drop=self.drop_file)
+        # merges repeated inotify events for the same file
+        self.coalescer = ingest.EventCoalescer(
+            window=self.settings.get('coalesce_window_sec', 0.25))
+        # keeps images for the same channel displayed in arrival order
+        # when they are decoded by several workers
+        self.gate = ingest.SequenceGate(logger=self.logger)
+        self.num_workers = max(1, self.settings.get('num_decode_workers', 1))
+        self.worker_stats = ingest.WorkerStats(self.num_workers)
+        # time from a user asking for a frame until it is displayed
+        self.interactive_latency = ingest.LatencyStats()
+        # time from a frame arriving until each stage of its ingest
+        self.timings = ingest.IngestTimings()
+        # keep decoded compressed files on local disk, so that revisiting
+        # a frame does not mean decompressing it again
+        self.decode_cache = None
+        cache_dir = self.settings.get('decode_cache_dir', None)
+        if cache_dir is not None:
+            max_bytes = int(self.settings.get('decode_cache_max_gb', 20.0) * 1024**3)
+            self.decode_cache = cache.DecodeCache(os.path.expanduser(cache_dir),
+                                                  max_bytes, logger=self.logger)
+        # decodes queued files and routes them to channels (see the
+        # decoder module for the settings)
+        self.decoder = decoder.FrameDecoder(
+            self.routes, self.gate, self.logger,
+            latest_wins=self.settings.get('latest_wins', False),
+            header_only_inscodes=self.settings.get('header_only_inscodes', []),
+            use_mmap=self.settings.get('use_mmap', False),
+            tile_threads=self.settings.get('tile_decompress_threads', 0),
+            decode_cache=self.decode_cache,
+            progressive=self.settings.get('progressive_preview', False),
+            preview_factor=self.settings.get('preview_factor', 4),
+            preview_method=self.settings.get('preview_method', 'stride'),
+            preview_min_bytes=self.settings.get('preview_min_bytes', 0),
+            max_reserved_buffers=self.settings.get('max_reserved_buffers', 4),
+            route_cb=self.ensure_channel, preview_cb=self.show_preview)
+        # frames queued to be prefetched into the decode cache
+        self.prefetch_pending = set()
+        self.num_prefetched = 0
+        # timers of sleep commands in progress, by tag
+        self.sleep_timers = {}
+        # how late sleep commands complete, beyond the time asked for
+        self.sleep_lateness = ingest.LatencyStats()
+        # statistics computed on loaded images, for get_image_stats
+        self.image_stats = imstats.StatsCache()
+        # frames Gen2 told us are coming
+        self.num_expected = 0
 
         self.data_dir = os.path.join('/data', self.propid)
 
@@ -96,11 +177,29 @@ class ANA(GingaPlugin.GlobalPlugin):
         self.monitor = Monitor.Monitor(mymonname, self.logger,
                                        threadPool=threadPool,
                                        ev_quit=self.fv.ev_quit)
+        # command results are published in batches
+        self.publisher = publish.PublishBatcher(
+            self.publish_result,
+            window_sec=self.settings.get('publish_batch_sec', 0.05),
+            max_tags=self.settings.get('publish_batch_max_tags', 100),
+            logger=self.logger)
+        # commands for the same instrument run one at a time
+        self.scheduler = scheduler.CommandScheduler(self.start_command,
+                                                    self.cancel_command_cb,
+                                                    logger=self.logger)
 
         # some of the other plugins expect this handle to be available
         # via fv
         self.fv.controller = self
 
+        # header-only results are announced to other plugins (e.g. ObsLog)
+        # via this callback; signature is cb(fv, chname, header, info)
+        self.fv.enable_callback('ana-add-header')
+        # the ObsLog tells us when it has logged a frame; signature is
+        # cb(fv, frameid)
+        self.fv.enable_callback('obslog-add-row')
+        self.fv.add_callback('obslog-add-row', self.obslog_add_row_cb)
+
     def start(self):
         self.logger.info("starting ANA plugin for propid: {}".format(self.propid))
 
@@ -116,11 +215,15 @@ class ANA(GingaPlugin.GlobalPlugin):
         #self.monitor.subscribe_remote(self.monitor_name, self.channels, {})
         # publishing for remote command executions
         self.monitor.publish_to('monitor', ['g2task'], {})
+        self.publisher.start()
 
         # Create our remote service object
         threadPool = self.fv.get_threadPool()
         # methods that can be called from outside via our service
-        method_list = ['callGlobalPlugin2']
+        method_list = ['callGlobalPlugin2', 'cancel_command',
+                       'set_command_timeout', 'get_command_stats',
+                       'get_image_stats', 'expect_frames',
+                       'get_ingest_stats', 'dump_ingest_stats']
         self.viewsvc = ro.remoteObjectServer(svcname=self.svcname,
                                              obj=self,
                                              logger=self.logger,
@@ -133,71 +236,255 @@ class ANA(GingaPlugin.GlobalPlugin):
         self.logger.info("starting ANA service on port {}".format(self.port))
         self.viewsvc.ro_start()
 
-        if not have_inotify:
+        # create channels we expect to use in one go, rather than as
+        # the first frame for each arrives
+        self.fv.gui_do(self.precreate_channels,
+                       self.settings.get('precreate_instruments', []))
+
+        # the engine watches for files and runs the decode workers
+        if self.settings.get('ingest_engine', 'threads') == 'asyncio':
+            self.engine = engine.AsyncIngestEngine(
+                self, self.queue, self.coalescer, self.gate, self.logger,
+                num_workers=self.num_workers,
+                batch_sec=self.settings.get('gui_batch_sec', 0.05))
+        else:
+            self.engine = engine.ThreadedIngestEngine(
+                self, self.queue, self.coalescer, self.gate, self.logger,
+                num_workers=self.num_workers)
+
+        if self.settings.get('ingest_daemon_socket', None) is not None:
+            # a shared ingest daemon watches the data directory for us
+            self.fv.nongui_do(self.daemon_client_loop, self.fv.ev_quit)
+        elif not engine.have_inotify:
             self.logger.warning("'inotify' package needs to be installed to "
                                 "monitor for files to be loaded")
         else:
-            self.fv.nongui_do(self.watch_loop, self.fv.ev_quit)
+            self.engine.add_watch(self.data_dir)
 
-        self.fv.nongui_do(self.load_images_loop, self.fv.ev_quit)
+        self.engine.start()
         self.logger.info("ANA plugin started.")
 
     def stop(self):
         self.logger.info("ANA plugin shutting down...")
         self.viewsvc.ro_stop(wait=True)
         #self.monitor.stop_server(wait=True)
+        self.scheduler.stop()
+        self.publisher.stop()
         self.monitor.stop(wait=True)
+        self.engine.stop()
+        for timer in list(self.sleep_timers.values()):
+            timer.stop()
+        self.report_ingest_stats()
         self.logger.info("ANA plugin stopped.")
 
+    def report_ingest_stats(self):
+        self.logger.info("inotify events: {}".format(
+            self.coalescer.get_stats()))
+        self.logger.info("routing table: {}".format(self.routes.get_stats()))
+        self.logger.info("ingest queue: {}".format(self.queue.get_stats()))
+        self.logger.info("ingest engine: {}".format(self.engine.get_stats()))
+        if self.decode_cache is not None:
+            self.logger.info("decode cache: {} ({} prefetched)".format(
+                self.decode_cache.get_stats(), self.num_prefetched))
+        self.logger.info("decoder: {}".format(self.decoder.get_stats()))
+        self.logger.info("interactive request-to-display latency: {}".format(
+            self.interactive_latency.get_stats()))
+        self.logger.info("commands: {}".format(self.scheduler.get_stats()))
+        self.logger.info("g2task publishing: {}".format(
+            self.publisher.get_stats()))
+        self.logger.info("sleep command lateness: {}".format(
+            self.format_latency(self.sleep_lateness.get_stats())))
+        for dct in self.worker_stats.get_stats():
+            self.logger.info("decode worker {worker}: {count} files, "
+                             "busy {busy_sec:.3f} sec, "
+                             "utilization {utilization:.1%}".format(**dct))
+        for insname, ch_dct in self.timings.get_stats().items():
+            for chname, stage_dct in ch_dct.items():
+                for stage in self.timings.stages:
+                    if stage not in stage_dct:
+                        continue
+                    self.logger.info("ingest latency {}/{} {}: {}".format(
+                        insname, chname, stage, self.format_latency(
+                            stage_dct[stage])))
+
+    def format_latency(self, dct):
+        if dct['count'] == 0:
+            return "no samples"
+        return ("n={count} p50={p50_sec:.3f} p95={p95_sec:.3f} "
+                "p99={p99_sec:.3f} max={max_sec:.3f} sec".format(**dct))
+
+    def get_ingest_stats(self):
+        """Returns a dict of ingest statistics.  The 'latency' item is a
+        dict of {insname: {chname: {stage: stats}}} with the time from
+        the arrival of a file to each stage of its ingest (see
+        ingest.IngestTimings).  This method can be called remotely.
+        """
+        res = dict(latency=self.timings.get_stats(),
+                   interactive=self.interactive_latency.get_stats(),
+                   events=self.coalescer.get_stats(),
+                   queue=self.queue.get_stats(),
+                   workers=self.worker_stats.get_stats(),
+                   engine=self.engine.get_stats(),
+                   routing=self.routes.get_stats(),
+                   sleep=self.sleep_lateness.get_stats(),
+                   publish=self.publisher.get_stats(),
+                   decoder=self.decoder.get_stats(),
+                   expected=dict(frames=self.num_expected,
+                                 reserved_used=self.decoder.num_reserved_used))
+        if self.decode_cache is not None:
+            res['cache'] = self.decode_cache.get_stats()
+        return rpcdata.cleanse(res)
+
+    def dump_ingest_stats(self):
+        """Write the ingest statistics to the log.  This method can be
+        called remotely.
+        """
+        self.report_ingest_stats()
+        return ro.OK
+
+    def expect_frames(self, frameids):
+        """Tell ANA about frames that are about to be written, so that
+        the first of them is displayed without delay: the channels they
+        will be shown in are created, their routes are looked up, and
+        if tile-parallel decompression is used, a decode buffer the
+        size of the last image in the channel is reserved.
+
+        Returns a dict with the names of the channels and the number of
+        buffers reserved.  This method can be called remotely.
+        """
+        chnames = []
+        num_reserved = 0
+        for frameid in frameids:
+            try:
+                frame = Frame(path=frameid)
+            except ValueError:
+                self.logger.warning("expected frame '{}' is not a valid "
+                                    "frame id".format(frameid))
+                continue
+            self.num_expected += 1
+
+            routes = self.routes.expect_routes(frame)
+            for route in routes:
+                self.ensure_channel(route)
+                if route.chname not in chnames:
+                    chnames.append(route.chname)
+
+            if (len(routes) == 1 and
+                self.decoder.reserve_buffer(frameid, routes[0].chname)):
+                num_reserved += 1
+
+        self.logger.info("expecting frames {}: channels {}".format(
+            frameids, chnames))
+        return dict(chnames=chnames, reserved=num_reserved)
+
+    def get_image_stats(self, chname, imname=None, boxes=None,
+                        saturation=None):
+        """Compute statistics of an image loaded in channel `chname`:
+        the image named `imname`, or the one shown if None.  `boxes` is
+        None for the whole image, one box (x1, y1, x2, y2) or a list of
+        them (see imstats).  Pixels at or above `saturation` (default:
+        the SATURATE keyword, if any) are counted.
+
+        Returns a dict with the channel and image names and a list of
+        statistics, one per box.  Results are cached per image.  This
+        method can be called remotely; it runs in the service thread,
+        not the GUI thread.
+        """
+        # NOTE: the image is looked up in the GUI thread, the statistics
+        # computed here
+        image = self.fv.gui_call(self.get_loaded_image, chname, imname)
+        if isinstance(image, Exception):
+            raise image
+
+        data = image.get_data()
+        if boxes is None:
+            boxes = [(0, 0, data.shape[1], data.shape[0])]
+        elif len(boxes) > 0 and not isinstance(boxes[0], (list, tuple)):
+            boxes = [boxes]
+        if saturation is None:
+            saturation = image.get_keyword('SATURATE', None)
+
+        stats = self.image_stats.get_stats(image, data, boxes,
+                                           saturation=saturation)
+        return rpcdata.cleanse(dict(chname=chname, imname=image.get('name'),
+                                    stats=stats))
+
+    def get_loaded_image(self, chname, imname=None):
+        """Returns the image named `imname` loaded in channel `chname`, or
+        the one shown if None.  Raises AnaError if there is none, or only
+        a preview of it.
+        This method is called from the GUI thread.
+        """
+        if not self.fv.has_channel(chname):
+            raise AnaError("No channel '{}'".format(chname))
+        channel = self.fv.get_channel(chname)
+        if imname is None:
+            image = channel.get_current_image()
+        else:
+            try:
+                image = channel.get_loaded_image(imname)
+            except KeyError:
+                image = None
+        if image is None:
+            raise AnaError("No image '{}' loaded in channel '{}'".format(
+                imname, chname))
+        if image.get('preview', False):
+            raise AnaError("Only a preview of '{}' is loaded".format(
+                image.get('name')))
+        return image
+
     def get_chname(self, fr, header, chname):
         """Determine the channel name from the frame, FITS header and
         default CHNAME.
         """
-        if fr.inscode == 'PFS':
-            if fr.frametype in ('A', 'B'):
-                digits = str(fr.number)
-                # PFS data model: spectrograph indicated by second digit from right,
-                # arm indicated by right-most digit
-                spg, arm = digits[-2], self.pfs_arm_dct[digits[-1]]
-                chname = f"PFS{fr.frametype}_{arm}{spg}"
-            else:
-                chname = fr.inscode + fr.frametype
-
-        elif fr.inscode in ['MCS', 'FCS']:
-            det_id = int(header['DET-ID'])
-            chname = chname + f'_{det_id}'
-
-        return chname
+        return routing.get_chname(fr, header, chname)
 
     def get_wsname(self, chname):
         """Determine the workspace from the CHNAME.
         """
-        wsname = 'channels'     # the default
-        if chname.startswith('PFS'):
-            if chname[3] in ('A', 'B'):
-                # spectrograph indicated by last character of channel name
-                spg = chname[-1]
-                wsname = f"PFS_{spg}"
+        return routing.get_wsname(chname)
 
-        elif chname.startswith('FOCAS'):
-            wsname = 'FOCAS'
-        elif chname.startswith('MOIRCS'):
-            wsname = 'MOIRCS'
+    def ensure_channel(self, route):
+        """Make sure the channel for `route` (see the routing module)
+        exists.  This method is called from a non-GUI thread.
+        """
+        if route.chname in self.known_channels:
+            return
+        if not self.fv.has_channel(route.chname):
+            # create the channel in this workspace
+            self.fv.gui_call(self.create_channel, route)
+        self.known_channels.add(route.chname)
 
-        return wsname
+    def create_channel(self, route):
+        # NOTE: this method is called from the GUI thread
+        if self.fv.has_channel(route.chname):
+            return
+        prefs = self.fv.get_preferences()
+        settings = prefs.create_category(f'channel_{route.chname}')
+        settings.set(**route.settings)
+        self.fv.add_channel(route.chname, settings=settings,
+                            workspace=route.wsname)
+
+    def precreate_channels(self, insnames):
+        """Create all the channels of the instruments in `insnames`,
+        including one per detector for FOCAS and MOIRCS.
+        This method is called from the GUI thread.
+        """
+        for insname in insnames:
+            for route in self.routes.get_instrument_routes(insname):
+                self.create_channel(route)
+                self.known_channels.add(route.chname)
+
+    def delete_channel_cb(self, fv, channel):
+        self.known_channels.discard(channel.name)
 
     def get_operation_chname(self, insname):
         self.fv.assert_gui_thread()
 
         # If this instrument has multiple windows for different detectors
         # choose one of them for the operation channel
-        wsname = self.get_wsname(insname)
-        if wsname in ['FOCAS', 'MOIRCS']:
-            chname = wsname + '_1'
-        elif wsname in ['PFS']:
-            chname = 'PFSA_B1'
-        else:
-            chname = wsname
+        chname = routing.get_operation_chname(insname)
+        wsname = self.get_wsname(chname)
 
         if not self.fv.has_channel(chname):
             # create the channel in this workspace
@@ -209,93 +496,275 @@ class ANA(GingaPlugin.GlobalPlugin):
                                 workspace=wsname)
         return chname
 
-    def load_file(self, filepath):
-        try:
-            frame = Frame(path=filepath)
-        except ValueError:
+    def enqueue_file(self, bnch, priority=ingest.PRIO_LIVE):
+        """Queue a file described by `bnch` for decoding, with request
+        class `priority` (see the ingest module).
+        This method is called from a non-GUI thread.
+        """
+        if priority == ingest.PRIO_INTERACTIVE:
+            # the user is waiting: not ordered with respect to the live
+            # frames, never skipped and never dropped
+            bnch.order_key = None
+            bnch.ticket = None
+            self.queue.put(bnch, priority=priority, droppable=False)
             return
 
-        if frame.inscode in ('HSC', 'SUP'):
-            # Don't display raw HSC, SPCAM
+        if bnch.get('prefetch', False):
+            # nothing is displayed, so no ordering is needed
+            bnch.order_key = None
+            bnch.ticket = None
+            self.queue.put(bnch, priority=priority)
             return
 
-        self.logger.info("loading file {}".format(filepath))
+        self.decoder.take_ticket(bnch)
+        # NOTE: this may block if the queue is full and the drop policy
+        # is 'block'
+        self.queue.put(bnch, priority=priority)
 
-        frameid = str(frame)
-        image = loader.load_file(filepath, logger=self.logger)
-        image.set(name=frameid)
+    def drop_file(self, bnch):
+        """Called when the full ingest queue drops `bnch`."""
+        if bnch.get('prefetch', False):
+            self.prefetch_pending.discard(bnch.filepath)
+            return
+        self.logger.warning("ingest queue full: dropped '{}'".format(
+            bnch.filepath))
+        # let later images for this channel through
+        self.gate.release(bnch.order_key, bnch.ticket, None)
 
-        chname = self.insconfig.getNameByFrameId(frameid)
-        header = image.get_header()
-        chname = self.get_chname(frame, header, chname)
-        wsname = self.get_wsname(chname)
+    def show_preview(self, info, bnch):
+        """Show the preview `info` made by the decoder right away.  It is
+        replaced in the channel by the full image once that is loaded.
 
-        if not self.fv.has_channel(chname):
-            # create the channel in this workspace
-            prefs = self.fv.get_preferences()
-            settings = prefs.create_category(f'channel_{chname}')
-            settings.set(numImages=1, raisenew=False,
-                         focus_indicator=False)
-            self.fv.gui_call(self.fv.add_channel, chname,
-                             settings=settings, workspace=wsname)
+        If `bnch` is given it describes the file in the ingest queue; the
+        preview then goes through the ingest engine, so that it is not
+        shown before frames that arrived earlier, and not at all if the
+        full image is ready first.
 
-        self.fv.gui_do(self.fv.add_image, frameid, image, chname=chname,
-                       wsname=wsname)
-        return chname
+        This method is called from a non-GUI thread.
+        """
+        if bnch is None:
+            self.deliver([info])
+        else:
+            self.engine.deliver_early(bnch, info)
 
-    def load_frame(self, frameid):
-        # See ObsLog plugin for where this method is called
-        filepath = None
-        for suffix in ['.fits', '.fits.fz', '.fits.gz']:
+    def display_image(self, info):
+        """Schedule the decoded image described by `info` to be shown.
+        Header-only results are announced via the 'ana-add-header'
+        callback instead.
+        """
+        self.deliver([info])
+
+    def deliver(self, infos):
+        """Schedule a list of decoded images to be shown, in order.
+        This method can be called from any thread.
+        """
+        self.fv.gui_do(self.show_results, infos)
+
+    def show_results(self, infos):
+        # NOTE: this method is called from the GUI thread
+        for info in infos:
+            try:
+                if info.image is None:
+                    self.record_timings(info)
+                    self.fv.make_callback('ana-add-header', info.chname,
+                                          info.header, info)
+                else:
+                    self.show_image(info)
+
+            except Exception as e:
+                self.logger.error("Error showing '{}': {}".format(
+                    info.filepath, e), exc_info=True)
+
+    def show_image(self, info):
+        """Add a decoded image to its channel.
+        This method is called from the GUI thread.
+        """
+        if not info.image.get('preview', False):
+            self.replace_preview_info(info)
+        self.fv.add_image(info.frameid, info.image,
+                          chname=info.chname, wsname=info.wsname)
+        self.record_timings(info)
+
+        time_request = info.get('time_request', None)
+        if time_request is not None:
+            latency = time.time() - time_request
+            self.interactive_latency.record(latency)
+            self.logger.info("requested frame {} displayed in {:.3f} sec".format(
+                info.frameid, latency))
+
+    def replace_preview_info(self, info):
+        """If a preview of the full image `info` was shown, make the
+        channel's metadata for the image describe the full image instead.
+        Otherwise it would be kept, since both have the same name, and
+        e.g. no thumbnail would be made for the full image.
+        This method is called from the GUI thread.
+        """
+        if not self.fv.has_channel(info.chname):
+            return
+        channel = self.fv.get_channel(info.chname)
+        if info.frameid not in channel:
+            return
+        image_info = channel[info.frameid]
+        image = info.image
+        image_info.nothumb = image.get('nothumb', False)
+        image_info.path = image.get('path', image_info.path)
+        image_info.idx = image.get('idx', image_info.idx)
+
+    def record_timings(self, info):
+        # NOTE: this method is called from the GUI thread
+        if info.get('time_event', None) is None:
+            # not a live arrival (e.g. a preview or a requested frame)
+            return
+        self.timings.record_frame(info.frameid, info.insname, info.chname,
+                                  info.time_event,
+                                  dequeued=info.time_dequeued,
+                                  decoded=info.time_decoded,
+                                  displayed=time.time())
+
+    def obslog_add_row_cb(self, fv, frameid):
+        self.timings.record_stage(frameid, 'logged')
+
+    def load_file(self, filepath):
+        info = self.decoder.decode_file(filepath)
+        if info is None:
+            return None
+
+        self.display_image(info)
+        return info.chname
+
+    def get_frame_path(self, frameid):
+        """Returns the path of the file for frame `frameid` in our data
+        directory, or None if there is no such file.  This can be called
+        by other plugins (e.g. the ObsLog and QL plugins).
+        """
+        filepath = self.frame_index.get_path(frameid)
+        if filepath is not None:
+            return filepath
+
+        # not seen yet (e.g. we are not watching the directory)
+        for suffix in self.frame_index.suffixes:
             path = os.path.join(self.data_dir, frameid + suffix)
             if os.path.exists(path):
-                filepath = path
-                break
-        if filepath is not None:
-            self.fv.nongui_do(self.load_file, filepath)
+                self.frame_index.add(path)
+                return path
+        return None
+
+    def prefetch_frames(self, frameids):
+        """Decode the frames in `frameids` into the decode cache in the
+        background, behind any live or requested frames, so that they
+        can be shown quickly if asked for.  Frames that are already
+        cached, or whose files are not compressed, are skipped.
+        This method is called from a non-GUI thread.
+        """
+        if self.decode_cache is None:
+            return
 
-    def watch_loop(self, ev_quit):
-        self.fv.assert_nongui_thread()
+        for frameid in frameids:
+            filepath = self.get_frame_path(frameid)
+            if (filepath is None or filepath.endswith('.fits') or
+                filepath in self.prefetch_pending or
+                self.decode_cache.contains(frameid, filepath)):
+                continue
 
-        i = inotify.adapters.Inotify()
-        i.add_watch(self.data_dir)
+            self.prefetch_pending.add(filepath)
+            bnch = Bunch.Bunch(filepath=filepath, time_event=time.time(),
+                               frameid=frameid, prefetch=True)
+            self.enqueue_file(bnch, priority=ingest.PRIO_BACKFILL)
 
-        while not ev_quit.is_set():
-            events = list(i.event_gen(yield_nones=False, timeout_s=1.0))
-
-            for event in events:
-                if event is not None:
-                    if ('IN_MOVED_TO' in event[1] or
-                        'IN_CLOSE_WRITE' in event[1]):
-                        (header, type_names, watch_path, filename) = event
-                        filepath = os.path.join(watch_path, filename)
-                        # Make a bunch, because we will probably want to add
-                        # more info in the future
-                        bnch = Bunch.Bunch(filepath=filepath)
-                        self.queue.put(bnch)
-
-        i.remove_watch(self.data_dir)
-
-    def load_images_loop(self, ev_quit):
-        self.logger.info("load images loop starting up...")
+    def load_frame(self, frameid):
+        # See ObsLog plugin for where this method is called
+        filepath = self.get_frame_path(frameid)
+        if filepath is None:
+            self.logger.error("no file found for frame {}".format(frameid))
+            return
+
+        # jump the queue of arriving frames
+        now = time.time()
+        bnch = Bunch.Bunch(filepath=filepath, time_event=now,
+                           time_request=now)
+        self.enqueue_file(bnch, priority=ingest.PRIO_INTERACTIVE)
+
+    #############################################################
+    #    Called from the ingest engine (see g2ana/engine.py)
+    #############################################################
+
+    def index_dir(self, data_dir):
+        time_start = time.time()
+        count = self.frame_index.scan(data_dir)
+        self.logger.info("indexed {} files in {} ({:.3f} sec)".format(
+            count, data_dir, time.time() - time_start))
+
+    def file_added(self, filepath):
+        self.frame_index.add(filepath)
+
+    def file_removed(self, filepath):
+        self.frame_index.remove(filepath)
+
+    def process_file(self, bnch, idx):
+        """Decode the queued file described by `bnch` in decode worker
+        `idx`.  Returns a Bunch as for FrameDecoder.decode(), or None.
+        This method is called from a non-GUI thread.
+        """
+        info = None
+        time_start = time.time()
+        try:
+            if bnch.get('prefetch', False):
+                # only fill the decode cache
+                try:
+                    if not self.decode_cache.contains(bnch.frameid,
+                                                      bnch.filepath):
+                        self.decoder.load_cached(bnch.frameid, bnch.filepath)
+                        self.num_prefetched += 1
+                finally:
+                    self.prefetch_pending.discard(bnch.filepath)
+            else:
+                info = self.decoder.decode(bnch)
+
+        finally:
+            self.worker_stats.record(idx, time.time() - time_start)
+
+        return info
+
+    def daemon_client_loop(self, ev_quit):
+        """Receive frame-arrival events for our data directory from the
+        shared ingest daemon (see g2ana/ingestd.py) and queue them,
+        instead of watching the directory ourselves; removal events
+        update the frame index.  Reconnects if the daemon goes away.
+        """
         self.fv.assert_nongui_thread()
+        sockpath = self.settings.get('ingest_daemon_socket')
 
-        filepath = None
         while not ev_quit.is_set():
+            client = None
             try:
-                bnch = self.queue.get(block=True, timeout=0.1)
-
-                filepath = bnch.filepath
-                self.load_file(filepath)
-
-            except Queue.Empty:
-                continue
+                client = ingestd.IngestClient(sockpath, self.logger)
+                client.subscribe(self.data_dir)
+                self.logger.info("subscribed to ingest daemon at {}".format(
+                    sockpath))
+                self.index_dir(self.data_dir)
+
+                while not ev_quit.is_set():
+                    event = client.get_event()
+                    if event is None:
+                        continue
+                    if event.event == 'removed':
+                        self.file_removed(event.filepath)
+                        continue
+                    self.file_added(event.filepath)
+                    bnch = Bunch.Bunch(filepath=event.filepath,
+                                       time_event=event.time_event,
+                                       event=event)
+                    self.enqueue_file(bnch)
 
             except Exception as e:
-                self.logger.error(f"Error displaying image '{filepath}': {e}",
-                                  exc_info=True)
+                self.logger.error("Error receiving from ingest daemon: {}".format(e))
+
+            finally:
+                if client is not None:
+                    client.close()
 
-        self.logger.info("load images loop terminating...")
+            # wait a bit before trying to reconnect
+            ev_quit.wait(5.0)
 
     #############################################################
     #    Called from Gen2 to deliver a command
@@ -317,25 +786,104 @@ class ANA(GingaPlugin.GlobalPlugin):
                 methodName, pluginName))
         method = getattr(obj, methodName)
 
+        # bind the arguments as the method will get them, so that the
+        # instrument is found however it was passed
+        try:
+            bound = inspect.signature(method).bind(tag, None, *args, **kwdargs)
+        except TypeError as e:
+            raise AnaError("bad arguments for '%s': %s" % (methodName, str(e)))
+        insname = bound.arguments.get('instrument_name', None)
+        # commands whose dialogs share a channel are run one after the
+        # other, those without one (e.g. sleep) right away
+        key = None
+        if insname is not None:
+            key = routing.get_operation_chname(insname)
+
         # Make a future that will be resolved by the GUI thread
-        p = Bunch.Bunch()
+        p = Bunch.Bunch(ana_received=time.time())
         future = Future.Future(data=p)
         #future.freeze(method, *args, **kwdargs)
         newargs = [tag, future]
         newargs.extend(list(args))
         future.add_callback('resolved',
                             lambda f: self.fv.nongui_do(self.result_cb2,
-                                                        future, tag, p))
+                                                        f, tag, p))
+        result_future = future
 
         future = Future.Future(data=p)
-        future.freeze(method, *newargs, **kwdargs)
+        future.freeze(self.dispatch_command, p, method, *newargs, **kwdargs)
         future.add_callback('resolved',
                             lambda f: self.fv.nongui_do(self.result_cb1,
-                                                        future, tag, p))
+                                                        f, tag, p))
 
-        self.fv.gui_do_future(future)
+        self.scheduler.submit(tag, key, methodName,
+                              timeout_sec=self.settings.get('command_timeout_sec',
+                                                            None),
+                              future=future, result_future=result_future)
         return ro.OK
 
+    def start_command(self, cmd):
+        self.fv.gui_do_future(cmd.future)
+
+    def dispatch_command(self, p, method, *args, **kwdargs):
+        # NOTE: this method is called from the GUI thread; the times are
+        # published with the result, for measuring dispatch latency
+        p.gui_dispatched = time.time()
+        return method(*args, **kwdargs)
+
+    def cancel_command(self, tag):
+        """Cancel the command `tag`, whether it is still waiting for
+        another command for the same instrument or already running.
+        Returns False if there is no such command.  This method can be
+        called remotely.
+        """
+        return self.scheduler.cancel(tag)
+
+    def set_command_timeout(self, tag, timeout_sec):
+        """Cancel the command `tag` if it has not finished in
+        `timeout_sec` seconds.  Returns False if there is no such command.
+        This method can be called remotely.
+        """
+        return self.scheduler.set_timeout(tag, timeout_sec)
+
+    def get_command_stats(self):
+        """Returns a dict of command statistics: the time commands waited
+        for others for the same instrument and the time they ran, per
+        method.  This method can be called remotely.
+        """
+        return rpcdata.cleanse(self.scheduler.get_stats())
+
+    def cancel_command_cb(self, cmd, reason):
+        if cmd.state == 'running':
+            # close the dialog or stop the timer; resolving the future
+            # reports the error to Gen2 via result_cb2
+            self.fv.gui_do(self.abort_command, cmd, reason)
+        else:
+            resdata = {'gui_done': time.time(), 'result': 'error',
+                       'errmsg': reason}
+            self.publisher.put(cmd.tag, **resdata)
+
+    def abort_command(self, cmd, reason):
+        # resolve first, so that a dialog closed below does not release
+        # the command as if the user had cancelled it
+        cmd.result_future.resolve(AnaError(reason))
+
+        if cmd.method == 'sleep':
+            timer = self.sleep_timers.pop(cmd.tag, None)
+            if timer is not None:
+                timer.stop()
+        elif cmd.method in command_plugins and cmd.key is not None:
+            # NOTE: the key is the operation channel of the dialog
+            chinfo = self.fv.get_channel_info(cmd.key)
+            pluginName = command_plugins[cmd.method]
+            if not chinfo.opmon.is_active(pluginName):
+                return
+            # the dialog showing may belong to another command (e.g. of
+            # another instrument sharing the channel); leave that alone
+            obj = chinfo.opmon.get_plugin(pluginName)
+            if getattr(obj, 'callerInfo', None) is cmd.result_future:
+                chinfo.opmon.deactivate(pluginName)
+
     def result_cb1(self, future, tag, data):
         res = future.get_value(suppress_exception=True)
         if isinstance(res, Exception):
@@ -347,7 +895,8 @@ class ANA(GingaPlugin.GlobalPlugin):
 
             self.logger.error("Command (%s) terminated by exception: %s" % (
                 tag, errmsg))
-            self.monitor.setvals(['g2task'], tag, **resdata)
+            self.publisher.put(tag, **resdata)
+            self.scheduler.finish(tag)
         else:
             self.logger.debug("Command made it to the GUI interaction: %s" % (
                 tag))
@@ -371,16 +920,17 @@ class ANA(GingaPlugin.GlobalPlugin):
         self._rpc_cleanse(resdata)
         self.logger.debug("Result is: %s" % (str(resdata)))
 
-        self.monitor.setvals(['g2task'], tag, **resdata)
+        self.publisher.put(tag, **resdata)
+        self.scheduler.finish(tag)
 
+    def publish_result(self, tag, **resdata):
+        # called by the publisher with the (merged) updates for `tag`
+        self.monitor.setvals(['g2task'], tag, **resdata)
 
     def _rpc_cleanse(self, d):
-        # RPC cleansing of return data dictionaries
-        for key, val in list(d.items()):
-            if isinstance(val, np.integer):
-                d[key] = int(val)
-            elif isinstance(val, np.floating):
-                d[key] = float(val)
+        # RPC cleansing of return data dictionaries (in place); numpy
+        # arrays are encoded compactly, see rpcdata
+        d.update(rpcdata.cleanse(d))
 
     #############################################################
     #    Here come the ANA commands
@@ -429,16 +979,26 @@ class ANA(GingaPlugin.GlobalPlugin):
 
 
     def sleep(self, tag, future, sleep_time=None):
-        def _sleep(future):
+        # NOTE: returns right away; the future is resolved by a timer, so
+        # the GUI and other commands (including other sleeps) carry on
+        # in the meantime
+        sleep_time = max(0.0, float(sleep_time))
+        time_start = time.time()
+
+        def _sleep(timer):
+            self.sleep_timers.pop(tag, None)
+            elapsed = time.time() - time_start
+            self.sleep_lateness.record(elapsed - sleep_time)
+            self.logger.debug("sleep ({}) of {:.3f} sec done in {:.3f} sec".format(
+                tag, sleep_time, elapsed))
             p = future.get_data()
             p.result = 'ok'
             future.resolve(0)
 
-        # TODO: Don't block the GUI thread!
-        #gobject.timeout_add(msecs, _sleep, future)
-        time.sleep(sleep_time)
-
-        _sleep(future)
+        timer = self.fv.make_timer()
+        timer.add_callback('expired', _sleep)
+        self.sleep_timers[tag] = timer
+        timer.set(sleep_time)
 
 
     def __str__(self):
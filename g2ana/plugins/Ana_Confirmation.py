@@ -12,6 +12,9 @@ class Ana_Confirmation(GingaPlugin.LocalPlugin):
         # superclass defines some variables for us, like logger
         super(Ana_Confirmation, self).__init__(fv, fitsimage)
 
+        # future of the command waiting for this dialog
+        self.callerInfo = None
+
     def build_gui(self, container, future=None):
         vbox1 = Widgets.VBox()
         vbox = Widgets.VBox()
@@ -76,11 +79,13 @@ class Ana_Confirmation(GingaPlugin.LocalPlugin):
         pass
 
     def release_caller(self):
+        future, self.callerInfo = self.callerInfo, None
         try:
             self.close()
         except:
             pass
-        self.callerInfo.resolve(0)
+        if future is not None:
+            future.resolve(0)
 
     def ok(self, index):
         self.logger.info("OK clicked, index=%d" % (index))
@@ -97,7 +102,14 @@ class Ana_Confirmation(GingaPlugin.LocalPlugin):
         self.release_caller()
 
     def stop(self):
-        pass
+        # closed without an answer (e.g. by the user, or another command
+        # for this channel): release the command as cancelled, or it
+        # would hold up the commands queued behind it
+        future, self.callerInfo = self.callerInfo, None
+        if future is not None and not future.has_value():
+            p = future.get_data()
+            p.result = 'cancel'
+            future.resolve(0)
 
     def redo(self):
         pass
@@ -12,6 +12,9 @@ class Ana_UserInput(GingaPlugin.LocalPlugin):
         # superclass defines some variables for us, like logger
         super(Ana_UserInput, self).__init__(fv, fitsimage)
 
+        # future of the command waiting for this dialog
+        self.callerInfo = None
+
     def build_gui(self, container, future=None):
         vbox1 = Widgets.VBox()
         vbox = Widgets.VBox()
@@ -86,11 +89,13 @@ class Ana_UserInput(GingaPlugin.LocalPlugin):
         pass
 
     def release_caller(self):
+        future, self.callerInfo = self.callerInfo, None
         try:
             self.close()
         except:
             pass
-        self.callerInfo.resolve(0)
+        if future is not None:
+            future.resolve(0)
 
     def ok(self):
         p = self.callerInfo.get_data()
@@ -114,7 +119,15 @@ class Ana_UserInput(GingaPlugin.LocalPlugin):
         self.release_caller()
 
     def stop(self):
-        pass
+        # closed without an answer (e.g. by the user, or another command
+        # for this channel): release the command as cancelled, or it
+        # would hold up the commands queued behind it
+        future, self.callerInfo = self.callerInfo, None
+        if future is not None and not future.has_value():
+            p = future.get_data()
+            p.result = 'cancel'
+            p.resDict = {}
+            future.resolve(0)
 
     def redo(self):
         pass
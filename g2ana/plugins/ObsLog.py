@@ -17,7 +17,14 @@ use the type selector combobox to pick the right extension:
 * csv:
 * xlsx: MS Excel file format
 
-The file is rewritten out every time a new entry is added to the log
+The file is rewritten out every time new entries are added to the log
+
+***Table updates***
+
+New and changed entries are added to the table in batches, at most every
+"table_update_sec" seconds (setting; 0 updates the table for each entry),
+so that the (sortable) table is re-sorted once per batch rather than
+once per frame.
 
 ***Adding a memo to one or more log entries***
 
@@ -29,6 +36,10 @@ rules about holding down CTRL and/or SHIFT keys.
 
 Double-click on a log entry.
 
+If the "prefetch_neighbors" setting is more than zero, that many frames
+on either side of the selected entries are decoded in the background
+(into the ANA decode cache), so that stepping through them is quick.
+
 """
 import os
 from datetime import datetime
@@ -73,19 +84,33 @@ class ObsLog(GingaPlugin.GlobalPlugin):
         self.settings.add_defaults(sortable=True,
                                    color_alternate_rows=True,
                                    column_info=column_info,
-                                   cache_normalized_images=True)
+                                   cache_normalized_images=True,
+                                   prefetch_neighbors=0,
+                                   table_update_sec=0.5)
 
         self.rpt_dict = OrderedDict({})
         self.rpt_columns = []
         self.col_widths = []
         self.memo_txt = ''
         self.insconfig = INSdata()
+        # entries waiting to be added to or updated in the table, and
+        # whether any of them are new (to scroll to the end)
+        self.pending_rows = OrderedDict()
+        self.pending_scroll = False
+        self.row_timer = self.fv.make_timer()
+        self.row_timer.add_callback('expired', lambda timer: self.flush_rows())
 
         self.col_info = self.settings.get('column_info', [])
         # this will set rpt_columns and col_widths
         self.process_columns(self.col_info)
 
         self.fv.add_callback('add-image', self.incoming_data_cb)
+        # frames that the ANA plugin read only the header for
+        self.fv.enable_callback('ana-add-header')
+        self.fv.add_callback('ana-add-header', self.incoming_header_cb)
+        # tells the ANA plugin (for its latency statistics) when a frame
+        # has been logged; signature is cb(fv, frameid)
+        self.fv.enable_callback('obslog-add-row')
         self.gui_up = False
 
     def process_columns(self, spec_lst):
@@ -219,7 +244,8 @@ class ObsLog(GingaPlugin.GlobalPlugin):
         self.rpt_dict[frameid] = d
         self.logger.info("adding to dict [{}]: {}".format(frameid, str(d)))
 
-        self.update_obslog()
+        self.add_obslog_rows([frameid])
+        self.fv.make_callback('obslog-add-row', frameid)
 
     def start(self):
         super().start()
@@ -232,6 +258,9 @@ class ObsLog(GingaPlugin.GlobalPlugin):
 
     def stop(self):
         self.gui_up = False
+        self.row_timer.clear()
+        self.pending_rows = OrderedDict()
+        self.pending_scroll = False
 
     def process_image(self, chname, header, image):
         """Override this method to do something special with the data."""
@@ -245,6 +274,10 @@ class ObsLog(GingaPlugin.GlobalPlugin):
         if imname is None:
             return
 
+        if image.get('preview', False):
+            # ANA will add the full resolution image shortly
+            return
+
         # only accepted list of frames
         accepted = False
         for prefix in self.file_prefixes:
@@ -266,13 +299,81 @@ class ObsLog(GingaPlugin.GlobalPlugin):
             self.logger.error("Failed to process image: {}".format(e),
                               exc_info=True)
 
+    def incoming_header_cb(self, fv, chname, header, info):
+        """Called when the ANA plugin has read only the header of a frame
+        (e.g. it was superseded before it could be displayed).  The
+        frame is added to the log, but process_image() is not called
+        because there is no image.
+        """
+        if chname not in self.chnames:
+            return
+
+        # only accepted list of frames
+        accepted = False
+        for prefix in self.file_prefixes:
+            if info.frameid.startswith(prefix):
+                accepted = True
+                break
+        if not accepted:
+            return
+
+        self.add_to_obslog(header, None)
+
     def update_obslog(self):
         if not self.gui_up:
             return
 
+        # the whole table is rebuilt, including any pending rows
+        self.row_timer.clear()
+        self.pending_rows = OrderedDict()
+        self.pending_scroll = False
         self.w.rpt_tbl.set_tree(self.rpt_dict)
+        self.obslog_changed()
+
+    def add_obslog_rows(self, frameids):
+        """Add the entries for `frameids` to the table with the next
+        batch, without rebuilding the rows that are already there.
+        """
+        self.queue_rows(frameids, scroll=True)
+
+    def update_obslog_rows(self, frameids):
+        """Update the rows of the table for the (changed) entries for
+        `frameids` with the next batch, leaving the others alone.
+        """
+        self.queue_rows(frameids, scroll=False)
 
-        if self.auto_scroll:
+    def queue_rows(self, frameids, scroll=False):
+        if not self.gui_up:
+            # table is filled in when the GUI is built
+            return
+
+        self.pending_rows.update(OrderedDict.fromkeys(frameids))
+        self.pending_scroll = self.pending_scroll or scroll
+        delay = self.settings.get('table_update_sec', 0.5)
+        if delay <= 0:
+            self.flush_rows()
+        elif not self.row_timer.is_set():
+            self.row_timer.set(delay)
+
+    def flush_rows(self):
+        """Add or update the rows of the pending entries in one go.  The
+        table re-sorts (and restyles) all its rows after each change, so
+        this is done once per batch.
+        """
+        if not self.gui_up or len(self.pending_rows) == 0:
+            return
+        frameids, self.pending_rows = self.pending_rows, OrderedDict()
+        scroll, self.pending_scroll = self.pending_scroll, False
+
+        # NOTE: add_tree() updates existing rows in place; update_tree()
+        # would delete all the rows that are not in the dict
+        self.w.rpt_tbl.add_tree({frameid: self.rpt_dict[frameid]
+                                 for frameid in frameids
+                                 if frameid in self.rpt_dict})
+        self.obslog_changed(scroll=scroll)
+
+    def obslog_changed(self, scroll=True):
+        if scroll and self.auto_scroll:
             self.w.rpt_tbl.scroll_to_end()
 
         if self.w.auto_save.get_state():
@@ -413,6 +514,39 @@ class ObsLog(GingaPlugin.GlobalPlugin):
                 self.w.memo.set_text(memo_txt)
                 break
 
+            num_neighbors = self.settings.get('prefetch_neighbors', 0)
+            if num_neighbors > 0:
+                self.prefetch_neighbors(list(res.keys()), num_neighbors)
+
+    def prefetch_neighbors(self, frameids, num_neighbors):
+        """Have ANA prefetch the `num_neighbors` frames on either side of
+        the frames in `frameids`, nearest first, since they are likely to
+        be viewed next.
+        """
+        keys = list(self.rpt_dict.keys())
+        index = {frameid: i for i, frameid in enumerate(keys)}
+        selected = set(frameids)
+        neighbors = []
+        for dist in range(1, num_neighbors + 1):
+            for frameid in frameids:
+                i = index.get(frameid, None)
+                if i is None:
+                    continue
+                for j in (i + dist, i - dist):
+                    if 0 <= j < len(keys) and keys[j] not in selected:
+                        selected.add(keys[j])
+                        neighbors.append(keys[j])
+        if len(neighbors) == 0:
+            return
+
+        try:
+            pl_obj = self.fv.gpmon.get_plugin('ANA')
+
+        except Exception:
+            # ANA not loaded
+            return
+        self.fv.nongui_do(pl_obj.prefetch_frames, neighbors)
+
     def set_memo_cb(self, widget):
         memo_txt = self.w.memo.get_text().strip()
         res = self.get_selected()
@@ -423,7 +557,7 @@ class ObsLog(GingaPlugin.GlobalPlugin):
         for key in res.keys():
             self.rpt_dict[key]['G_MEMO'] = memo_txt
 
-        self.update_obslog()
+        self.update_obslog_rows(list(res.keys()))
 
     def copy_memo_cb(self, widget):
         self.memo_txt = self.w.memo.get_text().strip()
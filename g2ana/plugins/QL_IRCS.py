@@ -234,9 +234,18 @@ class QL_IRCS(ObsLog.ObsLog):
         else:
             #<-- need to load the original image and reprocess it
             chname = 'IRCS'
-            # TODO: record the absolute path to the file in the ObsLog
-            filepath = os.path.join('/gen2', 'share', 'data', chname,
-                                    frameid + '.fits')
+            filepath = None
+            try:
+                # ANA knows where the frames of this session are
+                pl_obj = self.fv.gpmon.get_plugin('ANA')
+                filepath = pl_obj.get_frame_path(frameid)
+
+            except Exception as e:
+                self.logger.warning(f"couldn't look up '{frameid}' via ANA: {e}")
+
+            if filepath is None:
+                filepath = os.path.join('/gen2', 'share', 'data', chname,
+                                        frameid + '.fits')
             self.logger.info(f"attempting to load '{filepath}'...")
             self.fv.load_file(filepath, chname=chname)
 
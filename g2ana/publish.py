@@ -0,0 +1,134 @@
+#
+# publish.py -- batched publishing of command results for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Batch the status updates of Gen2 commands (``g2task`` items) that ANA
+publishes via its monitor.
+
+Updates are collected for a short window, or until a number of tags
+are pending, and then sent together.  Several updates for the same tag
+within a window are merged into one, later values winning, so the
+subscriber sees the same final state for the tag with fewer publishes.
+Updates for a tag are always sent in the order they were made.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class PublishBatcher:
+    """Collect per-tag updates and hand them to `publish_fn` in batches.
+
+    Parameters
+    ----------
+    publish_fn : callable
+        Called as ``publish_fn(tag, **vals)`` for each pending tag when a
+        batch is sent.
+    window_sec : float
+        How long to collect updates before sending them.  If 0, every
+        update is sent right away.
+    max_tags : int
+        Send the batch early when this many tags are pending.
+    """
+
+    def __init__(self, publish_fn, window_sec=0.05, max_tags=100, logger=None):
+        self.publish_fn = publish_fn
+        self.window_sec = window_sec
+        self.max_tags = max(1, max_tags)
+        self.logger = logger
+
+        self.lock = threading.Condition()
+        # held while a batch is being sent, so batches go out in order
+        self.send_lock = threading.Lock()
+        # tag -> dict of values, in order of first update
+        self.pending = OrderedDict()
+        self.time_first = None
+        self.ev_quit = threading.Event()
+        self.thread = None
+
+        self.num_updates = 0
+        self.num_coalesced = 0
+        self.num_sent = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.max_batch = 0
+
+    def start(self):
+        if self.window_sec <= 0:
+            return
+        self.ev_quit.clear()
+        self.thread = threading.Thread(target=self.flush_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the batcher, sending whatever is still pending."""
+        self.ev_quit.set()
+        with self.lock:
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def put(self, tag, **vals):
+        """Add an update of `vals` for `tag`."""
+        with self.lock:
+            self.num_updates += 1
+            dct = self.pending.get(tag, None)
+            if dct is None:
+                self.pending[tag] = dict(vals)
+            else:
+                dct.update(vals)
+                self.num_coalesced += 1
+            if self.time_first is None:
+                self.time_first = time.time()
+                self.lock.notify_all()
+            send_now = (self.window_sec <= 0 or
+                        len(self.pending) >= self.max_tags)
+
+        if send_now:
+            self.flush()
+
+    def flush(self):
+        """Send all pending updates."""
+        with self.send_lock:
+            with self.lock:
+                batch, self.pending = self.pending, OrderedDict()
+                self.time_first = None
+            if len(batch) == 0:
+                return
+
+            self.num_batches += 1
+            self.max_batch = max(self.max_batch, len(batch))
+            for tag, vals in batch.items():
+                try:
+                    self.publish_fn(tag, **vals)
+                    self.num_sent += 1
+
+                except Exception as e:
+                    self.num_errors += 1
+                    if self.logger is not None:
+                        self.logger.error("Error publishing '{}': {}".format(
+                            tag, e), exc_info=True)
+
+    def flush_loop(self):
+        while not self.ev_quit.is_set():
+            with self.lock:
+                if self.time_first is None:
+                    self.lock.wait()
+                    continue
+                delay = self.time_first + self.window_sec - time.time()
+                if delay > 0:
+                    self.lock.wait(delay)
+                    continue
+            self.flush()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(updates=self.num_updates, sent=self.num_sent,
+                        coalesced=self.num_coalesced, errors=self.num_errors,
+                        batches=self.num_batches, max_batch=self.max_batch,
+                        pending=len(self.pending))
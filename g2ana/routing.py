@@ -0,0 +1,221 @@
+#
+# routing.py -- decide which channel and workspace show a frame
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Map Subaru frames to the ANA channel and workspace they are displayed
+in.
+
+The rules themselves are in `get_chname` and `get_wsname`.  A
+`RoutingTable` memoises their results, keyed by the frame id prefix
+plus whatever part of the frame number or FITS header (a
+"discriminator") changes the outcome, so that routing a frame is a
+couple of dictionary lookups.
+"""
+import threading
+
+from ginga.misc import Bunch
+
+# PFS data model: arm indicated by right-most digit of the frame number
+pfs_arm_dct = {'1': 'B', '2': 'R', '3': 'N', '4': 'R'}
+
+# instruments (by code) whose channel depends on the FITS header
+header_inscodes = ('MCS', 'FCS')
+# ... and the values of DET-ID their frames can have
+header_det_ids = dict(MCS=(1, 2), FCS=(1, 2))
+
+# settings for channels that ANA creates
+channel_settings = dict(numImages=1, raisenew=False, focus_indicator=False)
+
+
+def get_chname(fr, header, chname):
+    """Determine the channel name from the frame, FITS header and
+    default CHNAME.
+    """
+    if fr.inscode == 'PFS':
+        if fr.frametype in ('A', 'B'):
+            digits = str(fr.number)
+            # PFS data model: spectrograph indicated by second digit from right,
+            # arm indicated by right-most digit
+            spg, arm = digits[-2], pfs_arm_dct[digits[-1]]
+            chname = f"PFS{fr.frametype}_{arm}{spg}"
+        else:
+            chname = fr.inscode + fr.frametype
+
+    elif fr.inscode in header_inscodes:
+        det_id = int(header['DET-ID'])
+        chname = chname + f'_{det_id}'
+
+    return chname
+
+
+def get_wsname(chname):
+    """Determine the workspace from the CHNAME.
+    """
+    wsname = 'channels'     # the default
+    if chname.startswith('PFS'):
+        if chname[3] in ('A', 'B'):
+            # spectrograph indicated by last character of channel name
+            spg = chname[-1]
+            wsname = f"PFS_{spg}"
+
+    elif chname.startswith('FOCAS'):
+        wsname = 'FOCAS'
+    elif chname.startswith('MOIRCS'):
+        wsname = 'MOIRCS'
+
+    return wsname
+
+
+def get_operation_chname(insname):
+    """Determine the channel in which the dialogs of Gen2 commands (e.g.
+    confirmation, user input) for instrument INSNAME are shown.
+    Instruments with a channel per detector use the first; most others
+    share the channel of the default workspace.
+    """
+    if insname == 'PFS':
+        # NOTE: get_wsname() expects a PFS channel name
+        return 'PFSA_B1'
+    wsname = get_wsname(insname)
+    if wsname in ['FOCAS', 'MOIRCS']:
+        chname = wsname + '_1'
+    else:
+        chname = wsname
+    return chname
+
+
+class RoutingTable:
+    """Route frames to (channel, workspace, channel settings).
+
+    Parameters
+    ----------
+    insconfig : `g2cam.INS.INSdata`
+        Instrument configuration, used to map frame id prefixes to
+        instrument names.
+    """
+
+    def __init__(self, insconfig, logger=None):
+        self.insconfig = insconfig
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        # instrument code (frame id prefix) -> instrument name
+        self.insnames = {}
+        # (inscode, frametype, discriminator) -> route Bunch
+        self.routes = {}
+        self.num_lookups = 0
+        self.num_misses = 0
+
+        try:
+            for insname in insconfig.getNames():
+                self.insnames[insconfig.getCodeByName(insname)] = insname
+
+        except Exception as e:
+            # will be filled in as frames are seen
+            if self.logger is not None:
+                self.logger.warning("Error reading instrument codes: {}".format(e))
+
+    def get_insname(self, frameid):
+        """Returns the instrument name for the frame id `frameid`."""
+        inscode = frameid[:3]
+        insname = self.insnames.get(inscode, None)
+        if insname is None:
+            insname = self.insconfig.getNameByFrameId(frameid)
+            with self.lock:
+                self.insnames[inscode] = insname
+        return insname
+
+    def needs_header(self, frame):
+        """Returns True if the channel for `frame` depends on its header."""
+        return frame.inscode in header_inscodes
+
+    def get_discriminator(self, frame, header):
+        if frame.inscode == 'PFS':
+            if frame.frametype in ('A', 'B'):
+                return str(frame.number)[-2:]
+            return None
+        if frame.inscode in header_inscodes:
+            return int(header['DET-ID'])
+        return None
+
+    def lookup(self, frame, header=None):
+        """Returns a Bunch with the instrument, channel and workspace
+        names and the channel settings for `frame` (a `Frame`).  `header`
+        is needed if `needs_header` is True for the frame.
+        """
+        key = (frame.inscode, frame.frametype,
+               self.get_discriminator(frame, header))
+        self.num_lookups += 1
+        route = self.routes.get(key, None)
+        if route is None:
+            route = self._make_route(frame, header)
+            with self.lock:
+                self.num_misses += 1
+                self.routes[key] = route
+        return route
+
+    def expect_routes(self, frame):
+        """Returns a list of the routes `frame` (a `Frame`) can take
+        before its header is known: one route, or one per detector for
+        instruments whose channel depends on the header.
+        """
+        if not self.needs_header(frame):
+            return [self.lookup(frame)]
+        return [self.lookup(frame, {'DET-ID': det_id})
+                for det_id in header_det_ids.get(frame.inscode, ())]
+
+    def _make_route(self, frame, header):
+        insname = self.get_insname(str(frame))
+        chname = get_chname(frame, header, insname)
+        return Bunch.Bunch(insname=insname, chname=chname,
+                           wsname=get_wsname(chname),
+                           settings=channel_settings)
+
+    def get_instrument_routes(self, insname):
+        """Returns a list of the routes for all the channels of instrument
+        `insname` that can be known in advance (e.g. to create them all
+        at once).  For instruments whose channel depends on the header,
+        there is one route per detector in `header_det_ids`.
+        """
+        inscode = None
+        for code, name in list(self.insnames.items()):
+            if name == insname:
+                inscode = code
+                break
+
+        if inscode in header_inscodes:
+            frame = Bunch.Bunch(inscode=inscode, frametype='A', number=0)
+            res = []
+            for det_id in header_det_ids.get(inscode, ()):
+                chname = get_chname(frame, {'DET-ID': det_id}, insname)
+                res.append(Bunch.Bunch(insname=insname, chname=chname,
+                                       wsname=get_wsname(chname),
+                                       settings=channel_settings))
+            return res
+
+        if inscode == 'PFS':
+            res = []
+            for frametype in ('A', 'B'):
+                for spg in range(1, 5):
+                    for arm in sorted(pfs_arm_dct.keys()):
+                        frame = Bunch.Bunch(inscode=inscode,
+                                            frametype=frametype,
+                                            number=int(f"1{spg}{arm}"))
+                        chname = get_chname(frame, None, insname)
+                        res.append(Bunch.Bunch(insname=insname,
+                                               chname=chname,
+                                               wsname=get_wsname(chname),
+                                               settings=channel_settings))
+            # arms '2' and '4' share a channel
+            return list({route.chname: route for route in res}.values())
+
+        return [Bunch.Bunch(insname=insname, chname=insname,
+                            wsname=get_wsname(insname),
+                            settings=channel_settings)]
+
+    def get_stats(self):
+        with self.lock:
+            return dict(lookups=self.num_lookups, misses=self.num_misses,
+                        routes=len(self.routes))
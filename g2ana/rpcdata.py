@@ -0,0 +1,72 @@
+#
+# rpcdata.py -- prepare ANA results for transport over XML-RPC
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Convert the results of ANA commands and remote methods into values that
+XML-RPC can carry, and back.
+
+numpy scalars become Python ints, floats and bools.  numpy arrays are
+sent as a compact binary encoding instead of (much larger and slower)
+nested lists: a dict with the base64 encoded bytes of the array, its
+dtype and shape, e.g.::
+
+    {'__ndarray__': 'AACAPwAAAEA=', 'dtype': '<f4', 'shape': [2]}
+
+`decode` turns such dicts back into arrays on the receiving end.
+"""
+import base64
+
+import numpy as np
+
+# marks a dict as an encoded numpy array
+array_key = '__ndarray__'
+
+
+def encode_array(arr):
+    """Returns the dict encoding of numpy array `arr`."""
+    arr = np.ascontiguousarray(arr)
+    return {array_key: base64.b64encode(arr.data).decode('ascii'),
+            'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+
+
+def decode_array(dct):
+    """Returns the numpy array encoded in dict `dct` (see `encode_array`).
+    The array is read-only, as it shares the decoded buffer.
+    """
+    buf = base64.b64decode(dct[array_key])
+    return np.frombuffer(buf, dtype=np.dtype(dct['dtype'])).reshape(
+        dct['shape'])
+
+
+def cleanse(obj):
+    """Returns a copy of `obj` that can be sent over XML-RPC.  Nested
+    dicts, lists and tuples are converted in one pass; dict keys are
+    turned into strings.
+    """
+    if isinstance(obj, dict):
+        return {str(key): cleanse(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [cleanse(val) for val in obj]
+    if isinstance(obj, np.ndarray):
+        if obj.ndim == 0:
+            return obj.item()
+        return encode_array(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def decode(obj):
+    """Returns a copy of `obj` (as received over XML-RPC) with encoded
+    numpy arrays turned back into arrays.
+    """
+    if isinstance(obj, dict):
+        if array_key in obj:
+            return decode_array(obj)
+        return {key: decode(val) for key, val in obj.items()}
+    if isinstance(obj, list):
+        return [decode(val) for val in obj]
+    return obj
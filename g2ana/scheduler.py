@@ -0,0 +1,200 @@
+#
+# scheduler.py -- scheduling of Gen2 commands for the ANA plugin
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Schedule the commands that Gen2 sends to ANA.
+
+Commands with the same key (for ANA, the operation channel that shows
+their dialogs) run one at a time, in the order they arrived; commands
+with different keys, or with no key, run in parallel.  A command is
+running from when it is started until its owner reports it finished
+(e.g. the user answered a dialog), and can be cancelled by tag while
+queued or running, or after a timeout.
+"""
+import time
+import threading
+from collections import deque
+
+from ginga.misc import Bunch
+
+from g2ana.ingest import LatencyStats
+
+
+class CommandScheduler:
+    """Run commands serially per key and in parallel across keys.
+
+    Parameters
+    ----------
+    start_fn : callable
+        Called as ``start_fn(cmd)`` to start a command.
+    cancel_fn : callable
+        Called as ``cancel_fn(cmd, reason)`` when a command is cancelled
+        or times out; ``cmd.state`` tells whether it was 'queued' or
+        'running' at the time.
+    """
+
+    def __init__(self, start_fn, cancel_fn, logger=None):
+        self.start_fn = start_fn
+        self.cancel_fn = cancel_fn
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        # key -> deque of commands waiting to run
+        self.waiting = {}
+        # key -> running command
+        self.running = {}
+        # tag -> command, for all commands not yet finished
+        self.commands = {}
+        # method -> Bunch of statistics
+        self.stats = {}
+
+    def _get_stats(self, method):
+        bnch = self.stats.get(method, None)
+        if bnch is None:
+            bnch = Bunch.Bunch(wait=LatencyStats(), run=LatencyStats(),
+                               cancelled=0, timed_out=0)
+            self.stats[method] = bnch
+        return bnch
+
+    def submit(self, tag, key, method, timeout_sec=None, **kwdargs):
+        """Add the command `tag` (calling `method`) for `key`.  Extra
+        keyword arguments are stored in the command Bunch for `start_fn`
+        and `cancel_fn`.  Returns the command Bunch.
+        """
+        cmd = Bunch.Bunch(tag=tag, key=key, method=method, state='queued',
+                          time_queued=time.time(), time_started=None,
+                          timer=None, **kwdargs)
+        with self.lock:
+            self.commands[tag] = cmd
+            if timeout_sec is not None:
+                self.set_timeout(tag, timeout_sec)
+            if key is not None and (key in self.running or
+                                    len(self.waiting.get(key, [])) > 0):
+                self.waiting.setdefault(key, deque()).append(cmd)
+                return cmd
+            self._start(cmd)
+
+        self.start_fn(cmd)
+        return cmd
+
+    def _start(self, cmd):
+        # must be called with the lock held
+        cmd.state = 'running'
+        cmd.time_started = time.time()
+        if cmd.key is not None:
+            self.running[cmd.key] = cmd
+        self._get_stats(cmd.method).wait.record(cmd.time_started -
+                                                cmd.time_queued)
+
+    def _next(self, key):
+        # must be called with the lock held; returns the next command
+        # started for `key`, if any
+        if key is None:
+            return None
+        self.running.pop(key, None)
+        queue = self.waiting.get(key, None)
+        if not queue:
+            self.waiting.pop(key, None)
+            return None
+        cmd = queue.popleft()
+        self._start(cmd)
+        return cmd
+
+    def finish(self, tag):
+        """Report that the command `tag` is done, starting the next one
+        for its key.  Returns False if it was not running (e.g. it had
+        already been cancelled).
+        """
+        with self.lock:
+            cmd = self.commands.get(tag, None)
+            if cmd is None or cmd.state != 'running':
+                return False
+            self._finish(cmd, 'done')
+            self._get_stats(cmd.method).run.record(time.time() -
+                                                   cmd.time_started)
+            next_cmd = self._next(cmd.key)
+
+        if next_cmd is not None:
+            self.start_fn(next_cmd)
+        return True
+
+    def _finish(self, cmd, state):
+        cmd.state = state
+        del self.commands[cmd.tag]
+        if cmd.timer is not None:
+            cmd.timer.cancel()
+            cmd.timer = None
+
+    def cancel(self, tag, reason='cancelled', timed_out=False):
+        """Cancel the command `tag`.  Returns False if there is no such
+        command queued or running.
+        """
+        next_cmd = None
+        with self.lock:
+            cmd = self.commands.get(tag, None)
+            if cmd is None:
+                return False
+            state = cmd.state
+            self._finish(cmd, 'cancelled')
+            stats = self._get_stats(cmd.method)
+            stats.cancelled += 1
+            if timed_out:
+                stats.timed_out += 1
+            if state == 'queued':
+                queue = self.waiting[cmd.key]
+                self.waiting[cmd.key] = deque([c for c in queue
+                                               if c is not cmd])
+            else:
+                next_cmd = self._next(cmd.key)
+
+        if self.logger is not None:
+            self.logger.info("command ({}) {}: {}".format(tag, state, reason))
+        # NOTE: state is what it was when the command was cancelled
+        cmd.state = state
+        self.cancel_fn(cmd, reason)
+        if next_cmd is not None:
+            self.start_fn(next_cmd)
+        return True
+
+    def set_timeout(self, tag, timeout_sec):
+        """Cancel the command `tag` if it has not finished `timeout_sec`
+        seconds from now.  Returns False if there is no such command.
+        """
+        with self.lock:
+            cmd = self.commands.get(tag, None)
+            if cmd is None:
+                return False
+            if cmd.timer is not None:
+                cmd.timer.cancel()
+            reason = "timed out after {} sec".format(timeout_sec)
+            cmd.timer = threading.Timer(timeout_sec, self.cancel,
+                                        args=(tag, reason, True))
+            cmd.timer.daemon = True
+            cmd.timer.start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            for cmd in self.commands.values():
+                if cmd.timer is not None:
+                    cmd.timer.cancel()
+                    cmd.timer = None
+
+    def get_stats(self):
+        """Returns a dict of {method: stats} with the time commands waited
+        to start and the time they ran, plus counts of cancellations and
+        timeouts, and the number of commands queued and running.
+        """
+        with self.lock:
+            methods = {method: dict(wait=bnch.wait.get_stats(),
+                                    run=bnch.run.get_stats(),
+                                    cancelled=bnch.cancelled,
+                                    timed_out=bnch.timed_out)
+                       for method, bnch in self.stats.items()}
+            num_running = len([cmd for cmd in self.commands.values()
+                               if cmd.state == 'running'])
+            return dict(methods=methods, running=num_running,
+                        queued=len(self.commands) - num_running)
@@ -0,0 +1,104 @@
+#
+# test_cache.py -- tests for the disk cache of decoded frames
+#
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from g2ana.cache import DecodeCache
+
+
+def make_source(dirpath, frameid):
+    # the cache only looks at the modification time of the original file
+    filepath = os.path.join(str(dirpath), frameid + '.fits.fz')
+    with open(filepath, 'wb') as out_f:
+        out_f.write(b'')
+    return filepath
+
+
+def make_entry(value, shape=(16, 16)):
+    data = np.full(shape, value, dtype=np.int16)
+    header = fits.Header([('OBJECT', 'test {}'.format(value))])
+    return data, header
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+def test_put_get(tmp_path, cache_dir):
+    cache = DecodeCache(cache_dir, 10 * 1024**2)
+    filepath = make_source(tmp_path, 'MCSA00000001')
+    data, header = make_entry(7)
+
+    assert cache.get('MCSA00000001', filepath) is None
+    cache.put('MCSA00000001', filepath, data, header, 1)
+    assert cache.contains('MCSA00000001', filepath)
+
+    res = cache.get('MCSA00000001', filepath)
+    assert res is not None
+    cached, cached_header, idx = res
+    np.testing.assert_array_equal(cached, data)
+    assert not cached.flags.writeable
+    assert cached_header['OBJECT'] == 'test 7'
+    assert idx == 1
+
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['stored']) == (1, 1, 1)
+
+
+def test_modified_file_is_a_miss(tmp_path, cache_dir):
+    cache = DecodeCache(cache_dir, 10 * 1024**2)
+    filepath = make_source(tmp_path, 'MCSA00000001')
+    cache.put('MCSA00000001', filepath, *make_entry(1), 0)
+
+    st = os.stat(filepath)
+    os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.get('MCSA00000001', filepath) is None
+
+
+def test_evicts_least_recently_used(tmp_path, cache_dir):
+    data, header = make_entry(0, shape=(64, 64))
+    # room for two entries (plus the .npy headers), not three
+    cache = DecodeCache(cache_dir, int(data.nbytes * 2.5))
+    paths = {frameid: make_source(tmp_path, frameid)
+             for frameid in ('MCSA00000001', 'MCSA00000002', 'MCSA00000003')}
+
+    cache.put('MCSA00000001', paths['MCSA00000001'], data, header, 0)
+    cache.put('MCSA00000002', paths['MCSA00000002'], data, header, 0)
+    # touch the first, so that the second is the least recently used
+    assert cache.get('MCSA00000001', paths['MCSA00000001']) is not None
+    cache.put('MCSA00000003', paths['MCSA00000003'], data, header, 0)
+
+    assert cache.contains('MCSA00000001', paths['MCSA00000001'])
+    assert not cache.contains('MCSA00000002', paths['MCSA00000002'])
+    assert cache.contains('MCSA00000003', paths['MCSA00000003'])
+    assert cache.get_stats()['evicted'] == 1
+    assert len([name for name in os.listdir(cache_dir)
+                if name.startswith('MCSA00000002')]) == 0
+
+
+def test_reuses_entries_of_earlier_session(tmp_path, cache_dir):
+    filepath = make_source(tmp_path, 'MCSA00000001')
+    cache = DecodeCache(cache_dir, 10 * 1024**2)
+    cache.put('MCSA00000001', filepath, *make_entry(3), 0)
+
+    cache = DecodeCache(cache_dir, 10 * 1024**2)
+    res = cache.get('MCSA00000001', filepath)
+    assert res is not None
+    assert res[0][0, 0] == 3
+
+
+def test_scan_drops_incomplete_entries(tmp_path, cache_dir):
+    filepath = make_source(tmp_path, 'MCSA00000001')
+    cache = DecodeCache(cache_dir, 10 * 1024**2)
+    cache.put('MCSA00000001', filepath, *make_entry(3), 0)
+    key = cache.get_key('MCSA00000001', filepath)
+    os.remove(os.path.join(cache_dir, key + '.json'))
+
+    cache = DecodeCache(cache_dir, 10 * 1024**2)
+    assert cache.get_stats()['entries'] == 0
+    assert not os.path.exists(os.path.join(cache_dir, key + '.npy'))
@@ -0,0 +1,109 @@
+#
+# test_fitsutil.py -- tests for the fast FITS loading paths
+#
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from g2ana import fitsutil
+
+
+def write_image(tmp_path, data, name='MCSA00000001.fits', **kwds):
+    filepath = str(tmp_path / name)
+    hdu = fits.PrimaryHDU(data)
+    for kwd, val in kwds.items():
+        hdu.header[kwd] = val
+    hdu.writeto(filepath)
+    return filepath
+
+
+def test_mmap_plain_image(tmp_path):
+    data = np.arange(60 * 40, dtype=np.int16).reshape(60, 40)
+    filepath = write_image(tmp_path, data, OBJECT='plain')
+
+    image = fitsutil.load_image_mmap(filepath)
+    assert image is not None
+    np.testing.assert_array_equal(image.get_data(), data)
+    assert image.get_keyword('OBJECT') == 'plain'
+    assert image.get('path') == filepath
+    assert image.get('idx') == 0
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'uint32'])
+def test_mmap_unsigned_image(tmp_path, dtype):
+    info = np.iinfo(dtype)
+    data = np.linspace(0, info.max, 50 * 30).astype(dtype).reshape(50, 30)
+    # astropy writes unsigned data as signed with BZERO=2**(bits-1)
+    filepath = write_image(tmp_path, data)
+
+    # a small band size, so that the image is converted in several bands
+    image = fitsutil.load_image_mmap(filepath, band_bytes=data[0].nbytes * 7)
+    assert image is not None
+    res = image.get_data()
+    assert res.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(res, data)
+    assert image.get_keyword('BZERO', None) is None
+
+
+def test_mmap_scaled_image_falls_back(tmp_path):
+    filepath = str(tmp_path / 'MCSA00000001.fits')
+    hdu = fits.PrimaryHDU(np.linspace(0, 100, 400).reshape(20, 20))
+    hdu.scale('int16', bscale=0.5, bzero=3)
+    hdu.writeto(filepath)
+
+    assert fitsutil.load_image_mmap(filepath) is None
+
+
+def test_get_uint_offset():
+    hdr = fits.Header([('BSCALE', 1), ('BZERO', 32768)])
+    assert fitsutil.get_uint_offset(hdr, np.dtype('>i2')) == 0x8000
+    assert fitsutil.get_uint_offset(hdr, np.dtype('>i4')) is None
+    hdr['BLANK'] = -32768
+    assert fitsutil.get_uint_offset(hdr, np.dtype('>i2')) is None
+
+
+@pytest.mark.parametrize('num_threads', [1, 3, 8])
+def test_tiled_matches_astropy(tmp_path, num_threads):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 60000, size=(101, 37)).astype(np.uint16)
+    filepath = str(tmp_path / 'MCSA00000001.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, compression_type='RICE_1',
+                                    tile_shape=(8, 37))]).writeto(filepath)
+
+    image = fitsutil.load_image_tiled(filepath, num_threads)
+    assert image is not None
+    np.testing.assert_array_equal(image.get_data(), data)
+    assert image.get('idx') == 1
+
+
+def test_tiled_uses_given_buffer(tmp_path):
+    data = np.arange(64 * 16, dtype=np.float32).reshape(64, 16)
+    filepath = str(tmp_path / 'MCSA00000001.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, compression_type='GZIP_1',
+                                    tile_shape=(4, 16))]).writeto(filepath)
+
+    out = np.empty(data.shape, dtype=data.dtype)
+    res, header = fitsutil.read_tiled_data(filepath, 4, out=out)
+    assert res is out
+    np.testing.assert_array_equal(out, data)
+
+
+def test_tiled_rejects_uncompressed(tmp_path):
+    filepath = write_image(tmp_path, np.zeros((4, 4), dtype=np.int16))
+    assert fitsutil.read_tiled_data(filepath, 2) is None
+
+
+def test_preview(tmp_path):
+    data = np.arange(64 * 48, dtype=np.float32).reshape(64, 48)
+    filepath = write_image(tmp_path, data, CRPIX1=10.0, CRPIX2=20.0,
+                           CDELT1=1.0, CDELT2=1.0)
+
+    image = fitsutil.make_preview(filepath, 4)
+    assert image.get('preview') and image.get('nothumb')
+    np.testing.assert_array_equal(image.get_data(), data[::4, ::4])
+
+    image = fitsutil.make_preview(filepath, 4, method='mean')
+    np.testing.assert_allclose(image.get_data(),
+                               data.reshape(16, 4, 12, 4).mean(axis=(1, 3)))
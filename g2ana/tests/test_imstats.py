@@ -0,0 +1,71 @@
+#
+# test_imstats.py -- tests for statistics of loaded images
+#
+import gc
+
+import numpy as np
+import pytest
+
+from ginga.AstroImage import AstroImage
+
+from g2ana import imstats
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'int32', 'float32', 'float64'])
+def test_matches_numpy(dtype):
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000, 30, size=(300, 200)).astype(dtype)
+    boxes = [(0, 0, 200, 300), (10, 20, 30, 40), (50, 50, 70, 70)]
+    res = imstats.compute_stats(data, boxes, saturation=1050)
+
+    for box, dct in zip(boxes, res):
+        x1, y1, x2, y2 = box
+        pixels = data[y1:y2, x1:x2].astype(np.float64)
+        assert dct['npix'] == pixels.size and dct['nbad'] == 0
+        assert dct['min'] == pixels.min() and dct['max'] == pixels.max()
+        assert dct['mean'] == pytest.approx(pixels.mean())
+        assert dct['median'] == pytest.approx(np.median(pixels))
+        assert dct['stddev'] == pytest.approx(pixels.std())
+        assert dct['saturated'] == (pixels >= 1050).sum()
+        assert dct['sky'] == pytest.approx(1000, abs=5)
+
+
+def test_bands_agree():
+    rng = np.random.default_rng(1)
+    pixels = rng.normal(0, 1, size=(2, 50, 40))
+    one = imstats.region_stats(pixels, band_pixels=10**6)
+    many = imstats.region_stats(pixels, band_pixels=100)
+    for key in ('min', 'max', 'mean', 'stddev', 'median'):
+        np.testing.assert_allclose(one[key], many[key])
+
+
+def test_nan_and_empty_boxes():
+    data = np.ones((10, 10), dtype=np.float32)
+    data[0, :] = np.nan
+    data[5:, 5:] = np.nan
+    res = imstats.compute_stats(data, [(0, 0, 10, 10), (6, 6, 9, 9),
+                                       (3, 3, 3, 8), (-5, -5, 2, 2)])
+
+    assert res[0]['nbad'] == 10 + 25 and res[0]['mean'] == 1.0
+    # all NaN: no values, which could not be sent over XML-RPC
+    assert res[1]['nbad'] == 9 and 'mean' not in res[1]
+    assert res[2] == dict(box=[3, 3, 3, 8], npix=0)
+    # clipped to the image
+    assert res[3]['box'] == [0, 0, 2, 2]
+
+
+def test_cache():
+    cache = imstats.StatsCache()
+    data = np.arange(100, dtype=np.float32).reshape(10, 10)
+    image = AstroImage(data_np=data)
+
+    cache.get_stats(image, data, [(0, 0, 5, 5)])
+    res = cache.get_stats(image, data, [(0, 0, 5, 5), (5, 5, 10, 10)])
+    assert res[1]['min'] == 55
+    stats = cache.get_cache_stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+    # entries go away with their image
+    del image
+    gc.collect()
+    assert cache.get_cache_stats()['images'] == 0
@@ -0,0 +1,217 @@
+#
+# test_ingest.py -- tests for the ingest queue, sequence gate and indexes
+#
+import os
+import threading
+
+import pytest
+
+from ginga.misc import Bunch
+
+from g2ana import ingest
+
+
+def make_item(name, order_key=None):
+    return Bunch.Bunch(filepath=name, order_key=order_key)
+
+
+def drain(queue):
+    res = []
+    while True:
+        bnch = queue.get_nowait()
+        if bnch is None:
+            return res
+        res.append(bnch.filepath)
+
+
+class TestIngestQueue:
+
+    def test_priority_then_arrival_order(self):
+        queue = ingest.IngestQueue()
+        queue.put(make_item('live1'))
+        queue.put(make_item('prefetch'), priority=ingest.PRIO_BACKFILL)
+        queue.put(make_item('live2'))
+        queue.put(make_item('request'), priority=ingest.PRIO_INTERACTIVE)
+        assert drain(queue) == ['request', 'live1', 'live2', 'prefetch']
+
+    def test_drops_oldest(self):
+        dropped = []
+        queue = ingest.IngestQueue(maxsize=2, on_drop=dropped.append)
+        for name in ('a', 'b', 'c'):
+            assert queue.put(make_item(name))
+        assert [bnch.filepath for bnch in dropped] == ['a']
+        assert drain(queue) == ['b', 'c']
+        assert queue.get_stats()['dropped'] == 1
+
+    def test_drops_least_urgent_first(self):
+        dropped = []
+        queue = ingest.IngestQueue(maxsize=2, on_drop=dropped.append)
+        queue.put(make_item('live'))
+        queue.put(make_item('prefetch'), priority=ingest.PRIO_BACKFILL)
+        queue.put(make_item('live2'))
+        assert [bnch.filepath for bnch in dropped] == ['prefetch']
+
+    def test_full_of_more_urgent_items_drops_new_item(self):
+        dropped = []
+        queue = ingest.IngestQueue(maxsize=1, on_drop=dropped.append)
+        queue.put(make_item('live'))
+        assert not queue.put(make_item('prefetch'),
+                             priority=ingest.PRIO_BACKFILL)
+        assert [bnch.filepath for bnch in dropped] == ['prefetch']
+        assert drain(queue) == ['live']
+
+    def test_channel_oldest(self):
+        dropped = []
+        queue = ingest.IngestQueue(maxsize=3, policy='channel-oldest',
+                                   on_drop=dropped.append)
+        queue.put(make_item('a1', 'A'))
+        queue.put(make_item('b1', 'B'))
+        queue.put(make_item('b2', 'B'))
+        queue.put(make_item('b3', 'B'))
+        assert [bnch.filepath for bnch in dropped] == ['b1']
+        assert drain(queue) == ['a1', 'b2', 'b3']
+
+    def test_undroppable_items_exceed_capacity(self):
+        dropped = []
+        queue = ingest.IngestQueue(maxsize=1, on_drop=dropped.append)
+        queue.put(make_item('live'))
+        assert queue.put(make_item('request'), priority=ingest.PRIO_INTERACTIVE,
+                         droppable=False)
+        assert queue.qsize() == 2
+        assert dropped == []
+
+    def test_block_policy(self):
+        queue = ingest.IngestQueue(maxsize=1, policy='block')
+        queue.put(make_item('a'))
+        done = threading.Event()
+
+        def producer():
+            queue.put(make_item('b'))
+            done.set()
+
+        thr = threading.Thread(target=producer, daemon=True)
+        thr.start()
+        assert not done.wait(0.2)
+        assert queue.get().filepath == 'a'
+        assert done.wait(5.0)
+        assert queue.get().filepath == 'b'
+
+    def test_close_wakes_consumers(self):
+        queue = ingest.IngestQueue()
+        res = []
+        thr = threading.Thread(target=lambda: res.append(queue.get()),
+                               daemon=True)
+        thr.start()
+        queue.close()
+        thr.join(5.0)
+        assert res == [None]
+
+    def test_bad_policy(self):
+        with pytest.raises(ValueError):
+            ingest.IngestQueue(policy='newest')
+
+
+class TestSequenceGate:
+
+    def test_releases_in_ticket_order(self):
+        gate = ingest.SequenceGate()
+        res = []
+        tickets = [gate.ticket('ch') for i in range(3)]
+        gate.release('ch', tickets[2], lambda: res.append(2))
+        gate.release('ch', tickets[1], lambda: res.append(1))
+        assert res == []
+        gate.release('ch', tickets[0], lambda: res.append(0))
+        assert res == [0, 1, 2]
+        assert gate.get_stats()['held'] == 0
+
+    def test_keys_are_independent(self):
+        gate = ingest.SequenceGate()
+        res = []
+        gate.ticket('A')
+        ticket_b = gate.ticket('B')
+        gate.release('B', ticket_b, lambda: res.append('B'))
+        assert res == ['B']
+
+    def test_no_key_runs_at_once(self):
+        gate = ingest.SequenceGate()
+        res = []
+        assert gate.ticket(None) is None
+        gate.release(None, None, lambda: res.append(1))
+        assert res == [1]
+
+    def test_release_without_action(self):
+        gate = ingest.SequenceGate()
+        res = []
+        t0, t1 = gate.ticket('ch'), gate.ticket('ch')
+        gate.release('ch', t1, lambda: res.append(1))
+        # e.g. a dropped frame
+        gate.release('ch', t0, None)
+        assert res == [1]
+
+    def test_early_action_waits_for_earlier_tickets(self):
+        gate = ingest.SequenceGate()
+        res = []
+        t0, t1 = gate.ticket('ch'), gate.ticket('ch')
+        gate.run_when_next('ch', t1, lambda: res.append('preview1'))
+        assert res == []
+        gate.release('ch', t0, lambda: res.append('image0'))
+        assert res == ['image0', 'preview1']
+        gate.release('ch', t1, lambda: res.append('image1'))
+        assert res == ['image0', 'preview1', 'image1']
+
+    def test_early_action_is_dropped_once_released(self):
+        gate = ingest.SequenceGate()
+        res = []
+        t0, t1 = gate.ticket('ch'), gate.ticket('ch')
+        gate.run_when_next('ch', t1, lambda: res.append('preview1'))
+        # the full image was ready before the one before it was shown
+        gate.release('ch', t1, lambda: res.append('image1'))
+        gate.release('ch', t0, lambda: res.append('image0'))
+        assert res == ['image0', 'image1']
+        assert gate.get_stats()['early'] == 0
+
+    def test_errors_in_actions_do_not_block(self):
+        gate = ingest.SequenceGate()
+        res = []
+        t0, t1 = gate.ticket('ch'), gate.ticket('ch')
+
+        def fail():
+            raise ValueError("oops")
+
+        gate.release('ch', t1, lambda: res.append(1))
+        gate.release('ch', t0, fail)
+        assert res == [1]
+
+
+def test_coalescer_merges_events():
+    coalescer = ingest.EventCoalescer(window=1.0)
+    coalescer.add('/data/a.fits', data_dir='/data')
+    coalescer.add('/data/a.fits', data_dir='/data')
+    coalescer.add('/data/b.fits')
+    coalescer.discard('/data/b.fits')
+    assert coalescer.get_ready() == []
+
+    due = coalescer.get_next_due()
+    res = coalescer.get_ready(now=due)
+    assert [bnch.filepath for bnch in res] == ['/data/a.fits']
+    assert res[0].num_events == 2
+    assert res[0].data_dir == '/data'
+    stats = coalescer.get_stats()
+    assert (stats['merged'], stats['discarded'], stats['pending']) == (1, 1, 0)
+
+
+def test_frame_index(tmp_path):
+    for name in ('MCSA00000001.fits', 'MCSA00000001.fits.fz',
+                 'MCSA00000002.fits.fz', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'')
+    index = ingest.FrameIndex()
+    assert index.scan(str(tmp_path)) == 3
+
+    path1 = os.path.join(str(tmp_path), 'MCSA00000001.fits')
+    # uncompressed files are preferred
+    assert index.get_path('MCSA00000001') == path1
+    index.remove(path1)
+    assert index.get_path('MCSA00000001') == path1 + '.fz'
+    index.remove(path1 + '.fz')
+    assert index.get_path('MCSA00000001') is None
+    assert len(index) == 1
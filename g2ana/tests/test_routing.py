@@ -0,0 +1,110 @@
+#
+# test_routing.py -- tests for routing frames to channels
+#
+import pytest
+
+from g2ana import routing
+
+
+class FakeFrame:
+    """The parts of a g2base Frame used for routing."""
+
+    def __init__(self, frameid):
+        self.frameid = frameid
+        self.inscode = frameid[:3]
+        self.frametype = frameid[3]
+        self.number = int(frameid[4:])
+
+    def __str__(self):
+        return self.frameid
+
+
+class FakeINSdata:
+    """The parts of g2cam.INS.INSdata used by the routing table."""
+
+    codes = dict(IRCS='IRC', FOCAS='FCS', MOIRCS='MCS', PFS='PFS')
+
+    def __init__(self):
+        self.num_calls = 0
+
+    def getNames(self):
+        return list(self.codes.keys())
+
+    def getCodeByName(self, insname):
+        return self.codes[insname]
+
+    def getNameByFrameId(self, frameid):
+        self.num_calls += 1
+        for insname, code in self.codes.items():
+            if frameid.startswith(code):
+                return insname
+        raise KeyError(frameid)
+
+
+@pytest.fixture
+def routes():
+    return routing.RoutingTable(FakeINSdata())
+
+
+@pytest.mark.parametrize('frameid, header, chname, wsname', [
+    ('IRCA00000001', None, 'IRCS', 'channels'),
+    ('FCSA00000001', {'DET-ID': 1}, 'FOCAS_1', 'FOCAS'),
+    ('MCSA00000002', {'DET-ID': 2}, 'MOIRCS_2', 'MOIRCS'),
+    # PFS: spectrograph in the second digit from the right, arm in the last
+    ('PFSA00000111', None, 'PFSA_B1', 'PFS_1'),
+    ('PFSB00000132', None, 'PFSB_R3', 'PFS_3'),
+    ('PFSC00000111', None, 'PFSC', 'channels'),
+])
+def test_lookup(routes, frameid, header, chname, wsname):
+    route = routes.lookup(FakeFrame(frameid), header)
+    assert (route.chname, route.wsname) == (chname, wsname)
+
+
+def test_lookup_is_memoised(routes):
+    for num in range(10):
+        routes.lookup(FakeFrame('FCSA%08d' % num), {'DET-ID': 1 + num % 2})
+    stats = routes.get_stats()
+    assert stats['lookups'] == 10
+    # one route per detector
+    assert stats['misses'] == 2
+
+
+def test_needs_header(routes):
+    assert routes.needs_header(FakeFrame('MCSA00000001'))
+    assert not routes.needs_header(FakeFrame('IRCA00000001'))
+
+
+def test_expect_routes(routes):
+    chnames = [route.chname
+               for route in routes.expect_routes(FakeFrame('FCSA00000001'))]
+    assert chnames == ['FOCAS_1', 'FOCAS_2']
+
+
+def test_instrument_routes(routes):
+    chnames = set(route.chname for route in routes.get_instrument_routes('PFS'))
+    # arms 2 and 4 share a channel
+    assert len(chnames) == 2 * 4 * 3
+    assert 'PFSA_N4' in chnames
+    assert ([route.chname for route in routes.get_instrument_routes('IRCS')] ==
+            ['IRCS'])
+
+
+def test_unknown_code_is_looked_up_once():
+    insconfig = FakeINSdata()
+    routes = routing.RoutingTable(insconfig)
+    # as if the code had been missing from the configuration
+    routes.insnames.pop('IRC')
+    routes.get_insname('IRCA00000001')
+    routes.get_insname('IRCA00000002')
+    assert insconfig.num_calls == 1
+
+
+@pytest.mark.parametrize('insname, chname', [
+    ('FOCAS', 'FOCAS_1'),
+    ('MOIRCS', 'MOIRCS_1'),
+    ('PFS', 'PFSA_B1'),
+    ('IRCS', 'channels'),
+    ('HSC', 'channels'),
+])
+def test_operation_chname(insname, chname):
+    assert routing.get_operation_chname(insname) == chname
@@ -0,0 +1,54 @@
+#
+# test_rpcdata.py -- tests for preparing results for XML-RPC
+#
+import xmlrpc.client
+
+import numpy as np
+import pytest
+
+from g2ana import rpcdata
+
+
+@pytest.mark.parametrize('arr', [
+    np.arange(12, dtype='<f4').reshape(3, 4),
+    np.arange(6, dtype='>i2'),
+    np.array([True, False]),
+    np.zeros((0, 3), dtype=np.uint16),
+    # not contiguous
+    np.arange(20, dtype=np.float64).reshape(4, 5)[:, ::2],
+])
+def test_array_round_trip(arr):
+    dct = rpcdata.encode_array(arr)
+    res = rpcdata.decode_array(dct)
+    assert res.dtype == arr.dtype
+    np.testing.assert_array_equal(res, arr)
+
+
+def test_cleanse_nested():
+    obj = dict(count=np.int64(3), ratio=np.float32(0.5), ok=np.bool_(True),
+               scalar=np.array(2.0),
+               items=[(1, np.uint16(2)), dict(data=np.arange(3))],
+               **{'7': 'str key'})
+    obj[8] = 'int key'
+    res = rpcdata.cleanse(obj)
+
+    assert type(res['count']) is int and res['count'] == 3
+    assert type(res['ratio']) is float
+    assert res['ok'] is True
+    assert res['scalar'] == 2.0
+    assert res['items'][0] == [1, 2]
+    assert rpcdata.array_key in res['items'][1]['data']
+    assert res['8'] == 'int key'
+
+
+def test_survives_xmlrpc():
+    obj = dict(stats=[dict(median=np.float64(1.5))],
+               data=np.arange(6, dtype=np.int32).reshape(2, 3))
+    # as the result would be sent and received
+    payload = xmlrpc.client.dumps((rpcdata.cleanse(obj),),
+                                  methodresponse=True)
+    (received,), _ = xmlrpc.client.loads(payload)
+
+    res = rpcdata.decode(received)
+    assert res['stats'] == [dict(median=1.5)]
+    np.testing.assert_array_equal(res['data'], obj['data'])
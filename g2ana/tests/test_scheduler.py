@@ -0,0 +1,105 @@
+#
+# test_scheduler.py -- tests for the scheduling of Gen2 commands
+#
+import threading
+
+import pytest
+
+from g2ana.scheduler import CommandScheduler
+
+
+class Recorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.cancelled = []
+        self.ev_cancelled = threading.Event()
+
+    def start(self, cmd):
+        with self.lock:
+            self.started.append(cmd.tag)
+
+    def cancel(self, cmd, reason):
+        with self.lock:
+            self.cancelled.append((cmd.tag, cmd.state, reason))
+        self.ev_cancelled.set()
+
+
+@pytest.fixture
+def rec():
+    return Recorder()
+
+
+@pytest.fixture
+def sched(rec):
+    sched = CommandScheduler(rec.start, rec.cancel)
+    yield sched
+    sched.stop()
+
+
+def test_serial_per_key(sched, rec):
+    sched.submit('a1', 'FOCAS_1', 'confirmation')
+    sched.submit('a2', 'FOCAS_1', 'userinput')
+    sched.submit('b1', 'channels', 'confirmation')
+    assert rec.started == ['a1', 'b1']
+
+    assert sched.finish('a1')
+    assert rec.started == ['a1', 'b1', 'a2']
+    stats = sched.get_stats()
+    assert (stats['running'], stats['queued']) == (2, 0)
+
+
+def test_no_key_runs_in_parallel(sched, rec):
+    sched.submit('s1', None, 'sleep')
+    sched.submit('s2', None, 'sleep')
+    assert rec.started == ['s1', 's2']
+
+
+def test_finish_twice(sched, rec):
+    sched.submit('a1', 'k', 'sleep')
+    assert sched.finish('a1')
+    assert not sched.finish('a1')
+
+
+def test_cancel_queued(sched, rec):
+    sched.submit('a1', 'k', 'confirmation')
+    sched.submit('a2', 'k', 'confirmation')
+    sched.submit('a3', 'k', 'confirmation')
+    assert sched.cancel('a2')
+    assert rec.cancelled == [('a2', 'queued', 'cancelled')]
+
+    sched.finish('a1')
+    assert rec.started == ['a1', 'a3']
+
+
+def test_cancel_running_starts_next(sched, rec):
+    sched.submit('a1', 'k', 'confirmation')
+    sched.submit('a2', 'k', 'confirmation')
+    assert sched.cancel('a1', reason='aborted')
+    assert rec.cancelled == [('a1', 'running', 'aborted')]
+    assert rec.started == ['a1', 'a2']
+    assert not sched.cancel('a1')
+    assert sched.get_stats()['methods']['confirmation']['cancelled'] == 1
+
+
+def test_timeout(sched, rec):
+    sched.submit('a1', 'k', 'confirmation', timeout_sec=0.05)
+    sched.submit('a2', 'k', 'confirmation')
+    assert rec.ev_cancelled.wait(5.0)
+    assert rec.cancelled[0][:2] == ('a1', 'running')
+    assert 'timed out' in rec.cancelled[0][2]
+    assert rec.started == ['a1', 'a2']
+    assert sched.get_stats()['methods']['confirmation']['timed_out'] == 1
+
+
+def test_finish_cancels_timer(sched, rec):
+    sched.submit('a1', 'k', 'confirmation', timeout_sec=0.1)
+    sched.finish('a1')
+    assert not rec.ev_cancelled.wait(0.3)
+
+
+def test_extra_arguments_are_kept(sched, rec):
+    marker = object()
+    cmd = sched.submit('a1', 'k', 'confirmation', result_future=marker)
+    assert cmd.result_future is marker